@@ -0,0 +1,280 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from cancellation import GenerationCancelled
+from metrics import Counter, Gauge, Histogram
+
+# Longest a request may be expected to wait for a slot before it is turned away
+ADMISSION_SLO_SECONDS = float(os.environ.get("ADMISSION_SLO_SECONDS", "60"))
+
+# Requests a single client may have running or queued at once on one controller
+# (enough for a /generate-batch of every predefined style of one fal model)
+ADMISSION_CLIENT_QUOTA = int(os.environ.get("ADMISSION_CLIENT_QUOTA", "4"))
+
+# Recent request durations used to estimate waits
+DURATION_WINDOW = int(os.environ.get("ADMISSION_DURATION_WINDOW", "50"))
+
+# How often queued requests check whether they were cancelled
+CANCELLATION_POLL_SECONDS = 0.25
+
+admission_rejections = Counter(
+    "admission_rejections_total",
+    "Requests turned away by admission control",
+    labelnames=("controller", "reason"),
+)
+admission_queue_wait = Histogram(
+    "admission_queue_wait_seconds",
+    "Time admitted requests waited for a slot",
+    labelnames=("controller",),
+)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted.
+    status is 429 when the client is over its quota and 503 when the backend is saturated; retry_after is in seconds.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def client_key(request):
+    """Identify the client of a Flask request: the X-Client-Id header set by app.js, else the caller's address"""
+    return client_key_for(request.headers, request.remote_addr)
+
+
+def client_key_for(headers, remote_addr):
+    """client_key from a mapping of lower-case header names (or case-insensitive headers) and the peer address"""
+    client_id = headers.get('x-client-id')
+    if client_id:
+        return client_id[:64]
+    forwarded = headers.get('x-forwarded-for')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return remote_addr or "unknown"
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Ticket:
+    def __init__(self, controller, client, on_grant=None):
+        self.controller = controller
+        self.client = client
+        self.granted = threading.Event()
+        self.on_grant = on_grant
+        self.started = None
+
+    def grant(self):
+        self.granted.set()
+        if self.on_grant is not None:
+            self.on_grant()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.controller.release(self)
+        return False
+
+
+class AdmissionController:
+    """
+    Bounded queue in front of one backend.
+
+    At most `concurrency` requests run at once and at most `max_queue` wait for a slot. A request is rejected up
+    front when the queue is full or when its estimated wait, computed from the durations of recent requests, exceeds
+    `slo_seconds` (503), or when its client already has `client_quota` requests running or queued (429). Free slots
+    go to waiting clients in turn, so one client queueing many requests cannot starve the others.
+
+    Use as `with controller.admit(client): ...`, or `with await controller.admit_async(client): ...` in coroutines.
+    """
+
+    def __init__(
+        self,
+        name,
+        concurrency,
+        max_queue,
+        expected_duration,
+        slo_seconds=ADMISSION_SLO_SECONDS,
+        client_quota=ADMISSION_CLIENT_QUOTA,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.expected_duration = expected_duration
+        self.slo_seconds = slo_seconds
+        self.client_quota = client_quota
+
+        self.running = 0
+        self._durations = deque(maxlen=DURATION_WINDOW)
+        self._clients = {}
+        self._waiting = OrderedDict()
+        self._queued = 0
+        self._lock = threading.Lock()
+
+        Gauge(
+            f"admission_{name}_running",
+            f"Requests holding a slot of the {name} admission controller",
+            callback=lambda: self.running,
+        )
+        Gauge(
+            f"admission_{name}_queued",
+            f"Requests waiting for a slot of the {name} admission controller",
+            callback=lambda: self._queued,
+        )
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def _duration_locked(self):
+        if not self._durations:
+            return self.expected_duration
+        return sum(self._durations) / len(self._durations)
+
+    def _estimated_wait_locked(self):
+        # A new request waits for everything queued ahead of it plus the requests running now to go through
+        ahead = self.running + self._queued - self.concurrency
+        if ahead < 0:
+            return 0.0
+        return (ahead // self.concurrency + 1) * self._duration_locked()
+
+    def duration(self):
+        """Typical request duration: mean of the recent window, or the configured expectation before any"""
+        with self._lock:
+            return self._duration_locked()
+
+    def estimated_wait(self):
+        """Seconds a new request would wait for a slot"""
+        with self._lock:
+            return self._estimated_wait_locked()
+
+    def admit(self, client, cancellation=None):
+        """
+        Admit a request from client, waiting for a slot; raises AdmissionRejected instead of queueing hopelessly.
+        A request whose cancellation token trips while it waits leaves the queue and raises GenerationCancelled.
+        """
+        ticket, enqueued = self._enqueue(client)
+        while not ticket.granted.wait(CANCELLATION_POLL_SECONDS if cancellation is not None else None):
+            if cancellation.cancelled and self._withdraw(ticket):
+                raise GenerationCancelled(cancellation.reason)
+        ticket.started = time.monotonic()
+        admission_queue_wait.observe(ticket.started - enqueued, controller=self.name)
+        return ticket
+
+    async def admit_async(self, client):
+        """
+        Coroutine equivalent of admit(): waits for a slot on the running loop instead of blocking a thread.
+        A request cancelled while it waits leaves the queue.
+        """
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        ticket, enqueued = self._enqueue(client, on_grant=lambda: loop.call_soon_threadsafe(_resolve, granted))
+        if not ticket.granted.is_set():
+            try:
+                await granted
+            except asyncio.CancelledError:
+                if not self._withdraw(ticket):
+                    # Granted in the meantime: hand the slot on
+                    self.release(ticket)
+                raise
+        ticket.started = time.monotonic()
+        admission_queue_wait.observe(ticket.started - enqueued, controller=self.name)
+        return ticket
+
+    def _enqueue(self, client, on_grant=None):
+        # Take a slot or a place in the queue for client; returns the ticket and when it was enqueued
+        ticket = _Ticket(self, client, on_grant)
+        enqueued = time.monotonic()
+        rejection = None
+        with self._lock:
+            held = self._clients.get(client, 0)
+            wait = self._estimated_wait_locked()
+            if held >= self.client_quota:
+                rejection = (
+                    "quota", f"Client already has {held} requests in progress", 429, self._duration_locked()
+                )
+            elif self.running < self.concurrency and not self._waiting:
+                self.running += 1
+                ticket.granted.set()
+            elif self._queued >= self.max_queue or wait > self.slo_seconds:
+                rejection = (
+                    "queue_full" if self._queued >= self.max_queue else "slo",
+                    f"Estimated wait of {wait:.0f}s on {self.name} exceeds the limit",
+                    503,
+                    wait,
+                )
+            else:
+                self._waiting.setdefault(client, deque()).append(ticket)
+                self._queued += 1
+            if rejection is None:
+                self._clients[client] = held + 1
+
+        if rejection is not None:
+            reason, message, status, retry_after = rejection
+            admission_rejections.inc(controller=self.name, reason=reason)
+            raise AdmissionRejected(message, status, retry_after)
+        return ticket, enqueued
+
+    def _grant_next_locked(self):
+        # Round robin over clients: the first waiting client gets the slot and moves to the back of the line
+        client, tickets = next(iter(self._waiting.items()))
+        ticket = tickets.popleft()
+        if tickets:
+            self._waiting.move_to_end(client)
+        else:
+            del self._waiting[client]
+        self._queued -= 1
+        self.running += 1
+        ticket.grant()
+
+    def _withdraw(self, ticket):
+        # Take a waiting ticket out of the queue; False if it was granted a slot in the meantime
+        with self._lock:
+            if ticket.granted.is_set():
+                return False
+            tickets = self._waiting[ticket.client]
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[ticket.client]
+            self._queued -= 1
+            held = self._clients.get(ticket.client, 0) - 1
+            if held > 0:
+                self._clients[ticket.client] = held
+            else:
+                self._clients.pop(ticket.client, None)
+            return True
+
+    def release(self, ticket):
+        """Give back the slot of a finished request"""
+        with self._lock:
+            if ticket.started is not None:
+                self._durations.append(time.monotonic() - ticket.started)
+            self.running -= 1
+            held = self._clients.get(ticket.client, 0) - 1
+            if held > 0:
+                self._clients[ticket.client] = held
+            else:
+                self._clients.pop(ticket.client, None)
+            if self._waiting and self.running < self.concurrency:
+                self._grant_next_locked()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self._queued,
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "duration_ms": round(self.duration() * 1000, 1),
+            "estimated_wait_ms": round(self.estimated_wait() * 1000, 1),
+        }
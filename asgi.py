@@ -0,0 +1,79 @@
+import json
+
+from a2wsgi import WSGIMiddleware
+
+
+class Request:
+    """The parts of an ASGI HTTP request the coroutine routes need"""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope["headers"]}
+        self.remote_addr = scope["client"][0] if scope.get("client") else None
+        self.body = body
+
+    @property
+    def content_length(self):
+        return len(self.body)
+
+    def json(self):
+        """The body parsed as JSON, or None if it is not valid JSON"""
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class JSONResponse:
+    def __init__(self, payload, status=200, headers=None):
+        self.body = json.dumps(payload).encode('utf-8')
+        self.status = status
+        self.headers = dict(headers or {})
+
+    @property
+    def content_length(self):
+        return len(self.body)
+
+    async def send(self, send):
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(self.body)).encode())]
+        for name, value in self.headers.items():
+            headers.append((name.lower().encode('latin-1'), str(value).encode('latin-1')))
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+async def read_body(receive):
+    """Read the whole body of an HTTP request"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+class HybridApp:
+    """
+    ASGI application serving some routes as coroutines on the server's event loop and every other request with a
+    WSGI app run in a thread pool.
+
+    `routes` maps (method, path) to `async def handler(request) -> JSONResponse`. Long waits on a backend belong in
+    these handlers, where they cost a coroutine instead of one of the `threads` WSGI threads.
+    """
+
+    def __init__(self, wsgi_app, routes, threads=32):
+        self.routes = dict(routes)
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        handler = self.routes.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if handler is None:
+            await self.wsgi(scope, receive, send)
+            return
+        request = Request(scope, await read_body(receive))
+        response = await handler(request)
+        await response.send(send)
@@ -0,0 +1,130 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# How long an uploaded asset URL is reused, and how many are remembered
+ASSET_TTL_SECONDS = float(os.environ.get("ASSET_TTL_SECONDS", "3600"))
+ASSET_CACHE_SIZE = int(os.environ.get("ASSET_CACHE_SIZE", "1024"))
+
+EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/webp': '.webp',
+}
+
+
+def fal_storage_uploader(data, content_type):
+    """Upload bytes to fal storage and return their URL"""
+    import fal_client
+
+    return fal_client.upload(data, content_type)
+
+
+class AssetUploadError(Exception):
+    """Raised when an asset cannot be uploaded"""
+
+
+class LocalAssetUploader:
+    """
+    Stand-in for fal storage that writes assets to a directory served at base_url.
+    Used for tests and local fake fal endpoints.
+    """
+
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, data, content_type):
+        name = hashlib.sha256(data).hexdigest() + EXTENSIONS.get(content_type, '')
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(data)
+        return f"{self.base_url}/{name}"
+
+
+class AssetStore:
+    """
+    Uploads each distinct image or mask once and remembers its URL by content hash, so that repeated generations
+    on the same photo only send a short URL to the model.
+    """
+
+    def __init__(self, uploader, ttl=ASSET_TTL_SECONDS, max_entries=ASSET_CACHE_SIZE):
+        self.uploader = uploader
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def url_for(self, image_data):
+        """
+        Return a URL for a data URI, uploading it if it has not been seen recently.
+        Plain URLs are returned unchanged.
+        """
+        if not isinstance(image_data, str) or not image_data.startswith('data:'):
+            return image_data
+
+        # Hash the encoded payload so cache hits skip base64 decoding
+        key = hashlib.sha256(image_data.encode('utf-8')).hexdigest()
+
+        def upload():
+            header, encoded = image_data.split(',', 1)
+            content_type = header[len('data:'):].split(';')[0] or 'application/octet-stream'
+            return self.uploader(base64.b64decode(encoded), content_type)
+
+        return self._get_or_upload(key, upload)
+
+    def url_for_bytes(self, data, content_type):
+        """Return a URL for raw bytes, uploading them if they have not been seen recently"""
+        key = hashlib.sha256(data).hexdigest()
+        return self._get_or_upload(key, lambda: self.uploader(data, content_type))
+
+    def _get_or_upload(self, key, upload):
+        url = self._lookup(key)
+        if url is not None:
+            return url
+
+        # One upload per key, concurrent requests for the same asset wait for it
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                url = self._lookup(key)
+                if url is not None:
+                    return url
+
+                try:
+                    url = upload()
+                except Exception as e:
+                    raise AssetUploadError(str(e)) from e
+                with self._lock:
+                    self.misses += 1
+                    self._cache[key] = (url, time.monotonic() + self.ttl)
+                    self._cache.move_to_end(key)
+                    while len(self._cache) > self.max_entries:
+                        self._cache.popitem(last=False)
+                return url
+            finally:
+                # Drop the key lock whether the upload succeeded or failed; waiters holding it still queue on it
+                with self._lock:
+                    if self._key_locks.get(key) is key_lock:
+                        del self._key_locks[key]
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            url, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return url
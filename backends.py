@@ -0,0 +1,370 @@
+import base64
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import httpx
+
+from mask_codec import is_encoded_mask, mask_png
+from styles import DEFAULT_FAL_MODEL, MASKLESS_FAL_MODELS, PREDEFINED_STYLES
+
+# Service times assumed for a backend until it has completed a generation
+LOCAL_EXPECTED_LATENCY = float(os.environ.get("LOCAL_EXPECTED_LATENCY", "30"))
+FAL_EXPECTED_LATENCY = float(os.environ.get("FAL_EXPECTED_LATENCY", "15"))
+
+# Weight of the newest measurement in a backend's moving average latency
+LATENCY_SMOOTHING = float(os.environ.get("ROUTER_LATENCY_SMOOTHING", "0.2"))
+
+# 1x1 white PNG returned by stub backends
+STUB_RESULT = "data:image/png;base64," + base64.b64encode(bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c63f8ffffff7f0009fb03fd2a86e38a0000000049454e44ae426082"
+)).decode('ascii')
+
+
+class BackendError(Exception):
+    """Raised when a backend could not produce an image"""
+
+
+class BackendBusy(Exception):
+    """
+    Raised when a backend turns a generation away because it is overloaded (HTTP 429 or 503).
+    This says nothing about the backend's health: the router falls back without counting it as a failure.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BackendRejected(Exception):
+    """
+    Raised when a backend refuses one request rather than failing: invalid input, a size it cannot fit or a missing
+    checkpoint (HTTP 4xx), or a generation cancelled or past its deadline (499, 504). Like BackendBusy it does not count
+    against the backend's health, and the router falls back.
+    """
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def fal_generation_target(selected_style, prompt):
+    """Return the fal model, prompt and whether to send the mask for a predefined style or a custom prompt"""
+    model = DEFAULT_FAL_MODEL
+    final_prompt = prompt
+    use_mask = True
+
+    if selected_style and selected_style in PREDEFINED_STYLES:
+        # Use predefined style
+        style_info = PREDEFINED_STYLES[selected_style]
+        model = style_info["model"]
+        final_prompt = style_info["prompt"]
+        print(f"Using predefined style: {style_info['name']} with model: {model}")
+
+        # Image-to-image models restyle everything, no need for mask
+        if model in MASKLESS_FAL_MODELS:
+            use_mask = False
+
+    return model, final_prompt, use_mask
+
+
+def fal_arguments(asset_store, image_data, mask_data, final_prompt, use_mask):
+    """Upload the inputs once and build the fal arguments, with URLs instead of inline data URIs"""
+    image_url = asset_store.url_for(image_data)
+    mask_url = None
+    if use_mask and is_encoded_mask(mask_data):
+        # Compact masks are expanded to a PNG only here, for the model
+        mask_url = asset_store.url_for_bytes(mask_png(mask_data), 'image/png')
+    elif use_mask and mask_data:
+        mask_url = asset_store.url_for(mask_data)
+    print(f"Asset store: {asset_store.hits} hits, {asset_store.misses} uploads")
+
+    api_args = {
+        "image_url": image_url,
+        "prompt": final_prompt
+    }
+
+    # Add mask only if needed and available
+    if mask_url:
+        api_args["mask_url"] = mask_url
+    return api_args
+
+
+def extract_result_url(result):
+    """Return the generated image URL from a fal result, or None if it has no image"""
+    print("Got API result:", result)
+
+    if 'images' in result and len(result['images']) > 0 and 'url' in result['images'][0]:
+        return result['images'][0]['url']
+
+    elif 'image' in result:
+        # Handle legacy or alternative response format
+        print("Successfully received image result (legacy format)")
+        return result['image']
+
+    print("No image in result:", result)
+    return None
+
+
+class Backend(ABC):
+    """
+    A place generations can run, as seen by the router.
+
+    Subclasses implement `generate`. `run` wraps it with the bookkeeping the router needs: at most `concurrency`
+    generations execute at once and the rest wait in this process, the number of accepted generations is the queue
+    depth, and completed generations update a moving average of the service time. A generation can be counted as
+    accepted ahead of running it with `reserve`, so that routing decisions see it at once.
+    """
+
+    name = "backend"
+
+    def __init__(self, concurrency, expected_latency):
+        self.concurrency = concurrency
+        self.latency = expected_latency
+        self.completed = 0
+        self.failed = 0
+
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    @abstractmethod
+    def generate(self, image, mask, prompt, style):
+        """Generate a design and return its URL or data URI"""
+
+    def accepts(self, image, mask, prompt, style):
+        """Return True if this backend can serve the request at all"""
+        return True
+
+    @property
+    def in_flight(self):
+        """Generations accepted and not finished, running or waiting for a slot"""
+        return self._in_flight
+
+    @property
+    def queued(self):
+        """Generations waiting for a slot"""
+        return max(0, self._in_flight - self.concurrency)
+
+    def estimated_wait(self, extra=0):
+        """Seconds a new generation would wait for a slot, from the queue depth and the measured service time"""
+        waiting = self._in_flight + extra - self.concurrency + 1
+        if waiting <= 0:
+            return 0.0
+        return -(-waiting // self.concurrency) * self.latency
+
+    def estimated_completion(self):
+        """Seconds until a new generation would finish"""
+        return self.estimated_wait() + self.latency
+
+    def reserve(self):
+        """Count a generation as accepted; pass reserved=True to `run` it, or give the place back with `release`"""
+        with self._lock:
+            self._in_flight += 1
+
+    def release(self):
+        """Give back the place of a reserved generation that will not run"""
+        with self._lock:
+            self._in_flight -= 1
+
+    def run(self, image, mask, prompt, style, reserved=False):
+        if not reserved:
+            self.reserve()
+        try:
+            with self._slots:
+                started = time.monotonic()
+                result = self.generate(image, mask, prompt, style)
+                elapsed = time.monotonic() - started
+            with self._lock:
+                self.completed += 1
+                self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+            return result
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        return {
+            "in_flight": self._in_flight,
+            "queued": self.queued,
+            "concurrency": self.concurrency,
+            "latency_ms": round(self.latency * 1000, 1),
+            "estimated_wait_ms": round(self.estimated_wait() * 1000, 1),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+class FalGenerationBackend(Backend):
+    """fal models through the shared asynchronous queue client; fal scales out, so its own limits apply"""
+
+    name = "fal"
+
+    def __init__(self, fal_backend, asset_store, concurrency=None, expected_latency=FAL_EXPECTED_LATENCY):
+        if concurrency is None:
+            concurrency = fal_backend.max_pending
+        super().__init__(concurrency, expected_latency)
+        self.fal_backend = fal_backend
+        self.asset_store = asset_store
+
+    def generate(self, image, mask, prompt, style):
+        model, final_prompt, use_mask = fal_generation_target(style, prompt)
+        api_args = fal_arguments(self.asset_store, image, mask, final_prompt, use_mask)
+        print(f"Calling FAL AI API with model: {model}...")
+        result = self.fal_backend.subscribe(model, arguments=api_args)
+        image_url = extract_result_url(result)
+        if image_url is None:
+            raise BackendError("Failed to generate image")
+        return image_url
+
+
+class LocalHTTPBackend(Backend):
+    """The local FLUX pipeline served by local.py; runs one generation per GPU at a time by default"""
+
+    name = "local"
+
+    def __init__(self, base_url, concurrency=1, expected_latency=LOCAL_EXPECTED_LATENCY, timeout=600.0):
+        super().__init__(concurrency, expected_latency)
+        self.base_url = base_url.rstrip('/')
+        self.client = httpx.Client(timeout=timeout)
+
+    def accepts(self, image, mask, prompt, style):
+        # The local pipeline only inpaints
+        return bool(mask)
+
+    def generate(self, image, mask, prompt, style):
+        response = self.client.post(
+            f"{self.base_url}/generate",
+            json={"image": image, "mask": mask, "prompt": prompt, "style": style},
+        )
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code in (429, 503):
+            # Admission control of local.py: overloaded, not broken
+            retry_after = response.headers.get('Retry-After')
+            raise BackendBusy(
+                data.get('error') or f"Local backend returned {response.status_code}",
+                int(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+        if 400 <= response.status_code < 500 or response.status_code == 504:
+            # The request was at fault or gave up; only server errors say the local pipeline is unhealthy
+            raise BackendRejected(
+                data.get('error') or f"Local backend returned {response.status_code}", response.status_code
+            )
+        if response.status_code != 200 or 'result_url' not in data:
+            raise BackendError(data.get('error') or f"Local backend returned {response.status_code}")
+        return data['result_url']
+
+    def probe(self):
+        """Model state reported by local.py's cached health check"""
+        response = self.client.get(f"{self.base_url}/api-status", timeout=5.0)
+        response.raise_for_status()
+        return response.json()
+
+
+class StubBackend(Backend):
+    """Stand-in backend that sleeps for a random service time and returns a blank image, for tests and load tests"""
+
+    def __init__(self, name, concurrency=1, latency=1.0, jitter=0.2, failure_rate=0.0, requires_mask=False):
+        super().__init__(concurrency, latency)
+        self.name = name
+        self.mean_latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.requires_mask = requires_mask
+
+    def accepts(self, image, mask, prompt, style):
+        return bool(mask) or not self.requires_mask
+
+    def generate(self, image, mask, prompt, style):
+        time.sleep(max(0.0, random.gauss(self.mean_latency, self.jitter * self.mean_latency)))
+        if random.random() < self.failure_rate:
+            raise BackendError(f"{self.name} stub failure")
+        return STUB_RESULT
+
+
+class HybridRouter:
+    """
+    Routes each generation to the local backend while it keeps up, and overflows to the remote backend otherwise.
+
+    Local is chosen when it has a free slot, or when its queue is shorter than `max_local_queue` and the estimated
+    local completion time (queue wait plus measured service time) is no later than the remote one. That keeps the local
+    hardware busy while bounding the extra latency of queueing behind it. Requests the local backend cannot serve, and
+    requests arriving while its circuit breaker is open, go remote.
+    """
+
+    def __init__(self, local, remote, health, max_local_queue=4, fallback=True):
+        self.local = local
+        self.remote = remote
+        self.health = health
+        self.max_local_queue = max_local_queue
+        self.fallback = fallback
+        self.routed = {local.name: 0, remote.name: 0}
+        self._lock = threading.Lock()
+
+    def choose(self, image, mask, prompt, style):
+        """Return the backend a new generation should run on; see `choose_and_reserve` to act on the choice"""
+        local, remote = self.local, self.remote
+        if not local.accepts(image, mask, prompt, style):
+            return remote
+        if self.health.breaker(local.name).state == "open":
+            return remote
+        if local.in_flight < local.concurrency:
+            return local
+        if local.queued >= self.max_local_queue:
+            return remote
+        if local.estimated_completion() <= remote.estimated_completion():
+            return local
+        return remote
+
+    def choose_and_reserve(self, image, mask, prompt, style):
+        """
+        Choose a backend and reserve a place on it in one step, so that concurrent requests cannot all see the same
+        free local slot. The caller must run the generation with reserved=True or release the place.
+        """
+        with self._lock:
+            backend = self.choose(image, mask, prompt, style)
+            backend.reserve()
+            self.routed[backend.name] += 1
+        return backend
+
+    def generate(self, image, mask, prompt, style):
+        """Generate a design on the chosen backend; returns (result_url, backend name)"""
+        backend = self.choose_and_reserve(image, mask, prompt, style)
+        started = False
+
+        def run():
+            nonlocal started
+            started = True
+            return backend.run(image, mask, prompt, style, reserved=True)
+
+        try:
+            return self.health.call(backend.name, run), backend.name
+        except Exception as e:
+            if not started:
+                # Turned away by the circuit breaker before running
+                backend.release()
+            if not self.fallback or backend is self.remote:
+                raise
+            print(f"Local generation failed, falling back to {self.remote.name}: {str(e)}")
+            with self._lock:
+                self.routed[self.remote.name] += 1
+            run = lambda: self.remote.run(image, mask, prompt, style)
+            return self.health.call(self.remote.name, run), self.remote.name
+
+    def stats(self):
+        with self._lock:
+            routed = dict(self.routed)
+        return {
+            backend.name: {**backend.stats(), "routed": routed[backend.name]}
+            for backend in (self.local, self.remote)
+        }
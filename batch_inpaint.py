@@ -0,0 +1,288 @@
+"""
+Inpaint every row of a manifest with one model load.
+
+    python batch_inpaint.py manifest.jsonl --output-dir results/ --batch-size 4
+
+The manifest is JSONL or CSV with one row per job: `image` and `mask` (paths or URLs), `prompt` or `style` (one of the
+predefined styles), and optionally `id` and `seed`. A pool of threads downloads and decodes the inputs ahead of the GPU,
+rows are grouped into batches of the same resolution bucket, and results are encoded and written by another pool
+while the next batch runs. Every finished row is appended to a progress file, so an interrupted job resumes where it
+stopped when it is started again with the same arguments.
+"""
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from styles import PREDEFINED_STYLES
+
+# Resolutions of about one megapixel the inputs are resized to, so that rows of similar aspect ratios share a batch
+BUCKETS = [
+    (1024, 1024),
+    (1152, 896),
+    (896, 1152),
+    (1280, 768),
+    (768, 1280),
+    (1344, 768),
+    (768, 1344),
+    (1536, 640),
+    (640, 1536),
+]
+
+GENERATION_DEFAULTS = dict(
+    num_inference_steps=28,
+    controlnet_conditioning_scale=0.9,
+    guidance_scale=3.5,
+    true_guidance_scale=1.0,
+)
+
+
+def read_manifest(path):
+    """Rows of a JSONL or CSV manifest, with an `id` (the row number unless given)"""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for index, row in enumerate(rows):
+        row["id"] = str(index if row.get("id") in (None, "") else row["id"])
+    return rows
+
+
+def read_progress(path):
+    """Ids already written successfully by a previous run"""
+    done = set()
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get("status") == "ok":
+                        done.add(record["id"])
+    return done
+
+
+def row_seed(row, base_seed):
+    """Seed of a row: its own, including 0, or base_seed when it does not set one"""
+    return base_seed if row.get("seed") in (None, "") else int(row["seed"])
+
+
+def nearest_bucket(width, height):
+    """Bucket whose aspect ratio is closest to width x height"""
+    aspect = width / height
+    return min(BUCKETS, key=lambda bucket: abs(bucket[0] / bucket[1] - aspect))
+
+
+class ProgressLog:
+    """Append-only record of finished rows, shared by the writer threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, **fields):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(fields) + "\n")
+
+
+def prepare_row(row, base_seed):
+    """Download and decode the inputs of a row and resize them to its bucket (runs on the prefetch pool)"""
+    from diffusers.utils import load_image
+    from PIL import Image
+
+    prompt = row.get("prompt")
+    style = row.get("style")
+    if style:
+        if style not in PREDEFINED_STYLES:
+            raise ValueError(f"Unknown style {style!r}")
+        prompt = PREDEFINED_STYLES[style]["prompt"]
+    if not prompt:
+        raise ValueError("Row has neither a prompt nor a style")
+
+    image = load_image(row["image"]).convert("RGB")
+    mask = load_image(row["mask"]).convert("RGB")
+    original_size = image.size
+    bucket = nearest_bucket(*original_size)
+    if image.size != bucket:
+        image = image.resize(bucket, Image.LANCZOS)
+    if mask.size != bucket:
+        mask = mask.resize(bucket, Image.NEAREST)
+
+    return {
+        "id": row["id"],
+        "prompt": prompt,
+        "seed": row_seed(row, base_seed),
+        "image": image,
+        "mask": mask,
+        "bucket": bucket,
+        "original_size": original_size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inpaint every row of a JSONL or CSV manifest")
+    parser.add_argument("manifest")
+    parser.add_argument("--output-dir", default="batch_results")
+    parser.add_argument("--progress", help="Progress file, by default progress.jsonl in the output directory")
+    parser.add_argument("--batch-size", type=int, default=4, help="Rows per pipeline call, lowered to fit memory")
+    parser.add_argument("--prefetch-workers", type=int, default=8, help="Threads downloading and decoding inputs")
+    parser.add_argument("--prefetch", type=int, default=32, help="Rows decoded ahead of the GPU")
+    parser.add_argument("--writers", type=int, default=4, help="Threads encoding and writing results")
+    parser.add_argument("--format", choices=("png", "webp", "jpg"), default="png")
+    parser.add_argument("--keep-bucket-size", action="store_true", help="Do not resize results to the input size")
+    parser.add_argument("--steps", type=int, default=GENERATION_DEFAULTS["num_inference_steps"])
+    parser.add_argument("--seed", type=int, default=24, help="Seed of rows that do not set one")
+    parser.add_argument("--memory-calibration", default="memory_calibration.json")
+    args = parser.parse_args()
+
+    import torch
+    from PIL import Image
+
+    from memory_planner import MemoryPlanRejected, MemoryPlanner, component_bytes
+    from model_loader import format_load_timings, load_inpainting_pipeline
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress = ProgressLog(args.progress or os.path.join(args.output_dir, "progress.jsonl"))
+    done = read_progress(progress.path)
+    rows = [row for row in read_manifest(args.manifest) if row["id"] not in done]
+    print(f"{len(rows)} rows to process, {len(done)} already done")
+    if not rows:
+        return
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    pipe, load_timings = load_inpainting_pipeline(device=device, dtype=torch.bfloat16)
+    print(f"Pipeline loaded in {load_timings['total']:.1f}s ({format_load_timings(load_timings)})")
+
+    if os.path.isfile(args.memory_calibration):
+        planner = MemoryPlanner.load(args.memory_calibration, component_bytes(pipe))
+    else:
+        planner = MemoryPlanner(component_bytes(pipe))
+    budget = planner.budget()
+    batch_sizes = {}
+
+    def batch_size_for(bucket):
+        # Largest batch of this bucket that fits in memory, 0 if not even one row does
+        if bucket not in batch_sizes:
+            try:
+                plan = planner.plan(
+                    bucket[1],
+                    bucket[0],
+                    args.batch_size,
+                    do_classifier_free_guidance=GENERATION_DEFAULTS["true_guidance_scale"] > 1.0,
+                    budget=budget,
+                    buckets=[bucket],
+                )
+                batch_sizes[bucket] = plan["batch_size"]
+            except MemoryPlanRejected as e:
+                print(f"Skipping {bucket[0]}x{bucket[1]}: {str(e)}")
+                batch_sizes[bucket] = 0
+        return batch_sizes[bucket]
+
+    counts = {"ok": 0, "error": 0}
+    counts_lock = threading.Lock()
+
+    def finish(item_id, status, **fields):
+        progress.record(id=item_id, status=status, **fields)
+        with counts_lock:
+            counts[status] += 1
+
+    def write_result(item, image):
+        try:
+            if not args.keep_bucket_size and image.size != item["original_size"]:
+                image = image.resize(item["original_size"], Image.LANCZOS)
+            name = "".join(c if c.isalnum() or c in "-_." else "_" for c in item["id"])
+            path = os.path.join(args.output_dir, f"{name}.{args.format}")
+            image.save(path)
+            finish(item["id"], "ok", output=path)
+        except Exception as e:
+            finish(item["id"], "error", error=f"Error writing result: {str(e)}")
+
+    prefetch_pool = ThreadPoolExecutor(max_workers=args.prefetch_workers, thread_name_prefix="prefetch")
+    writer_pool = ThreadPoolExecutor(max_workers=args.writers, thread_name_prefix="writer")
+
+    def run_batch(items):
+        bucket = items[0]["bucket"]
+        generators = [torch.Generator(device=device).manual_seed(item["seed"]) for item in items]
+        try:
+            images = pipe(
+                prompt=[item["prompt"] for item in items],
+                negative_prompt=[""] * len(items),
+                height=bucket[1],
+                width=bucket[0],
+                control_image=[item["image"] for item in items],
+                control_mask=[item["mask"] for item in items],
+                num_inference_steps=args.steps,
+                generator=generators,
+                controlnet_conditioning_scale=GENERATION_DEFAULTS["controlnet_conditioning_scale"],
+                guidance_scale=GENERATION_DEFAULTS["guidance_scale"],
+                true_guidance_scale=GENERATION_DEFAULTS["true_guidance_scale"],
+            ).images
+        except Exception as e:
+            print(f"Batch of {len(items)} at {bucket[0]}x{bucket[1]} failed: {str(e)}")
+            for item in items:
+                finish(item["id"], "error", error=str(e))
+            return
+        for item, image in zip(items, images):
+            writer_pool.submit(write_result, item, image)
+
+    started = time.monotonic()
+    pending = defaultdict(list)
+    prefetched = deque()
+    remaining = iter(rows)
+
+    def refill():
+        # Keep a bounded window of rows being decoded ahead of the GPU
+        while len(prefetched) < args.prefetch:
+            row = next(remaining, None)
+            if row is None:
+                return
+            prefetched.append((row["id"], prefetch_pool.submit(prepare_row, row, args.seed)))
+
+    try:
+        refill()
+        while prefetched:
+            item_id, future = prefetched.popleft()
+            refill()
+            try:
+                item = future.result()
+            except Exception as e:
+                finish(item_id, "error", error=f"Error loading inputs: {str(e)}")
+                continue
+
+            bucket = item["bucket"]
+            size = batch_size_for(bucket)
+            if size == 0:
+                finish(item_id, "error", error=f"{bucket[0]}x{bucket[1]} does not fit in memory")
+                continue
+            pending[bucket].append(item)
+            if len(pending[bucket]) >= size:
+                run_batch(pending.pop(bucket))
+                elapsed = time.monotonic() - started
+                print(f"{counts['ok'] + counts['error']}/{len(rows)} rows, {counts['ok'] / elapsed:.2f} images/s")
+
+        # Partial batches left once the manifest is exhausted
+        for items in pending.values():
+            run_batch(items)
+    finally:
+        prefetch_pool.shutdown(wait=True, cancel_futures=True)
+        writer_pool.shutdown(wait=True)
+
+    elapsed = time.monotonic() - started
+    print(json.dumps({
+        "rows": len(rows),
+        "completed": counts["ok"],
+        "failed": counts["error"],
+        "seconds": round(elapsed, 1),
+        "images_per_second": round(counts["ok"] / elapsed, 3) if elapsed > 0 else None,
+        "load_seconds": round(load_timings["total"], 1),
+        "batch_sizes": {f"{width}x{height}": size for (width, height), size in batch_sizes.items()},
+    }))
+
+
+if __name__ == '__main__':
+    main()
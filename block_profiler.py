@@ -0,0 +1,267 @@
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import torch
+
+from transformer_flux import FluxSingleTransformerBlock, FluxTransformerBlock
+
+
+def _tensor_bytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(item) for item in value)
+    return 0
+
+
+def estimate_block_flops(
+    block: torch.nn.Module,
+    hidden_states: torch.Tensor,
+    encoder_hidden_states: Optional[torch.Tensor] = None,
+    key_tokens: Optional[int] = None,
+) -> int:
+    """
+    Estimate the floating point operations of one forward pass of a Flux block from its input shapes.
+
+    A multiply-add counts as two operations. The estimate covers the linear layers, the modulation and the attention
+    matmuls, which dominate the cost; norms, activations and rotary embeddings are ignored. For a double-stream block
+    over `L` image and text tokens of width `D` it is `24 L D^2 + 4 L^2 D + 24 D^2` per sample, and for a
+    single-stream block `24 L D^2 + 4 L^2 D + 6 D^2`. With sparse mask denoising the single blocks only receive the
+    `L` computed tokens, which attend to all `key_tokens` tokens, so the attention term becomes `4 L key_tokens D`.
+    """
+    batch_size, tokens, dim = hidden_states.shape
+    if isinstance(block, FluxTransformerBlock):
+        if encoder_hidden_states is not None:
+            tokens += encoder_hidden_states.shape[1]
+        modulation = 24 * dim * dim
+    elif isinstance(block, FluxSingleTransformerBlock):
+        modulation = 6 * dim * dim
+    else:
+        return 0
+    key_tokens = tokens if key_tokens is None else key_tokens
+    return batch_size * (24 * tokens * dim * dim + 4 * tokens * key_tokens * dim + modulation)
+
+
+def _sparse_key_tokens(sparse_cache, tokens: int) -> Optional[int]:
+    # On sparse passes the computed tokens attend to the stored keys of the whole joint sequence
+    if sparse_cache is None or sparse_cache.refreshing:
+        return None
+    return tokens - sparse_cache.image_token_index.shape[0] + sparse_cache.num_image_tokens
+
+
+class BlockProfiler:
+    r"""
+    Per-block cost of the Flux transformer and controlnet.
+
+    [`~BlockProfiler.attach`] registers forward hooks on every block in `transformer_blocks` and
+    `single_transformer_blocks` of a [`FluxTransformer2DModel`] or [`FluxControlNetModel`], and a hook on the model
+    itself that numbers its calls, one per denoising step. Each block call records its wall time, an estimate of its
+    floating point operations ([`estimate_block_flops`]), the size of its outputs and, on CUDA, how far the allocator
+    peak rose above the memory allocated when the block started. Like [`FluxStageTimer`], the profiler only reads the
+    device-wide peak statistics, so that it does not disturb the stage timings or concurrent runs: a block that stayed
+    under an earlier peak is credited with the memory it still held at its end. The device is synchronized around every
+    block so the
+    wall time belongs to the block; this serializes the host and the device, so absolute timings are somewhat higher
+    than in an unprofiled run while the relative cost of the blocks is preserved.
+
+    [`~BlockProfiler.detach`] removes every hook, after which the models run exactly as if they had never been
+    profiled. The records can be exported as a Chrome trace (open in `chrome://tracing` or https://ui.perfetto.dev) or
+    summarized as a table.
+
+    Example:
+
+    ```py
+    >>> profiler = BlockProfiler()
+    >>> profiler.attach(pipe.transformer, "transformer")
+    >>> profiler.attach(pipe.controlnet, "controlnet")
+    >>> image = pipe(prompt, control_image=image, control_mask=mask).images[0]
+    >>> profiler.detach()
+    >>> profiler.export_chrome_trace("blocks.json")
+    >>> print(profiler.summary())
+    ```
+    """
+
+    def __init__(self):
+        self.records: List[Dict] = []
+        self._handles = []
+        self._models = {}
+        self._steps = defaultdict(lambda: -1)
+        self._active = {}
+        self._origin = time.perf_counter()
+
+    @property
+    def attached(self) -> bool:
+        return bool(self._handles)
+
+    def attach(self, model: torch.nn.Module, name: str):
+        """Profile the blocks of `model`, reporting them under `name`."""
+        if name in self._models:
+            raise ValueError(f"A model is already attached as {name!r}.")
+        self._models[name] = model
+
+        def count_step(module, args):
+            self._steps[name] += 1
+
+        self._handles.append(model.register_forward_pre_hook(count_step))
+        for stack in ("transformer_blocks", "single_transformer_blocks"):
+            for index, block in enumerate(getattr(model, stack, ())):
+                self._attach_block(block, name, stack, index)
+        return self
+
+    def _attach_block(self, block: torch.nn.Module, model_name: str, stack: str, index: int):
+        key = (model_name, stack, index)
+
+        def before(module, args, kwargs):
+            hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+            encoder_hidden_states = kwargs.get("encoder_hidden_states", args[1] if len(args) > 1 else None)
+            key_tokens = None
+            if isinstance(module, FluxSingleTransformerBlock):
+                encoder_hidden_states = None
+                key_tokens = _sparse_key_tokens(kwargs.get("sparse_cache"), hidden_states.shape[1])
+            device = hidden_states.device
+            self._synchronize(device)
+            memory = peak_before = None
+            if device.type == "cuda":
+                memory = torch.cuda.memory_allocated(device)
+                peak_before = torch.cuda.max_memory_allocated(device)
+            self._active[key] = (
+                time.perf_counter(),
+                device,
+                memory,
+                peak_before,
+                estimate_block_flops(module, hidden_states, encoder_hidden_states, key_tokens),
+            )
+
+        def after(module, args, kwargs, output):
+            started, device, memory, peak_before, flops = self._active.pop(key)
+            self._synchronize(device)
+            ended = time.perf_counter()
+            peak_memory_delta = None
+            if memory is not None:
+                peak = torch.cuda.max_memory_allocated(device)
+                if peak <= peak_before:
+                    peak = max(memory, torch.cuda.memory_allocated(device))
+                peak_memory_delta = peak - memory
+            self.records.append({
+                "model": model_name,
+                "stack": stack,
+                "block": index,
+                "step": self._steps[model_name],
+                "start": started - self._origin,
+                "duration": ended - started,
+                "flops": flops,
+                "activation_bytes": _tensor_bytes(output),
+                "peak_memory_delta": peak_memory_delta,
+            })
+
+        self._handles.append(block.register_forward_pre_hook(before, with_kwargs=True))
+        self._handles.append(block.register_forward_hook(after, with_kwargs=True))
+
+    @staticmethod
+    def _synchronize(device: torch.device):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elif device.type == "mps":
+            torch.mps.synchronize()
+
+    def detach(self):
+        """Remove every hook. The records are kept."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._models = {}
+        self._active = {}
+
+    def reset(self):
+        """Drop the records and restart the step numbering, e.g. after a warmup run."""
+        self.records = []
+        self._steps.clear()
+        self._origin = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+        return False
+
+    def chrome_trace(self) -> Dict:
+        """Return the records as a Chrome trace: one thread per model, one complete event per block call."""
+        threads = {}
+        events = []
+        for record in self.records:
+            tid = threads.setdefault(record["model"], len(threads))
+            events.append({
+                "name": f"{record['stack']}.{record['block']}",
+                "cat": record["model"],
+                "ph": "X",
+                "pid": 0,
+                "tid": tid,
+                "ts": record["start"] * 1e6,
+                "dur": record["duration"] * 1e6,
+                "args": {
+                    "step": record["step"],
+                    "flops": record["flops"],
+                    "activation_bytes": record["activation_bytes"],
+                    "peak_memory_delta": record["peak_memory_delta"],
+                },
+            })
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": model}}
+            for model, tid in threads.items()
+        ]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path: str):
+        """Write the Chrome trace JSON to `path`."""
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary_rows(self) -> List[Dict]:
+        """Aggregate the records per model and block, most expensive first."""
+        groups = defaultdict(list)
+        for record in self.records:
+            groups[(record["model"], record["stack"], record["block"])].append(record)
+        total = sum(record["duration"] for record in self.records) or 1.0
+
+        rows = []
+        for (model, stack, block), records in groups.items():
+            duration = sum(record["duration"] for record in records)
+            flops = sum(record["flops"] for record in records)
+            peaks = [record["peak_memory_delta"] for record in records if record["peak_memory_delta"] is not None]
+            rows.append({
+                "model": model,
+                "stack": stack,
+                "block": block,
+                "calls": len(records),
+                "total_ms": duration * 1000,
+                "mean_ms": duration * 1000 / len(records),
+                "share": duration / total,
+                "gflops": flops / len(records) / 1e9,
+                "tflops_per_s": flops / duration / 1e12 if duration > 0 else 0.0,
+                "activation_mb": max(record["activation_bytes"] for record in records) / 2**20,
+                "peak_delta_mb": max(peaks) / 2**20 if peaks else None,
+            })
+        rows.sort(key=lambda row: row["total_ms"], reverse=True)
+        return rows
+
+    def summary(self, limit: Optional[int] = None) -> str:
+        """Format [`~BlockProfiler.summary_rows`] as a text table, optionally only the `limit` most expensive blocks."""
+        rows = self.summary_rows()
+        if limit is not None:
+            rows = rows[:limit]
+        header = (
+            f"{'model':<12} {'block':<28} {'calls':>5} {'total ms':>10} {'mean ms':>9} {'share':>6} "
+            f"{'GFLOP':>8} {'TFLOP/s':>8} {'act MB':>8} {'peak MB':>8}"
+        )
+        lines = [header, "-" * len(header)]
+        for row in rows:
+            peak = f"{row['peak_delta_mb']:8.1f}" if row["peak_delta_mb"] is not None else f"{'-':>8}"
+            lines.append(
+                f"{row['model']:<12} {row['stack'] + '.' + str(row['block']):<28} {row['calls']:>5} "
+                f"{row['total_ms']:>10.2f} {row['mean_ms']:>9.3f} {row['share']:>6.1%} "
+                f"{row['gflops']:>8.1f} {row['tflops_per_s']:>8.2f} {row['activation_mb']:>8.1f} {peak}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+
+from metrics import Counter
+
+# Longest a generation may take, from the arrival of its request, before it is stopped (0 for no limit)
+GENERATION_DEADLINE_SECONDS = float(os.environ.get("GENERATION_DEADLINE_SECONDS", "600"))
+
+generations_cancelled = Counter(
+    "generations_cancelled_total",
+    "Requests whose generation was stopped early, by reason (cancelled or deadline)",
+    labelnames=("reason",),
+)
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised when a generation is stopped early.
+    reason is "cancelled" when every request waiting for it was cancelled and "deadline" when it ran out of time.
+    """
+
+    def __init__(self, reason):
+        super().__init__("Generation was cancelled" if reason == "cancelled" else "Generation ran past its deadline")
+        self.reason = reason
+
+    @property
+    def status(self):
+        # 499 is the de facto status of requests closed by the client
+        return 499 if self.reason == "cancelled" else 504
+
+
+class CancellationToken:
+    """
+    Cooperative stop signal of one generation, polled by the work between steps.
+    It trips when cancel() is called or once the monotonic deadline, if any, has passed.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self._reason = None
+
+    def cancel(self, reason="cancelled"):
+        if self._reason is None:
+            self._reason = reason
+
+    @property
+    def reason(self):
+        if self._reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self._reason = "deadline"
+        return self._reason
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def remaining(self):
+        """Seconds left before the deadline, None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise GenerationCancelled(self.reason)
+
+
+class _Run:
+    def __init__(self, token):
+        self.token = token
+        self.requests = set()
+
+
+class CancellationRegistry:
+    """
+    Cancellation tokens of the generations in progress, by the request ids they were submitted with.
+
+    Requests sharing one generation (see SingleFlight) share its token: cancelling one of them only stops the
+    generation once every request attached to it has been cancelled. Its deadline is the latest of theirs.
+    """
+
+    def __init__(self, default_timeout=GENERATION_DEADLINE_SECONDS):
+        self.default_timeout = default_timeout
+        self._runs = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def attach(self, run_key, request_id, timeout=None):
+        """Attach a request to the generation run_key and return the generation's token"""
+        timeout = timeout or self.default_timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            run = self._runs.get(run_key)
+            if run is None or run.token.cancelled:
+                run = self._runs[run_key] = _Run(CancellationToken(deadline))
+            elif run.token.deadline is not None:
+                run.token.deadline = None if deadline is None else max(run.token.deadline, deadline)
+            run.requests.add(request_id)
+            self._requests[request_id] = run_key
+            return run.token
+
+    def detach(self, request_id):
+        """Forget a request whose generation finished, one way or another"""
+        with self._lock:
+            self._remove_locked(request_id)
+
+    def cancel(self, request_id):
+        """Cancel a request; returns False if it is not known (already finished or never submitted)"""
+        with self._lock:
+            run = self._remove_locked(request_id)
+            if run is None:
+                return False
+            if not run.requests:
+                run.token.cancel()
+            return True
+
+    def _remove_locked(self, request_id):
+        run_key = self._requests.pop(request_id, None)
+        if run_key is None:
+            return None
+        run = self._runs[run_key]
+        run.requests.discard(request_id)
+        if not run.requests:
+            del self._runs[run_key]
+        return run
+
+    def stats(self):
+        with self._lock:
+            return {"generations": len(self._runs), "requests": len(self._requests)}
@@ -37,6 +37,138 @@ class FluxControlNetOutput(BaseOutput):
     controlnet_single_block_samples: Tuple[torch.Tensor]
 
 
+class FluxControlNetResidualStream:
+    r"""
+    Lazily computed controlnet residuals for one stack of blocks, returned by [`FluxControlNetModel`] in interleaved
+    mode.
+
+    It behaves like the list of residuals the transformer expects: indexing block `i` advances the controlnet up to
+    that block and returns its projected and scaled residual. The previously returned residual is released first, so
+    only one of them is alive at a time. Blocks have to be requested in non-decreasing order, double blocks before
+    single blocks, which is how [`FluxTransformer2DModel`] consumes them.
+    """
+
+    def __init__(self, runner: "_FluxControlNetInterleavedRunner", single: bool, length: int):
+        self._runner = runner
+        self._single = single
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        if index < 0 or index >= self._length:
+            raise IndexError(f"controlnet residual index {index} out of range for {self._length} blocks")
+        return self._runner.residual(self._single, index)
+
+
+class _FluxControlNetInterleavedRunner:
+    """Runs the controlnet blocks on demand for [`FluxControlNetResidualStream`]."""
+
+    def __init__(
+        self,
+        controlnet: "FluxControlNetModel",
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        temb: torch.Tensor,
+        image_rotary_emb: torch.Tensor,
+        conditioning_scale: float,
+        residual_dtype: Optional[torch.dtype],
+        lora_scale: float,
+    ):
+        self.controlnet = controlnet
+        self.hidden_states = hidden_states
+        self.encoder_hidden_states = encoder_hidden_states
+        self.temb = temb
+        self.image_rotary_emb = image_rotary_emb
+        self.conditioning_scale = conditioning_scale
+        self.residual_dtype = residual_dtype
+        self.lora_scale = lora_scale
+
+        self._next_block = 0
+        self._next_single_block = 0
+        self._single_stack_started = False
+        self._current_key = None
+        self._current = None
+
+    def residual(self, single: bool, index: int) -> torch.Tensor:
+        key = (single, index)
+        if key == self._current_key:
+            return self._current
+
+        # release the previous residual before computing the next one
+        self._current_key, self._current = None, None
+
+        scale_lora = USE_PEFT_BACKEND and self.lora_scale != 1.0
+        if scale_lora:
+            scale_lora_layers(self.controlnet, self.lora_scale)
+        try:
+            if single:
+                sample = self._advance_single_blocks(index)
+            else:
+                sample = self._advance_blocks(index)
+        finally:
+            if scale_lora:
+                unscale_lora_layers(self.controlnet, self.lora_scale)
+
+        if self.residual_dtype is not None:
+            sample = sample.to(dtype=self.residual_dtype)
+        self._current_key, self._current = key, sample
+        return sample
+
+    def _advance_blocks(self, index: int) -> torch.Tensor:
+        if self._single_stack_started or index < self._next_block:
+            raise ValueError(
+                f"Interleaved controlnet residuals must be consumed in order, but block {index} was requested after"
+                f" block {self._next_block - 1}."
+            )
+        while self._next_block <= index:
+            self.encoder_hidden_states, self.hidden_states = self.controlnet.transformer_blocks[self._next_block](
+                hidden_states=self.hidden_states,
+                encoder_hidden_states=self.encoder_hidden_states,
+                temb=self.temb,
+                image_rotary_emb=self.image_rotary_emb,
+            )
+            self._next_block += 1
+
+        sample = self.controlnet.controlnet_blocks[index](self.hidden_states)
+        return self.controlnet._scale_residual(sample, self.conditioning_scale)
+
+    def _advance_single_blocks(self, index: int) -> torch.Tensor:
+        if not self._single_stack_started:
+            # the single stack starts from the output of the last double block, whether or not its residual was used
+            while self._next_block < len(self.controlnet.transformer_blocks):
+                self.encoder_hidden_states, self.hidden_states = self.controlnet.transformer_blocks[
+                    self._next_block
+                ](
+                    hidden_states=self.hidden_states,
+                    encoder_hidden_states=self.encoder_hidden_states,
+                    temb=self.temb,
+                    image_rotary_emb=self.image_rotary_emb,
+                )
+                self._next_block += 1
+            self.hidden_states = torch.cat([self.encoder_hidden_states, self.hidden_states], dim=1)
+            self._single_stack_started = True
+
+        if index < self._next_single_block:
+            raise ValueError(
+                f"Interleaved controlnet residuals must be consumed in order, but single block {index} was requested"
+                f" after single block {self._next_single_block - 1}."
+            )
+        while self._next_single_block <= index:
+            self.hidden_states = self.controlnet.single_transformer_blocks[self._next_single_block](
+                hidden_states=self.hidden_states,
+                temb=self.temb,
+                image_rotary_emb=self.image_rotary_emb,
+            )
+            self._next_single_block += 1
+
+        sample = self.controlnet.controlnet_single_blocks[index](
+            self.hidden_states[:, self.encoder_hidden_states.shape[1] :]
+        )
+        return self.controlnet._scale_residual(sample, self.conditioning_scale)
+
+
 class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
     _supports_gradient_checkpointing = True
 
@@ -219,6 +351,15 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
 
         return controlnet
 
+    @staticmethod
+    def _scale_residual(sample: torch.Tensor, conditioning_scale: float) -> torch.Tensor:
+        # the projected residual is not referenced anywhere else, so it can be scaled in place at inference
+        if conditioning_scale == 1.0:
+            return sample
+        if torch.is_grad_enabled():
+            return sample * conditioning_scale
+        return sample.mul_(conditioning_scale)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -232,6 +373,8 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         guidance: torch.Tensor = None,
         joint_attention_kwargs: Optional[Dict[str, Any]] = None,
         return_dict: bool = True,
+        interleaved: bool = False,
+        residual_dtype: Optional[torch.dtype] = None,
     ) -> Union[torch.FloatTensor, Transformer2DModelOutput]:
         """
         The [`FluxTransformer2DModel`] forward method.
@@ -254,6 +397,12 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~models.transformer_2d.Transformer2DModelOutput`] instead of a plain
                 tuple.
+            interleaved (`bool`, *optional*, defaults to `False`):
+                Inference only. Instead of running all blocks, return [`FluxControlNetResidualStream`]s that run each
+                controlnet block when the transformer asks for its residual, so that only one residual is alive at a
+                time. The streams must be passed to the transformer before the next call to this model.
+            residual_dtype (`torch.dtype`, *optional*):
+                Dtype the residuals are cast to in interleaved mode.
 
         Returns:
             If `return_dict` is True, an [`~models.transformer_2d.Transformer2DModelOutput`] is returned, otherwise a
@@ -265,6 +414,9 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         else:
             lora_scale = 1.0
 
+        if interleaved and self.training and self.gradient_checkpointing:
+            raise ValueError("Interleaved controlnet execution does not support gradient checkpointing.")
+
         if USE_PEFT_BACKEND:
             # weight the lora layers by setting `lora_scale` for each PEFT layer
             scale_lora_layers(self, lora_scale)
@@ -297,8 +449,42 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
         ids = torch.cat((txt_ids, img_ids), dim=1)
         image_rotary_emb = self.pos_embed(ids)
 
-        block_samples = ()
-        for _, block in enumerate(self.transformer_blocks):
+        if interleaved:
+            if USE_PEFT_BACKEND:
+                # the runner scales the lora layers around each block it runs
+                unscale_lora_layers(self, lora_scale)
+
+            runner = _FluxControlNetInterleavedRunner(
+                self,
+                hidden_states=hidden_states,
+                encoder_hidden_states=encoder_hidden_states,
+                temb=temb,
+                image_rotary_emb=image_rotary_emb,
+                conditioning_scale=conditioning_scale,
+                residual_dtype=residual_dtype,
+                lora_scale=lora_scale,
+            )
+            controlnet_block_samples = (
+                FluxControlNetResidualStream(runner, single=False, length=len(self.transformer_blocks))
+                if len(self.transformer_blocks) > 0
+                else None
+            )
+            controlnet_single_block_samples = (
+                FluxControlNetResidualStream(runner, single=True, length=len(self.single_transformer_blocks))
+                if len(self.single_transformer_blocks) > 0
+                else None
+            )
+
+            if not return_dict:
+                return (controlnet_block_samples, controlnet_single_block_samples)
+
+            return FluxControlNetOutput(
+                controlnet_block_samples=controlnet_block_samples,
+                controlnet_single_block_samples=controlnet_single_block_samples,
+            )
+
+        controlnet_block_samples = []
+        for index_block, block in enumerate(self.transformer_blocks):
             if self.training and self.gradient_checkpointing:
 
                 def create_custom_forward(module, return_dict=None):
@@ -332,12 +518,17 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                     temb=temb,
                     image_rotary_emb=image_rotary_emb,
                 )
-            block_samples = block_samples + (hidden_states,)
+            controlnet_block_samples.append(
+                self._scale_residual(
+                    self.controlnet_blocks[index_block](hidden_states),
+                    conditioning_scale,
+                )
+            )
 
         hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
 
-        single_block_samples = ()
-        for _, block in enumerate(self.single_transformer_blocks):
+        controlnet_single_block_samples = []
+        for index_block, block in enumerate(self.single_transformer_blocks):
             if self.training and self.gradient_checkpointing:
 
                 def create_custom_forward(module, return_dict=None):
@@ -366,35 +557,15 @@ class FluxControlNetModel(ModelMixin, ConfigMixin, PeftAdapterMixin):
                     temb=temb,
                     image_rotary_emb=image_rotary_emb,
                 )
-            single_block_samples = single_block_samples + (
-                hidden_states[:, encoder_hidden_states.shape[1] :],
-            )
-
-        # controlnet block
-        controlnet_block_samples = ()
-        for block_sample, controlnet_block in zip(
-            block_samples, self.controlnet_blocks
-        ):
-            block_sample = controlnet_block(block_sample)
-            controlnet_block_samples = controlnet_block_samples + (block_sample,)
-
-        controlnet_single_block_samples = ()
-        for single_block_sample, controlnet_block in zip(
-            single_block_samples, self.controlnet_single_blocks
-        ):
-            single_block_sample = controlnet_block(single_block_sample)
-            controlnet_single_block_samples = controlnet_single_block_samples + (
-                single_block_sample,
+            controlnet_single_block_samples.append(
+                self._scale_residual(
+                    self.controlnet_single_blocks[index_block](
+                        hidden_states[:, encoder_hidden_states.shape[1] :]
+                    ),
+                    conditioning_scale,
+                )
             )
 
-        # scaling
-        controlnet_block_samples = [
-            sample * conditioning_scale for sample in controlnet_block_samples
-        ]
-        controlnet_single_block_samples = [
-            sample * conditioning_scale for sample in controlnet_single_block_samples
-        ]
-
         #
         controlnet_block_samples = (
             None if len(controlnet_block_samples) == 0 else controlnet_block_samples
@@ -0,0 +1,196 @@
+"""
+Local stand-in for the fal queue API, to run server.py and test FalBackend without a fal account.
+
+    python fake_fal.py --port 5003 --latency 2.0
+    FAL_QUEUE_URL=http://localhost:5003 ASSET_STORE=local python server.py
+
+Every model is accepted. A request is queued, then in progress, then completed `latency` seconds after it was
+submitted, with a fixed image URL as its result; a share `failure_rate` of requests end with the ERROR status instead.
+Both can be set per model through `model_latency` and `model_failure_rate`.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Deep enough for thousands of clients connecting at once
+    request_queue_size = 4096
+
+
+class _Request:
+    def __init__(self, model, arguments, latency, fail):
+        self.model = model
+        self.arguments = arguments
+        self.submitted = time.monotonic()
+        self.latency = latency
+        self.fail = fail
+        self.finished = False
+        self.logs = []
+
+    def status(self):
+        elapsed = time.monotonic() - self.submitted
+        if elapsed < self.latency / 4:
+            return "IN_QUEUE"
+        if elapsed < self.latency:
+            return "IN_PROGRESS"
+        return "ERROR" if self.fail else "COMPLETED"
+
+
+class FakeFal:
+    """
+    The fal queue API served from a background thread: POST /<model> submits, GET <status_url> polls and GET
+    <response_url> fetches the result. Submitted arguments and the most requests of each model active at once (submitted
+    and not finished) are recorded for tests.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.5, failure_rate=0.0,
+                 result_url="https://fal.media/files/fake.png"):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.result_url = result_url
+        # Per-model overrides of latency and failure_rate
+        self.model_latency = {}
+        self.model_failure_rate = {}
+
+        self.submitted = []
+        self.max_active = {}
+        self._active = {}
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-fal", daemon=True)
+        self._thread.start()
+        return self
+
+    def wait(self):
+        """Block until the server is stopped"""
+        self._thread.join()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def submit(self, model, arguments):
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            latency = self.model_latency.get(model, self.latency)
+            fail = random.random() < self.model_failure_rate.get(model, self.failure_rate)
+            self._requests[request_id] = _Request(model, arguments, latency, fail)
+            self.submitted.append((model, arguments))
+            active = self._active[model] = self._active.get(model, 0) + 1
+            self.max_active[model] = max(self.max_active.get(model, 0), active)
+        base = f"{self.url}/{model}/requests/{request_id}"
+        return {"request_id": request_id, "status_url": f"{base}/status", "response_url": base}
+
+    def status(self, request_id):
+        with self._lock:
+            request = self._requests.get(request_id)
+            if request is None:
+                return None
+            status = request.status()
+            if status == "ERROR":
+                self._finish_locked(request)
+            # Like fal, every poll returns the whole log so far
+            message = f"{request.model} {status.lower()}"
+            if not request.logs or request.logs[-1]["message"] != message:
+                request.logs.append({"message": message})
+            payload = {"status": status, "logs": list(request.logs)}
+        if status == "ERROR":
+            payload["error"] = f"{request.model} fake failure"
+        return payload
+
+    def result(self, request_id):
+        with self._lock:
+            request = self._requests.get(request_id)
+            if request is None or request.status() != "COMPLETED":
+                return None
+            self._finish_locked(request)
+        return {"images": [{"url": self.result_url}], "prompt": request.arguments.get("prompt")}
+
+    def _finish_locked(self, request):
+        if not request.finished:
+            request.finished = True
+            self._active[request.model] -= 1
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so that pooled clients reuse their connections
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    arguments = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    return self._send(422, {"detail": "Invalid JSON"})
+                self._send(200, fake.submit(self.path.strip("/"), arguments))
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if "/requests/" not in path:
+                    return self._send(404, {"detail": "Not found"})
+                request_id = path.split("/requests/", 1)[1]
+                if request_id.endswith("/status"):
+                    payload = fake.status(request_id[:-len("/status")])
+                else:
+                    payload = fake.result(request_id)
+                if payload is None:
+                    return self._send(400, {"detail": "Request is not completed"})
+                self._send(200, payload)
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5003)
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds from submission to result")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeFal(args.host, args.port, latency=args.latency, failure_rate=args.failure_rate)
+    print(f"Fake fal queue API listening on {fake.url}")
+    try:
+        fake.start().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import random
+import threading
+
+import httpx
+
+from backends import BackendError
+
+# Queue API root; point it at a local fake endpoint to test without calling fal
+FAL_QUEUE_URL = os.environ.get("FAL_QUEUE_URL", "https://queue.fal.run")
+
+# Maximum number of in-flight remote runs per model
+MODEL_CONCURRENCY = {
+    "fal-ai/ideogram/v3/edit": int(os.environ.get("FAL_IDEOGRAM_CONCURRENCY", "8")),
+    "fal-ai/flux/dev/image-to-image": int(os.environ.get("FAL_FLUX_CONCURRENCY", "16")),
+}
+DEFAULT_CONCURRENCY = int(os.environ.get("FAL_DEFAULT_CONCURRENCY", "4"))
+
+# Maximum number of generations accepted (running or waiting for a slot) per process
+MAX_PENDING = int(os.environ.get("FAL_MAX_PENDING", "4096"))
+
+POLL_INTERVAL = float(os.environ.get("FAL_POLL_INTERVAL", "0.25"))
+REQUEST_TIMEOUT = float(os.environ.get("FAL_TIMEOUT", "600"))
+
+# Queue statuses of requests that ended without a result
+FAILED_STATUSES = {"ERROR", "FAILED", "CANCELLED"}
+
+
+class FalBackendBusy(Exception):
+    """Raised when the backend already holds its maximum number of pending generations"""
+
+
+class FalBackend:
+    """
+    Asynchronous client for the fal queue API.
+
+    All generations run as coroutines on one event loop thread and share a single pooled HTTP session, so a pending
+    generation costs a coroutine and a few small buffers rather than a connection or a thread. Each model has its own
+    concurrency limit; generations over the limit wait for a slot on the loop. The loop thread is started by the first
+    generation, so importing an app does not start it.
+    """
+
+    def __init__(
+        self,
+        queue_url=FAL_QUEUE_URL,
+        key=None,
+        model_concurrency=None,
+        default_concurrency=DEFAULT_CONCURRENCY,
+        max_pending=MAX_PENDING,
+        max_connections=256,
+        poll_interval=POLL_INTERVAL,
+        timeout=REQUEST_TIMEOUT,
+    ):
+        self.queue_url = queue_url.rstrip('/')
+        self.key = key if key is not None else os.environ.get("FAL_KEY")
+        self.model_concurrency = dict(MODEL_CONCURRENCY if model_concurrency is None else model_concurrency)
+        self.default_concurrency = default_concurrency
+        self.max_pending = max_pending
+        self.max_connections = max_connections
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._semaphores = {}
+        self._client = None
+
+        self.loop = None
+        self._thread = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """Number of generations accepted and not finished yet"""
+        return self._pending
+
+    def _ensure_loop(self):
+        with self._loop_lock:
+            if self._thread is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self.loop.run_forever, name="fal-backend", daemon=True)
+                self._thread.start()
+            return self.loop
+
+    def _http(self):
+        # Created lazily so that it is bound to the backend loop
+        if self._client is None:
+            headers = {"Authorization": f"Key {self.key}"} if self.key else {}
+            self._client = httpx.AsyncClient(
+                headers=headers,
+                timeout=httpx.Timeout(60.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    def _semaphore(self, model):
+        if model not in self._semaphores:
+            limit = self.model_concurrency.get(model, self.default_concurrency)
+            self._semaphores[model] = asyncio.Semaphore(limit)
+        return self._semaphores[model]
+
+    async def subscribe_async(self, model, arguments, on_log=None):
+        """Submit a request to the model queue, wait for it to complete and return its result"""
+        async with self._semaphore(model):
+            client = self._http()
+
+            response = await client.post(f"{self.queue_url}/{model}", json=arguments)
+            response.raise_for_status()
+            handle = response.json()
+
+            logs_seen = 0
+            while True:
+                response = await client.get(handle["status_url"], params={"logs": "1"})
+                response.raise_for_status()
+                status = response.json()
+
+                logs = status.get("logs") or []
+                if on_log is not None:
+                    for log in logs[logs_seen:]:
+                        on_log(log["message"])
+                logs_seen = len(logs)
+
+                if status["status"] == "COMPLETED":
+                    break
+                if status["status"] in FAILED_STATUSES or status.get("error"):
+                    error = status.get("error") or "no result"
+                    raise BackendError(f"{model} request ended with status {status['status']}: {error}")
+                await asyncio.sleep(self.poll_interval)
+
+            response = await client.get(handle["response_url"])
+            response.raise_for_status()
+            return response.json()
+
+    def submit(self, model, arguments, on_log=None):
+        """
+        Schedule a generation on the backend loop and return a concurrent future for its result.
+        Raises FalBackendBusy when too many generations are already pending.
+        """
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                raise FalBackendBusy(f"{self._pending} generations already pending")
+            self._pending += 1
+
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.subscribe_async(model, arguments, on_log), self.timeout),
+            self._ensure_loop(),
+        )
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        with self._pending_lock:
+            self._pending -= 1
+
+    def subscribe(self, model, arguments, on_log=None):
+        """Blocking equivalent of fal_client.subscribe for use from request threads"""
+        return self.submit(model, arguments, on_log).result()
+
+    async def asubscribe(self, model, arguments, on_log=None):
+        """Awaitable equivalent of subscribe for coroutines running on another event loop, such as the ASGI server's"""
+        return await asyncio.wrap_future(self.submit(model, arguments, on_log))
+
+    def close(self):
+        """Close the HTTP session and stop the backend loop"""
+        with self._loop_lock:
+            if self._thread is None:
+                return
+            if self._client is not None:
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), self.loop).result()
+                self._client = None
+            self._semaphores = {}
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
+            self._thread = None
+
+
+class StubFalBackend(FalBackend):
+    """
+    FalBackend whose generations sleep for a random service time instead of calling fal, for load tests.
+    Concurrency limits and pending accounting are the real ones; only the remote round trip is replaced.
+    """
+
+    def __init__(
+        self,
+        latency=4.0,
+        jitter=0.2,
+        failure_rate=0.0,
+        result_url="https://fal.media/files/stub.png",
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.result_url = result_url
+
+    async def subscribe_async(self, model, arguments, on_log=None):
+        async with self._semaphore(model):
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter * self.latency)))
+            if random.random() < self.failure_rate:
+                raise RuntimeError(f"{model} stub failure")
+            if on_log is not None:
+                on_log(f"{model} stub completed")
+            return {"images": [{"url": self.result_url}]}
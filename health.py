@@ -0,0 +1,250 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import Gauge
+
+# How often the background prober checks the backend, and how many recent latencies are kept per model
+HEALTH_PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL", "30"))
+LATENCY_WINDOW = int(os.environ.get("HEALTH_LATENCY_WINDOW", "256"))
+
+# Consecutive failures that open a model's circuit, and how long it stays open before a trial call
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+
+PERCENTILES = (50, 95, 99)
+
+circuit_open = Gauge(
+    "circuit_breaker_open",
+    "1 while the circuit breaker of a model is open and calls to it fail fast",
+    labelnames=("model",),
+)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a model whose circuit breaker is open"""
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"{model} is unavailable, retrying in {retry_after:.0f}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated errors from a model.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are rejected for `reset_timeout`
+    seconds. The first call after that is let through as a trial: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, model, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        circuit_open.set(0, model=model)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self._trial_running or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call to the model may go ahead"""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return
+            retry_after = max(self.reset_timeout - (time.monotonic() - self.opened_at), 1.0)
+        raise CircuitOpen(self.model, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+        circuit_open.set(0, model=self.model)
+
+    def release(self):
+        """End a call without judging the model, e.g. when it was rejected before reaching the model"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            reopen = self._trial_running or self.failures >= self.failure_threshold
+            self._trial_running = False
+            if reopen:
+                self.opened_at = time.monotonic()
+        if reopen:
+            circuit_open.set(1, model=self.model)
+
+
+class LatencyWindow:
+    """Latencies of the most recent calls to one model"""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """Nearest-rank percentiles in milliseconds, or None when nothing has been recorded"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        result = {}
+        for p in percentiles:
+            index = min(len(samples) - 1, max(0, int(round(p / 100 * len(samples))) - 1))
+            result[f"p{p}_ms"] = round(samples[index] * 1000, 1)
+        result["count"] = len(samples)
+        return result
+
+
+class HealthMonitor:
+    """
+    Cached backend health for /api-status.
+
+    A daemon thread runs `probe` every `interval` seconds and stores its outcome, so health checks read a cached
+    state instead of calling the backend. `probe` returns a dict of details to report, or raises when the backend is
+    unhealthy. Real calls go through `call(model, fn)`, which feeds the per-model latency windows and circuit breakers;
+    exceptions in `ignored_errors` (e.g. local overload) are re-raised without counting against the model.
+    """
+
+    def __init__(self, probe, interval=HEALTH_PROBE_INTERVAL, probe_model=None, ignored_errors=()):
+        self.probe = probe
+        self.interval = interval
+        self.probe_model = probe_model
+        self.ignored_errors = tuple(ignored_errors)
+
+        self._latencies = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._state = {"status": "unknown", "checked_at": None}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the background prober; safe to call more than once"""
+        with self._lock:
+            if self._thread is not None:
+                return self
+            self._thread = threading.Thread(target=self._run, name="health-prober", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+    def check(self):
+        """Run the probe once and update the cached state"""
+        started = time.monotonic()
+        try:
+            if self.probe_model is not None:
+                details = self.call(self.probe_model, self.probe)
+            else:
+                details = self.probe()
+            state = {"status": "ok", **(details or {})}
+        except CircuitOpen as e:
+            state = {"status": "degraded", "message": str(e)}
+        except Exception as e:
+            state = {"status": "error", "message": str(e)}
+        state["checked_at"] = time.time()
+        state["probe_ms"] = round((time.monotonic() - started) * 1000, 1)
+        with self._lock:
+            self._state = state
+        return state
+
+    def breaker(self, model):
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(model)
+                self._latencies[model] = LatencyWindow()
+            return self._breakers[model]
+
+    def call(self, model, fn):
+        """
+        Call fn() on behalf of model through its circuit breaker, recording its latency.
+        Raises CircuitOpen without calling fn while the breaker is open.
+        """
+        breaker = self.breaker(model)
+        breaker.before_call()
+        started = time.monotonic()
+        try:
+            result = fn()
+        except self.ignored_errors:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        self._latencies[model].add(time.monotonic() - started)
+        breaker.record_success()
+        return result
+
+    async def call_async(self, model, fn):
+        """Coroutine equivalent of call(): fn() returns an awaitable"""
+        breaker = self.breaker(model)
+        breaker.before_call()
+        started = time.monotonic()
+        try:
+            result = await fn()
+        except self.ignored_errors + (asyncio.CancelledError,):
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        self._latencies[model].add(time.monotonic() - started)
+        breaker.record_success()
+        return result
+
+    def snapshot(self):
+        """Cached health state with per-model latency percentiles and breaker states"""
+        with self._lock:
+            state = dict(self._state)
+            models = list(self._breakers)
+
+        state["models"] = {
+            model: {
+                "circuit": self._breakers[model].state,
+                "latency": self._latencies[model].percentiles(),
+            }
+            for model in models
+        }
+        if state["status"] == "ok" and any(m["circuit"] == "open" for m in state["models"].values()):
+            state["status"] = "degraded"
+        return state
+
+    def status_code(self, state):
+        """
+        HTTP status for a snapshot: 503 only when the probe itself fails, since a degraded instance can still serve
+        the models whose circuits are closed
+        """
+        return 503 if state["status"] == "error" else 200
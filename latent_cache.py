@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+# Bounds of the latent checkpoint cache: checkpoints of the least recently used generations are dropped first
+LATENT_CACHE_ENTRIES = int(os.environ.get("LATENT_CACHE_ENTRIES", "32"))
+LATENT_CACHE_MB = int(os.environ.get("LATENT_CACHE_MB", "256"))
+
+latent_cache_lookups = Counter(
+    "latent_checkpoint_lookups_total",
+    "Lookups of the latent checkpoints of a previous generation, by whether they were still cached",
+    labelnames=("result",),
+)
+
+
+class LatentCheckpointCache:
+    """
+    Remembers the intermediate latents of recent generations by request hash, so that a follow-up request can resume
+    one of them from a checkpoint step with a different prompt.
+
+    Each entry holds the checkpoints of one generation (step -> FluxLatentCheckpoint, kept on the CPU) and its layout
+    key, the hash of everything but the prompt that the checkpoints depend on.
+    """
+
+    def __init__(self, max_entries=LATENT_CACHE_ENTRIES, max_bytes=LATENT_CACHE_MB * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        Gauge(
+            "latent_checkpoint_cache_bytes",
+            "Bytes of latents held by the latent checkpoint cache",
+            callback=lambda: self.nbytes,
+        )
+        Gauge(
+            "latent_checkpoint_cache_entries",
+            "Generations whose latent checkpoints are cached",
+            callback=lambda: len(self._cache),
+        )
+
+    def put(self, key, layout_key, checkpoints):
+        """Store the checkpoints of the generation identified by key, evicting the oldest entries over the bounds"""
+        if not checkpoints:
+            return
+        size = sum(checkpoint.nbytes for checkpoint in checkpoints.values())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._cache.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous[2]
+            self._cache[key] = (layout_key, dict(checkpoints), size)
+            self.nbytes += size
+            while len(self._cache) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._cache.popitem(last=False)
+                self.nbytes -= evicted
+
+    def get(self, key):
+        """Return (layout_key, checkpoints) of a generation, or None if it is not cached"""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                latent_cache_lookups.inc(result="miss")
+                return None
+            self._cache.move_to_end(key)
+            latent_cache_lookups.inc(result="hit")
+            return entry[0], entry[1]
+
+    def steps(self, key):
+        """Checkpoint steps cached for a generation, without counting as a lookup"""
+        with self._lock:
+            entry = self._cache.get(key)
+            return sorted(entry[1]) if entry is not None else []
@@ -0,0 +1,361 @@
+"""
+Load test the serving layer of server.py, local.py or router.py with the models replaced by stubs.
+
+The app is started in a subprocess with its fal client and/or FLUX pipeline swapped for stubs of configurable latency,
+so the numbers measure request handling, admission, coalescing and encoding rather than model speed. Virtual users
+drive /generate, /get-predefined-styles and /api-status with realistic payloads in a closed loop, and the latency
+percentiles, throughput and server memory of each scenario are reported as JSON.
+
+    python loadtest.py --app server --scenario all --users 16 --duration 30 --output report.json
+"""
+import argparse
+import base64
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+
+from mask_codec import encode_mask, grayscale_png
+
+# How each app is started: its script, port and the environment that swaps the models for stubs
+APPS = {
+    "server": {
+        "script": "server.py",
+        "port": 5001,
+        "env": {"FAL_BACKEND": "stub", "ASSET_STORE": "local"},
+        "latency_env": "STUB_FAL_LATENCY",
+    },
+    "local": {
+        "script": "local.py",
+        "port": 5002,
+        "env": {"LOCAL_PIPELINE": "stub"},
+        "latency_env": "STUB_LOCAL_LATENCY",
+    },
+    "router": {
+        "script": "router.py",
+        "port": 5000,
+        "env": {"ROUTER_BACKENDS": "stub"},
+        "latency_env": "STUB_FAL_LATENCY",
+    },
+}
+
+# Share of requests of each kind. A page load fetches the styles and the status, then the user generates.
+SCENARIOS = {
+    "generate": {"generate": 1.0},
+    "styles": {"styles": 1.0},
+    "status": {"status": 1.0},
+    "mixed": {"generate": 0.4, "styles": 0.3, "status": 0.3},
+}
+
+DEFAULT_PROMPT = "A modern living room with a grey sofa and oak floors"
+
+
+def make_payload(width, height, image_kb, mask_coverage):
+    """
+    Build an image data URI of about image_kb kilobytes and a compact mask covering mask_coverage of the image.
+    The image is a PNG with a band of noise sized to reach the target, the size of a typical upload.
+    """
+    noise_rows = min(height, max(1, image_kb * 1024 // width))
+    pixels = bytearray(os.urandom(noise_rows * width)) + bytearray(b"\x80" * ((height - noise_rows) * width))
+    image = "data:image/png;base64," + base64.b64encode(grayscale_png(width, height, pixels)).decode('ascii')
+
+    # A centered rectangle, like a piece of furniture painted over
+    side = mask_coverage ** 0.5
+    mask_width, mask_height = int(width * side), int(height * side)
+    left, top = (width - mask_width) // 2, (height - mask_height) // 2
+    mask = bytearray(width * height)
+    for row in range(top, top + mask_height):
+        mask[row * width + left:row * width + left + mask_width] = b"\xff" * mask_width
+    return image, encode_mask(width, height, mask)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def process_tree(pid):
+    """pid and all of its descendants, from /proc (the Flask reloader serves from a child process)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def rss_bytes(pid):
+    """Resident memory of a process tree in bytes, or None where /proc is not available"""
+    total = None
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total = (total or 0) + int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class MemorySampler:
+    """Samples the resident memory of the server process tree in the background"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = rss_bytes(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.pid is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        return False
+
+    def report(self):
+        if not self.samples:
+            return None
+        return {
+            "start_mb": round(self.samples[0] / 2**20, 1),
+            "end_mb": round(self.samples[-1] / 2**20, 1),
+            "peak_mb": round(max(self.samples) / 2**20, 1),
+        }
+
+
+class LoadGenerator:
+    """Closed-loop virtual users: each sends a request, waits for the response, then sends the next"""
+
+    def __init__(self, base_url, image, mask, prompt, style=None, unique_prompts=True, timeout=300.0):
+        self.base_url = base_url.rstrip('/')
+        self.image = image
+        self.mask = mask
+        self.prompt = prompt
+        self.style = style
+        self.unique_prompts = unique_prompts
+        self.timeout = timeout
+        self._counter = itertools.count()
+
+    def request(self, client, operation):
+        """Send one request; returns (status, response bytes)"""
+        if operation == "generate":
+            prompt = self.prompt
+            if self.unique_prompts:
+                # Distinct prompts keep identical requests from being coalesced into one generation
+                prompt = f"{prompt} #{next(self._counter)}"
+            body = {"image": self.image, "mask": self.mask, "prompt": prompt, "style": self.style}
+            response = client.post(f"{self.base_url}/generate", json=body)
+        elif operation == "styles":
+            response = client.get(f"{self.base_url}/get-predefined-styles")
+        elif operation == "status":
+            response = client.get(f"{self.base_url}/api-status")
+        else:
+            raise ValueError(f"Unknown operation: {operation}")
+        return response.status_code, len(response.content)
+
+    def run(self, mix, users, duration, warmup=0.0):
+        """Run the mix of operations with `users` virtual users for `duration` seconds after `warmup`"""
+        operations, weights = zip(*mix.items())
+        results = []
+        results_lock = threading.Lock()
+        started = time.monotonic()
+        measure_from = started + warmup
+        deadline = measure_from + duration
+
+        def user():
+            # Each virtual user is its own client as far as the per-client admission quota is concerned
+            headers = {"X-Client-Id": f"loadtest-{uuid.uuid4().hex[:12]}"}
+            with httpx.Client(headers=headers, timeout=self.timeout) as client:
+                while time.monotonic() < deadline:
+                    operation = random.choices(operations, weights)[0]
+                    sent = time.monotonic()
+                    try:
+                        status, size = self.request(client, operation)
+                    except httpx.HTTPError as e:
+                        status, size = type(e).__name__, 0
+                    received = time.monotonic()
+                    if sent >= measure_from:
+                        with results_lock:
+                            results.append((operation, status, received - sent, size))
+
+        threads = [threading.Thread(target=user, daemon=True) for _ in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - measure_from
+        return results, elapsed
+
+
+def summarize(results, elapsed):
+    """Latency percentiles, status counts and throughput per operation and overall"""
+    def describe(rows):
+        latencies = sorted(latency for _, _, latency, _ in rows)
+        statuses = {}
+        for _, status, _, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        ok = sum(1 for _, status, _, _ in rows if status == 200)
+        return {
+            "requests": len(rows),
+            "ok": ok,
+            "statuses": statuses,
+            "throughput_rps": round(len(rows) / elapsed, 2) if elapsed > 0 else None,
+            "ok_throughput_rps": round(ok / elapsed, 2) if elapsed > 0 else None,
+            "p50_ms": _ms(percentile(latencies, 0.50)),
+            "p95_ms": _ms(percentile(latencies, 0.95)),
+            "p99_ms": _ms(percentile(latencies, 0.99)),
+            "max_ms": _ms(latencies[-1] if latencies else None),
+            "mean_response_bytes": round(sum(size for *_, size in rows) / len(rows)) if rows else None,
+        }
+
+    operations = sorted({operation for operation, *_ in results})
+    return {
+        "overall": describe(results),
+        "operations": {
+            operation: describe([row for row in results if row[0] == operation]) for operation in operations
+        },
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def stop_app(process):
+    """Stop an app started by start_app, including the server process the Flask reloader forked"""
+    for pid in reversed(process_tree(process.pid)):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    process.wait()
+
+
+def start_app(app, latency, extra_env, log_path):
+    """Start an app with stubbed models and wait until it serves requests; returns (process, base URL)"""
+    config = APPS[app]
+    env = dict(os.environ)
+    env.update(config["env"])
+    env[config["latency_env"]] = str(latency)
+    env.setdefault("LOCAL_ASSET_DIR", tempfile.mkdtemp(prefix="loadtest-assets-"))
+    env.update(extra_env)
+
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, config["script"]],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{config['port']}"
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{config['script']} exited with {process.returncode}, see {log_path}")
+        try:
+            if httpx.get(f"{base_url}/get-predefined-styles", timeout=1.0).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    stop_app(process)
+    raise RuntimeError(f"{config['script']} did not start within 60s, see {log_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test an app with its models replaced by stubs")
+    parser.add_argument("--app", choices=sorted(APPS), default="server", help="App to start and load")
+    parser.add_argument("--url", help="Load an app that is already running at this URL instead of starting one")
+    parser.add_argument("--pid", type=int, help="Process whose memory to sample when using --url")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS) + ["all"], default="mixed")
+    parser.add_argument("--users", type=int, default=16, help="Concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before each scenario")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean stub model latency in seconds")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--image-kb", type=int, default=250, help="Approximate size of the uploaded image")
+    parser.add_argument("--mask-coverage", type=float, default=0.15, help="Fraction of the image that is masked")
+    parser.add_argument("--style", help="Predefined style to request instead of a custom prompt")
+    parser.add_argument(
+        "--identical", action="store_true", help="Send identical generations, which the apps coalesce"
+    )
+    parser.add_argument(
+        "--env", action="append", default=[], metavar="NAME=VALUE", help="Extra environment for the app"
+    )
+    parser.add_argument("--log", default="loadtest-server.log", help="Where the started app logs to")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    image, mask = make_payload(args.width, args.height, args.image_kb, args.mask_coverage)
+    scenarios = sorted(SCENARIOS) if args.scenario == "all" else [args.scenario]
+
+    process = None
+    if args.url:
+        base_url, pid = args.url, args.pid
+    else:
+        process, base_url = start_app(args.app, args.latency, extra_env, args.log)
+        pid = process.pid
+
+    report = {
+        "app": args.app if not args.url else args.url,
+        "users": args.users,
+        "duration_s": args.duration,
+        "stub_latency_s": args.latency,
+        "request_bytes": {"image": len(image), "mask": len(json.dumps(mask))},
+        "scenarios": {},
+    }
+    try:
+        generator = LoadGenerator(
+            base_url, image, mask, DEFAULT_PROMPT, style=args.style, unique_prompts=not args.identical
+        )
+        for scenario in scenarios:
+            print(f"Running {scenario} with {args.users} users for {args.duration:.0f}s...", file=sys.stderr)
+            with MemorySampler(pid) as memory:
+                results, elapsed = generator.run(SCENARIOS[scenario], args.users, args.duration, args.warmup)
+            report["scenarios"][scenario] = {**summarize(results, elapsed), "server_memory": memory.report()}
+    finally:
+        if process is not None:
+            stop_app(process)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
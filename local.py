@@ -2,6 +2,11 @@ import torch
 import base64
 import os
 import io
+import random
+import time
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from types import SimpleNamespace
 from pathlib import Path
 from PIL import Image
 from flask import Flask, request, jsonify, render_template
@@ -10,9 +15,18 @@ from diffusers.utils import load_image
 # from diffusers.pipelines import StableDiffusion3ControlNetInpaintingPipeline
 # from diffusers.models.controlnets.controlnet_sd3 import SD3ControlNetModel
 
-from controlnet_flux import FluxControlNetModel
-from transformer_flux import FluxTransformer2DModel
-from pipeline_flux_controlnet_inpaint import FluxControlNetInpaintingPipeline
+from admission import CANCELLATION_POLL_SECONDS, AdmissionController, AdmissionRejected, client_key
+from cancellation import CancellationRegistry, GenerationCancelled, generations_cancelled
+from health import CircuitOpen, HealthMonitor
+from latent_cache import LatentCheckpointCache
+from mask_codec import decode_mask, is_encoded_mask, validate_mask
+from memory_planner import MemoryPlanRejected, MemoryPlanner, component_bytes
+from metrics import SIZE_BUCKETS, Histogram, metrics_response
+from model_loader import format_load_timings, load_inpainting_pipeline
+from singleflight import SingleFlight, request_key
+from staged_executor import Stage, StagedExecutor
+from styles import PREDEFINED_STYLES
+from transformer_flux import FluxChunkedAttnProcessor
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -22,42 +36,140 @@ pipe = None
 controlnet = None
 transformer = None 
 
-# Predefined styles with carefully crafted prompts
-PREDEFINED_STYLES = {
-    "modern": {
-        "name": "Modern",
-        "prompt": "Transform this area into a sleek modern design with clean lines, neutral colors, minimalist furniture, and subtle lighting. Use contemporary materials like glass, metal, and polished surfaces. Maintain a spacious and uncluttered look.",
-    },
-    "scandinavian": {
-        "name": "Scandinavian",
-        "prompt": "Convert this space into a bright Scandinavian style with white walls, light wooden floors, simple functional furniture, and plenty of natural light. Include cozy textiles, muted colors, and touches of greenery for warmth.",
-    },
-    "industrial": {
-        "name": "Industrial",
-        "prompt": "Redesign this area with industrial aesthetics featuring exposed brick walls, metal fixtures, weathered wood, and vintage furniture. Add Edison bulbs, open shelving, and raw materials like concrete and steel to create an urban warehouse feel.",
-    },
-    "mid_century": {
-        "name": "Mid-Century Modern",
-        "prompt": "Transform this space into a mid-century modern design with iconic furniture shapes, warm wood tones, bold geometric patterns, and pops of color. Include tapered legs, functional forms, and retro-inspired decor from the 1950s-60s era.",
-    },
-    "indian": {
-        "name": "Indian Traditional",
-        "prompt": "Redesign this space with rich Indian traditional decor featuring vibrant textiles, intricate patterns, wooden carved furniture, and warm colors like deep reds, oranges, and golds. Add brass accents, decorative pillows, ornate details, archways, and traditional Indian artwork or tapestries.",
-    },
-    "bohemian": {
-        "name": "Bohemian",
-        "prompt": "Transform this area with bohemian style featuring layered textiles, eclectic patterns, mixed furniture, macramé, and plenty of plants. Include global-inspired elements, vibrant colors, natural materials, and artistic touches for a free-spirited atmosphere.",
-    },
-    "luxury": {
-        "name": "Luxury",
-        "prompt": "Redesign this space with opulent luxury featuring plush velvet furniture, crystal chandeliers, marble surfaces, and gold accents. Create a sophisticated palette with rich colors, symmetrical arrangements, and high-end finishes for an elegant, refined ambiance.",
+# Identical concurrent /generate requests share one pipeline run
+generate_flight = SingleFlight("generate")
+
+# Generations stop between denoising steps once every request waiting for them was cancelled (POST /cancel) or once
+# they run past their deadline; INTERRUPT_BETWEEN_BLOCKS=1 also checks between transformer blocks
+cancellations = CancellationRegistry()
+INTERRUPT_BETWEEN_BLOCKS = os.environ.get("INTERRUPT_BETWEEN_BLOCKS", "0") == "1"
+
+# STAGED_EXECUTION=1 splits each generation into text/VAE encode, denoise, VAE decode and PNG encode stages with their
+# own workers, CUDA streams and bounded queues (STAGED_QUEUE_SIZE jobs), so the transformer denoises one request while
+# the next is encoded and the previous decoded. Several requests are then admitted at once, one per GPU stage.
+STAGED_EXECUTION = os.environ.get("STAGED_EXECUTION", "0") == "1"
+STAGED_QUEUE_SIZE = int(os.environ.get("STAGED_QUEUE_SIZE", "1"))
+staged_executor = None
+
+# The GPU runs LOCAL_CONCURRENCY generations at a time; a bounded queue waits in front of it and requests expected to
+# wait longer than ADMISSION_SLO_SECONDS are turned away with Retry-After
+admission = AdmissionController(
+    "local",
+    concurrency=int(os.environ.get("LOCAL_CONCURRENCY", "3" if STAGED_EXECUTION else "1")),
+    max_queue=int(os.environ.get("LOCAL_MAX_QUEUE", "8")),
+    expected_duration=float(os.environ.get("LOCAL_EXPECTED_LATENCY", "30")),
+)
+
+def probe_model():
+    """Health probe: report the model state without loading it"""
+    details = {
+        "device": "cuda" if torch.cuda.is_available() else "cpu",
+        "model_loaded": pipe is not None,
+        "admission": admission.stats(),
+        "cancellation": cancellations.stats(),
     }
-}
+    if staged_executor is not None:
+        details["stages"] = staged_executor.stats()
+    if torch.cuda.is_available():
+        free, total = torch.cuda.mem_get_info()
+        details["gpu_memory_free_mb"] = free // (1024 * 1024)
+        details["gpu_memory_total_mb"] = total // (1024 * 1024)
+    return details
+
+# /api-status reads the state cached by a background prober, it never triggers a model load
+health = HealthMonitor(probe_model, ignored_errors=(GenerationCancelled,))
+
+# Set to 1 to time every stage of each pipeline run and export the distributions on /metrics. Off by default: the GPU
+# is synchronized around every stage, which costs the overlap between them
+PIPELINE_STAGE_TIMINGS = os.environ.get("PIPELINE_STAGE_TIMINGS", "0") == "1"
+
+pipeline_stage_seconds = Histogram(
+    "pipeline_stage_seconds",
+    "Duration of each pipeline stage; denoising stages are observed once per step",
+    labelnames=("stage",),
+)
+codec_seconds = Histogram(
+    "codec_seconds",
+    "Time spent decoding request images and masks and encoding results",
+    labelnames=("operation",),
+)
+payload_bytes = Histogram(
+    "payload_bytes",
+    "Size of request and response bodies",
+    labelnames=("endpoint", "direction"),
+    buckets=SIZE_BUCKETS,
+)
+
+# Attention implementation: "default" or "chunked" (memory-capped, for CPU-only nodes)
+ATTENTION_PROCESSOR = os.environ.get("FLUX_ATTENTION_PROCESSOR", "default")
+ATTENTION_MAX_MEMORY_MB = int(os.environ.get("FLUX_ATTENTION_MAX_MEMORY_MB", "256"))
+ATTENTION_HEAD_CHUNK_SIZE = int(os.environ.get("FLUX_ATTENTION_HEAD_CHUNK_SIZE", "0")) or None
+
+# Bucket the browser downscales uploads to before sending them: the pipeline runs at exactly this size
+UPLOAD_TARGET = {"width": 1280, "height": 768, "resize": "exact", "format": "image/webp", "quality": 0.92}
+
+# Requests are run at the largest resolution that fits in GPU memory, or rejected before anything is loaded.
+# MEMORY_CALIBRATION is the output of `python memory_planner.py`; rough defaults are used without it.
+MEMORY_CALIBRATION = os.environ.get("MEMORY_CALIBRATION", "memory_calibration.json")
+if os.path.isfile(MEMORY_CALIBRATION):
+    memory_planner = MemoryPlanner.load(MEMORY_CALIBRATION)
+else:
+    memory_planner = MemoryPlanner()
+
+# The latents of every generation are saved after these denoising steps, so that a follow-up request with a tweaked
+# prompt can resume from one of them and only run the remaining steps (empty to disable)
+LATENT_CHECKPOINT_STEPS = [
+    int(step) for step in os.environ.get("LATENT_CHECKPOINT_STEPS", "7,14").split(",") if step.strip()
+]
+latent_cache = LatentCheckpointCache()
+
+# Coarse-to-fine denoising: "scale:steps" phases run before the full resolution, e.g. "0.5:8" runs the first 8 of the
+# 28 steps at half the width and height (empty to run every step at full resolution)
+PROGRESSIVE_RESOLUTION = [
+    (float(phase.split(":")[0]), int(phase.split(":")[1]))
+    for phase in os.environ.get("PROGRESSIVE_RESOLUTION", "").split(",") if phase.strip()
+]
+
+# LOCAL_PIPELINE=stub replaces the FLUX pipeline with a sleep of STUB_LOCAL_LATENCY seconds (load tests)
+LOCAL_PIPELINE = os.environ.get("LOCAL_PIPELINE", "flux")
+
+class StubPipeline:
+    """Stand-in for the FLUX pipeline that sleeps for a random service time and returns the control image"""
+
+    def __init__(self, latency, jitter=0.2):
+        self.latency = latency
+        self.jitter = jitter
+        self.stage_timings = {}
+        self.latent_checkpoints = {}
+
+    def __call__(self, control_image=None, height=None, width=None, **kwargs):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter * self.latency)))
+        return SimpleNamespace(images=[control_image.convert("RGB").resize((width, height))])
+
+def start_staged_executor(device):
+    """Run generations through per-stage workers, so that consecutive requests overlap on the GPU"""
+    global staged_executor
+    staged_executor = StagedExecutor(
+        "generate",
+        [
+            Stage("encode", encode_stage),
+            Stage("denoise", denoise_stage),
+            Stage("decode", decode_stage),
+            Stage("encode_result", encode_result_stage, workers=2, use_stream=False),
+        ],
+        queue_size=STAGED_QUEUE_SIZE,
+        device=device,
+    )
+    staged_executor.start()
+    print(f"Running generations in stages: {', '.join(stage.name for stage in staged_executor.stages)}")
 
 def load_model():
     """Load the SD3 model with ControlNet for inpainting"""
     global pipe, controlnet, transformer
     
+    if pipe is None and LOCAL_PIPELINE == "stub":
+        pipe = StubPipeline(float(os.environ.get("STUB_LOCAL_LATENCY", "2.0")))
+        print(f"Using a stub pipeline with {pipe.latency}s latency")
     if pipe is None:
         print("Loading SD3 ControlNet model...")
         try:
@@ -65,24 +177,23 @@ def load_model():
             # Most modern NVIDIA GPUs support float16 well
             precision_format = torch.bfloat16
             
-            controlnet = FluxControlNetModel.from_pretrained(
-                "alimama-creative/FLUX.1-dev-Controlnet-Inpainting-Alpha", 
-                torch_dtype=precision_format
-            )
-            transformer = FluxTransformer2DModel.from_pretrained(
-                "black-forest-labs/FLUX.1-dev", 
-                subfolder='transformer', 
-                torch_dtype=precision_format
-            )
-            pipe = FluxControlNetInpaintingPipeline.from_pretrained(
-                "black-forest-labs/FLUX.1-dev",
-                controlnet=controlnet,
-                transformer=transformer,
-                torch_dtype=precision_format
-            )
-            # Move models to correct device
             device = "cuda" if torch.cuda.is_available() else "cpu"
-            pipe.to(device)
+            pipe, load_timings = load_inpainting_pipeline(device=device, dtype=precision_format)
+            controlnet = pipe.controlnet
+            transformer = pipe.transformer
+            memory_planner.component_bytes = component_bytes(pipe)
+            if STAGED_EXECUTION:
+                start_staged_executor(device)
+            print(f"Loaded components in {load_timings['total']:.1f}s ({format_load_timings(load_timings)})")
+
+            if ATTENTION_PROCESSOR == "chunked":
+                processor = FluxChunkedAttnProcessor(
+                    max_memory_bytes=ATTENTION_MAX_MEMORY_MB * 1024 * 1024,
+                    head_chunk_size=ATTENTION_HEAD_CHUNK_SIZE,
+                )
+                pipe.transformer.set_attn_processor(processor)
+                pipe.controlnet.set_attn_processor(processor)
+                print(f"Using chunked attention capped at {ATTENTION_MAX_MEMORY_MB} MB per chunk")
             print(f"Model loaded successfully on {device}")
         except Exception as e:
             print(f"Error loading model: {str(e)}")
@@ -98,17 +209,137 @@ def decode_base64_to_image(base64_string):
     image_data = base64.b64decode(base64_string)
     return Image.open(io.BytesIO(image_data))
 
+def decode_mask_to_tensor(payload, width, height):
+    """Convert a compact mask payload straight to a (1, 1, height, width) float tensor, 1.0 where masked"""
+    mask_width, mask_height, pixels = decode_mask(payload)
+    mask = torch.frombuffer(pixels, dtype=torch.uint8).view(1, 1, mask_height, mask_width)
+    mask = mask.float().div_(255)
+    if (mask_width, mask_height) != (width, height):
+        mask = torch.nn.functional.interpolate(mask, size=(height, width), mode="nearest")
+    return mask
+
 def encode_image_to_base64(image):
     """Convert PIL Image to base64 string"""
     buffered = io.BytesIO()
     image.save(buffered, format="PNG")
     return f"data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
 
+def encode_result(image):
+    """Resize a result to the size the frontend expects and encode it as a data URI"""
+    # Downscaled runs are returned at the size the frontend expects
+    target_size = (UPLOAD_TARGET["width"], UPLOAD_TARGET["height"])
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS)
+    
+    # Convert result to base64
+    with codec_seconds.time(operation="encode_result"):
+        return encode_image_to_base64(image)
+
+def pipeline_arguments(job):
+    """Pipeline arguments of a generation job, other than its prompt"""
+    generation_args = job["generation_args"]
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Checkpoints are only taken at full resolution, after the coarse phases
+    first_checkpoint = max(
+        job["resume_from"].step + 1 if job["resume_from"] is not None else 0,
+        sum(steps for _, steps in generation_args["progressive_resolution"]),
+    )
+    return dict(
+        negative_prompt='',
+        height=job["height"],
+        width=job["width"],
+        control_image=job["control_image"],
+        control_mask=job["control_mask"],
+        num_inference_steps=generation_args["num_inference_steps"],
+        generator=torch.Generator(device=device).manual_seed(generation_args["seed"]),
+        controlnet_conditioning_scale=generation_args["controlnet_conditioning_scale"],
+        guidance_scale=generation_args["guidance_scale"],
+        true_guidance_scale=generation_args["true_guidance_scale"],
+        record_stage_timings=PIPELINE_STAGE_TIMINGS,
+        checkpoint_steps=[step for step in LATENT_CHECKPOINT_STEPS if step >= first_checkpoint],
+        resume_from=job["resume_from"],
+        progressive_resolution=generation_args["progressive_resolution"],
+        should_interrupt=lambda: job["cancellation"].cancelled,
+        interrupt_between_blocks=INTERRUPT_BETWEEN_BLOCKS,
+    )
+
+def finish_pipeline_run(job):
+    """Cache the latent checkpoints of the run that just returned and export its stage timings"""
+    latent_cache.put(job["key"], job["layout_key"], {**job["inherited_checkpoints"], **pipe.latent_checkpoints})
+    for stage, durations in pipe.stage_timings.items():
+        for duration in durations:
+            pipeline_stage_seconds.observe(duration, stage=stage)
+
+def encode_stage(job):
+    """Staged execution: encode the prompt with CLIP and T5 and the control image with the VAE"""
+    job["cancellation"].raise_if_cancelled()
+    do_classifier_free_guidance = job["generation_args"]["true_guidance_scale"] > 1.0
+    (
+        job["prompt_embeds"],
+        job["pooled_prompt_embeds"],
+        job["negative_prompt_embeds"],
+        job["negative_pooled_prompt_embeds"],
+        _,
+    ) = pipe.encode_prompt(
+        prompt=job["prompt"],
+        prompt_2=None,
+        device=pipe._execution_device,
+        do_classifier_free_guidance=do_classifier_free_guidance,
+        negative_prompt='',
+    )
+    job["control_latents"], _, _ = pipe.prepare_image_with_mask(
+        image=job["control_image"],
+        mask=job["control_mask"],
+        width=job["width"],
+        height=job["height"],
+        batch_size=1,
+        num_images_per_prompt=1,
+        device=pipe._execution_device,
+        dtype=pipe.transformer.dtype,
+        do_classifier_free_guidance=do_classifier_free_guidance,
+    )
+    return job
+
+def denoise_stage(job):
+    """Staged execution: run the denoising loop from the encoded inputs, up to the latents"""
+    job["latents"] = pipe(
+        prompt_embeds=job.pop("prompt_embeds"),
+        pooled_prompt_embeds=job.pop("pooled_prompt_embeds"),
+        negative_prompt_embeds=job.pop("negative_prompt_embeds"),
+        negative_pooled_prompt_embeds=job.pop("negative_pooled_prompt_embeds"),
+        control_latents=job.pop("control_latents"),
+        output_type="latent",
+        **pipeline_arguments(job),
+    ).images
+    job["cancellation"].raise_if_cancelled()
+    finish_pipeline_run(job)
+    return job
+
+def decode_stage(job):
+    """Staged execution: decode the latents with the VAE"""
+    job["cancellation"].raise_if_cancelled()
+    job["image"] = pipe.decode_latents(job.pop("latents"), job["height"], job["width"])[0]
+    return job
+
+def encode_result_stage(job):
+    """Staged execution: resize and PNG-encode the result"""
+    return encode_result(job["image"])
+
 @app.route('/')
 def index():
     """Render the main application page"""
     return render_template('index.html')
 
+@app.after_request
+def observe_payload_sizes(response):
+    """Record the body sizes of generation requests and responses"""
+    if request.endpoint == 'generate_design':
+        if request.content_length is not None:
+            payload_bytes.observe(request.content_length, endpoint=request.endpoint, direction="request")
+        if response.content_length is not None:
+            payload_bytes.observe(response.content_length, endpoint=request.endpoint, direction="response")
+    return response
+
 @app.route('/get-predefined-styles', methods=['GET'])
 def get_predefined_styles():
     """Return the list of predefined styles for the frontend"""
@@ -120,15 +351,34 @@ def get_predefined_styles():
         })
     return jsonify(styles_list)
 
+@app.route('/upload-config')
+def get_upload_config():
+    """Return the size and encoding the frontend should prepare uploads with, and that it may cancel generations"""
+    return jsonify({**UPLOAD_TARGET, "cancellation": True})
+
+@app.route('/metrics')
+def metrics():
+    """Expose serving metrics in the Prometheus text format"""
+    return metrics_response()
+
 @app.route('/api-status')
 def check_api_status():
-    """Check if the model is available"""
-    try:
-        # Just check if we can load the model
-        load_model()
-        return jsonify({"status": "ok", "device": "cuda" if torch.cuda.is_available() else "cpu"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+    """Report the cached model state, latency percentiles and circuit state"""
+    health.start()
+    state = health.snapshot()
+    return jsonify(state), health.status_code(state)
+
+@app.route('/cancel', methods=['POST'])
+def cancel_generation():
+    """Cancel a generation by the request_id it was submitted with (sent by app.js when the page is closed)"""
+    data = request.get_json(force=True, silent=True) or {}
+    request_id = data.get('request_id')
+    if not request_id:
+        return jsonify({'error': 'Missing request_id'}), 400
+    cancelled = cancellations.cancel(str(request_id)[:64])
+    if cancelled:
+        print(f"Cancelled request {request_id}")
+    return jsonify({'cancelled': cancelled})
 
 @app.route('/generate', methods=['POST'])
 def generate_design():
@@ -146,6 +396,59 @@ def generate_design():
             return jsonify({'error': 'Missing image data'}), 400
         if not mask_data:
             return jsonify({'error': 'Missing mask data'}), 400
+        error = validate_mask(mask_data)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        generation_args = dict(
+            num_inference_steps=28,
+            seed=24,
+            controlnet_conditioning_scale=0.9,
+            guidance_scale=3.5,
+            true_guidance_scale=1.0,
+            progressive_resolution=PROGRESSIVE_RESOLUTION,
+        )
+        
+        # Pick the largest resolution that fits in GPU memory, or fail fast instead of running out of memory later.
+        # The plan leaves room for the other generations admitted at the same time (one per stage when staged).
+        try:
+            memory_plan = memory_planner.plan(
+                UPLOAD_TARGET["height"],
+                UPLOAD_TARGET["width"],
+                do_classifier_free_guidance=generation_args["true_guidance_scale"] > 1.0,
+                budget=memory_planner.budget(),
+                concurrent_runs=admission.concurrency,
+                staged=STAGED_EXECUTION,
+            )
+        except MemoryPlanRejected as e:
+            print(f"Rejecting request: {str(e)}")
+            return jsonify({'error': f"Image is too large for the available GPU memory: {str(e)}"}), 413
+        width, height = memory_plan["width"], memory_plan["height"]
+        if (width, height) != (UPLOAD_TARGET["width"], UPLOAD_TARGET["height"]):
+            print(f"Running at {width}x{height} to fit in GPU memory")
+        generation_args.update(height=height, width=width)
+        
+        # Checkpoints depend on everything but the prompt, a follow-up may only resume one of the same layout
+        layout_key = request_key(image_data, mask_data, "flux-controlnet-inpainting", None, generation_args)
+        resume = data.get('resume')
+        resume_from = None
+        inherited_checkpoints = {}
+        if resume:
+            if not isinstance(resume, dict):
+                return jsonify({'error': 'resume must be an object with checkpoint_id and step'}), 400
+            entry = latent_cache.get(resume.get('checkpoint_id'))
+            if entry is None:
+                return jsonify({'error': 'Checkpoint not found, it may have been evicted'}), 404
+            checkpoint_layout, checkpoints = entry
+            if checkpoint_layout != layout_key:
+                return jsonify({'error': 'Checkpoint was saved for a different image, mask or settings'}), 409
+            resume_from = checkpoints.get(resume.get('step'))
+            if resume_from is None:
+                error = f"No checkpoint at step {resume.get('step')}, saved steps: {sorted(checkpoints)}"
+                return jsonify({'error': error}), 400
+            # The resumed run shares the earlier steps, so its own follow-ups can resume from them too
+            inherited_checkpoints = {step: c for step, c in checkpoints.items() if step <= resume_from.step}
+            print(f"Resuming checkpoint {resume['checkpoint_id'][:12]} from step {resume_from.step}")
         
         # Load model
         pipe = load_model()
@@ -158,48 +461,112 @@ def generate_design():
         
         # Convert base64 to PIL images
         try:
-            control_image = decode_base64_to_image(image_data)
-            control_mask = decode_base64_to_image(mask_data)
-            
-            # Resize images to rectangular format
-            width, height = 1280, 768  # Default rectangular size (16:9 aspect ratio)
-            control_image = control_image.resize((width, height))
-            control_mask = control_mask.resize((width, height))
+            with codec_seconds.time(operation="decode_image"):
+                control_image = decode_base64_to_image(image_data)
+                
+                # Resize images to rectangular format; uploads prepared by the frontend already have this size
+                if control_image.size != (width, height):
+                    control_image = control_image.resize((width, height))
+            with codec_seconds.time(operation="decode_mask"):
+                if is_encoded_mask(mask_data):
+                    # Compact masks skip PIL and the pipeline's mask preprocessing
+                    control_mask = decode_mask_to_tensor(mask_data, width, height)
+                else:
+                    control_mask = decode_base64_to_image(mask_data)
+                    if control_mask.size != (width, height):
+                        control_mask = control_mask.resize((width, height))
         except Exception as e:
             print(f"Error processing images: {str(e)}")
             return jsonify({'error': f"Error processing images: {str(e)}"}), 400
         
-        # Generate image
-        print(f"Generating with prompt: {final_prompt}")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        def run_generation():
+            # Generate image
+            print(f"Generating with prompt: {final_prompt}")
+            if staged_executor is not None:
+                future = staged_executor.submit(job)
+                while True:
+                    try:
+                        return future.result(timeout=CANCELLATION_POLL_SECONDS)
+                    except FutureTimeoutError:
+                        # Give the slot back right away, the stages drop the job when they reach it
+                        job["cancellation"].raise_if_cancelled()
+            result_images = pipe(prompt=final_prompt, **pipeline_arguments(job)).images
+            job["cancellation"].raise_if_cancelled()
+            result_image = result_images[0]
+            finish_pipeline_run(job)
+            return encode_result(result_image)
+        
+        def admitted_generation():
+            # Wait for the GPU, or be turned away if the wait would be too long
+            with admission.admit(client, cancellation=job["cancellation"]):
+                return health.call("flux-controlnet-inpainting", run_generation)
+        
+        client = client_key(request)
+        key_args = generation_args
+        if resume_from is not None:
+            key_args = dict(generation_args, resume=[resume['checkpoint_id'], resume_from.step])
+        key = request_key(image_data, mask_data, "flux-controlnet-inpainting", final_prompt, key_args)
+        job = dict(
+            prompt=final_prompt,
+            control_image=control_image,
+            control_mask=control_mask,
+            height=height,
+            width=width,
+            generation_args=generation_args,
+            resume_from=resume_from,
+            inherited_checkpoints=inherited_checkpoints,
+            key=key,
+            layout_key=layout_key,
+        )
+        
+        # The frontend tags each generation with a request id it can cancel it by; requests sharing a generation share
+        # its cancellation token
+        request_id = str(data.get('request_id') or uuid.uuid4().hex)[:64]
         try:
-            generator = torch.Generator(device=device).manual_seed(24)
-            result_image = pipe(
-                negative_prompt='',
-                prompt=final_prompt,
-                height=height,
-                width=width,
-                control_image=control_image,
-                control_mask=control_mask,
-                num_inference_steps=28,
-                generator=generator,
-                controlnet_conditioning_scale=0.9,
-                guidance_scale=3.5,
-                true_guidance_scale=1.0 
-            ).images[0]
-            
-      
-            
-            # Convert result to base64
-            result_base64 = encode_image_to_base64(result_image)
+            timeout = float(data['timeout']) if data.get('timeout') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'timeout must be a number of seconds'}), 400
+        job["cancellation"] = cancellations.attach(key, request_id, timeout)
+        # Runs are shared by token rather than by key alone: a cancelled generation can still be winding down when an
+        # identical request arrives, and that request gets a fresh token and a run of its own instead of the 499
+        flight_key = (key, id(job["cancellation"]))
+        try:
+            result_base64, shared = generate_flight.do(flight_key, admitted_generation)
+            if shared:
+                print("Shared the result of an identical in-flight generation")
             
             # Return the generated image
             print("Successfully generated image")
-            return jsonify({'result_url': result_base64})
+            # The id and steps a follow-up request can resume this generation from
+            return jsonify({
+                'result_url': result_base64,
+                'checkpoint_id': key,
+                'checkpoint_steps': latent_cache.steps(key),
+            })
         
+        except AdmissionRejected as e:
+            print(f"Not admitted: {str(e)}")
+            response = jsonify({
+                'error': 'Too many generations in progress',
+                'details': str(e),
+                'retry_after': e.retry_after
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, e.status
+        except CircuitOpen as e:
+            print(f"Failing fast: {str(e)}")
+            response = jsonify({'error': f"Model is temporarily unavailable: {str(e)}"})
+            response.headers['Retry-After'] = str(int(e.retry_after))
+            return response, 503
+        except GenerationCancelled as e:
+            print(f"Stopped generation: {str(e)}")
+            generations_cancelled.inc(reason=e.reason)
+            return jsonify({'error': str(e)}), e.status
         except Exception as e:
             print(f"Error generating image: {str(e)}")
             return jsonify({'error': f"Error generating image: {str(e)}"}), 500
+        finally:
+            cancellations.detach(request_id)
             
     except Exception as e:
         print(f"Error in generate_design: {e}")
@@ -213,6 +580,7 @@ if __name__ == '__main__':
     os.makedirs('static/js', exist_ok=True)
     os.makedirs('templates', exist_ok=True)
     
+    health.start()
     print("Starting SD3 ControlNet Interior Design API...")
     print("Open your browser and navigate to http://localhost:5002")
     
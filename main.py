@@ -1,8 +1,8 @@
+import os
 import torch
 from diffusers.utils import load_image, check_min_version
-from controlnet_flux import FluxControlNetModel
-from transformer_flux import FluxTransformer2DModel
-from pipeline_flux_controlnet_inpaint import FluxControlNetInpaintingPipeline
+from block_profiler import BlockProfiler
+from model_loader import format_load_timings, load_inpainting_pipeline
 
 check_min_version("0.30.2")
 
@@ -11,19 +11,9 @@ image_path='https://huggingface.co/alimama-creative/FLUX.1-dev-Controlnet-Inpain
 mask_path='https://huggingface.co/alimama-creative/FLUX.1-dev-Controlnet-Inpainting-Alpha/resolve/main/images/bucket_mask.jpeg',
 prompt='a person wearing a white shoe, carrying a white bucket with text "FLUX" on it'
 
-# Build pipeline
-controlnet = FluxControlNetModel.from_pretrained("alimama-creative/FLUX.1-dev-Controlnet-Inpainting-Alpha", torch_dtype=torch.bfloat16)
-transformer = FluxTransformer2DModel.from_pretrained(
-        "black-forest-labs/FLUX.1-dev", subfolder='transformer', torch_dtype=torch.bfloat16
-    )
-pipe = FluxControlNetInpaintingPipeline.from_pretrained(
-    "black-forest-labs/FLUX.1-dev",
-    controlnet=controlnet,
-    transformer=transformer,
-    torch_dtype=torch.bfloat16
-).to("cuda")
-pipe.transformer.to(torch.bfloat16)
-pipe.controlnet.to(torch.bfloat16)
+# Build pipeline: components are loaded concurrently, directly in bf16 on the GPU
+pipe, load_timings = load_inpainting_pipeline(device="cuda", dtype=torch.bfloat16)
+print(f"Pipeline loaded in {load_timings['total']:.1f}s ({format_load_timings(load_timings)})")
 
 # Load image and mask
 size = (768, 768)
@@ -31,6 +21,13 @@ image = load_image(image_path).convert("RGB").resize(size)
 mask = load_image(mask_path).convert("RGB").resize(size)
 generator = torch.Generator(device="cuda").manual_seed(24)
 
+# Set PROFILE_BLOCKS=trace.json to profile every transformer and controlnet block of the run
+profile_path = os.environ.get("PROFILE_BLOCKS")
+profiler = BlockProfiler()
+if profile_path:
+    profiler.attach(pipe.transformer, "transformer")
+    profiler.attach(pipe.controlnet, "controlnet")
+
 # Inpaint
 result = pipe(
     prompt=prompt,
@@ -46,5 +43,10 @@ result = pipe(
     true_guidance_scale=1.0 # default: 3.5 for alpha and 1.0 for beta
 ).images[0]
 
+if profile_path:
+    profiler.detach()
+    profiler.export_chrome_trace(profile_path)
+    print(profiler.summary(limit=20))
+
 result.save('flux_inpaint.png')
 print("Successfully inpaint image")
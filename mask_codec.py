@@ -0,0 +1,141 @@
+import base64
+import struct
+import zlib
+
+# Compact wire format for binary inpainting masks, produced by static/js/mask-codec.js:
+#
+#     {"encoding": "rle-v1", "width": W, "height": H, "data": "<base64>"}
+#
+# `data` holds the run lengths of the row-major mask as unsigned LEB128 varints, alternating between unmasked and
+# masked runs and starting with an unmasked run (which may be empty). A typical mask is a few hundred bytes.
+RLE_ENCODING = "rle-v1"
+
+# Upper bound on decoded masks, to reject payloads that would expand to absurd sizes
+MAX_MASK_PIXELS = 8192 * 8192
+
+
+def is_encoded_mask(value):
+    """Return True if value is a compact mask payload rather than an image data URI or URL"""
+    return isinstance(value, dict) and "encoding" in value
+
+
+def decode_runs(payload):
+    """Validate a compact mask payload and return (width, height, runs)"""
+    if payload.get("encoding") != RLE_ENCODING:
+        raise ValueError(f"Unsupported mask encoding: {payload.get('encoding')!r}")
+
+    width, height = payload.get("width"), payload.get("height")
+    # bool is an int subclass, but true/false are not mask sizes
+    if any(not isinstance(size, int) or isinstance(size, bool) or size <= 0 for size in (width, height)):
+        raise ValueError("Mask width and height must be positive integers")
+    if width * height > MAX_MASK_PIXELS:
+        raise ValueError(f"Mask of {width}x{height} is too large")
+
+    data = base64.b64decode(payload.get("data") or "", validate=True)
+    runs = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift > 63:
+                raise ValueError("Malformed mask run length")
+        else:
+            runs.append(value)
+            value = shift = 0
+    if shift:
+        raise ValueError("Truncated mask run length")
+
+    if sum(runs) != width * height:
+        raise ValueError(f"Mask runs cover {sum(runs)} pixels, expected {width * height}")
+    return width, height, runs
+
+
+def validate_mask(mask_data):
+    """
+    Return an error message if mask_data is neither absent, an image data URI or URL nor a well-formed compact mask,
+    None otherwise
+    """
+    if mask_data is None or isinstance(mask_data, str):
+        return None
+    if not isinstance(mask_data, dict):
+        return "Invalid mask: expected an image data URI or an encoded mask"
+    try:
+        decode_runs(mask_data)
+    except (ValueError, TypeError) as e:
+        return f"Invalid mask: {str(e)}"
+    return None
+
+
+def decode_mask(payload):
+    """
+    Decode a compact mask payload into (width, height, pixels).
+    pixels is a row-major bytearray with one byte per pixel, 255 where masked and 0 elsewhere.
+    """
+    width, height, runs = decode_runs(payload)
+    pixels = bytearray(width * height)
+    position = 0
+    for index, run in enumerate(runs):
+        if index % 2:
+            pixels[position:position + run] = b"\xff" * run
+        position += run
+    return width, height, pixels
+
+
+def encode_mask(width, height, pixels):
+    """Encode a row-major mask, non-zero where masked, as a compact mask payload (encodeMaskRLE in mask-codec.js)"""
+    if len(pixels) != width * height:
+        raise ValueError(f"Mask has {len(pixels)} pixels, expected {width * height}")
+
+    data = bytearray()
+    masked = False
+    run = 0
+    for pixel in pixels:
+        if bool(pixel) != masked:
+            data += _varint(run)
+            masked = not masked
+            run = 0
+        run += 1
+    data += _varint(run)
+
+    return {
+        "encoding": RLE_ENCODING,
+        "width": width,
+        "height": height,
+        "data": base64.b64encode(bytes(data)).decode('ascii'),
+    }
+
+
+def _varint(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return encoded
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def mask_png(payload):
+    """Encode a compact mask payload as an 8-bit grayscale PNG, for backends that only accept image URLs"""
+    width, height, pixels = decode_mask(payload)
+    return grayscale_png(width, height, pixels)
+
+
+def grayscale_png(width, height, pixels):
+    """Encode row-major 8-bit grayscale pixels as a PNG"""
+    # Each PNG scanline is prefixed with its filter type, 0 (none)
+    scanlines = bytearray()
+    for row in range(height):
+        scanlines.append(0)
+        scanlines += pixels[row * width:(row + 1) * width]
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(bytes(scanlines), 6)),
+        _png_chunk(b"IEND", b""),
+    ])
@@ -0,0 +1,400 @@
+import argparse
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from diffusers.utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# Phases whose peak memory is planned, and the pipeline stages (see `record_stage_timings`) each one is measured from
+PHASE_STAGES = {
+    "vae_encode": ("prepare_image_with_mask",),
+    "denoise": ("controlnet", "transformer", "scheduler_step"),
+    "vae_decode": ("vae_decode",),
+}
+
+# Weights of FLUX.1-dev with the inpainting controlnet in bfloat16, used until the planner sees the loaded pipeline
+DEFAULT_COMPONENT_BYTES = {
+    "transformer": 23_800_000_000,
+    "controlnet": 4_300_000_000,
+    "text_encoder_2": 9_520_000_000,
+    "text_encoder": 250_000_000,
+    "vae": 170_000_000,
+}
+
+# Components resident during each phase: all of them without offloading, only the ones in use with model offloading
+PHASE_COMPONENTS = {
+    "vae_encode": ("vae",),
+    "denoise": ("transformer", "controlnet"),
+    "vae_decode": ("vae",),
+}
+
+# Rough bfloat16 activation costs until a calibration is loaded: bytes per pixel for the VAE and bytes per token and per
+# squared token for the denoising step (zero with fused attention, which does not materialize the attention matrix)
+DEFAULT_COEFFICIENTS = {
+    "vae_encode": [1500.0, 256 * 2**20],
+    "denoise": [100_000.0, 0.0, 512 * 2**20],
+    "vae_decode": [5000.0, 256 * 2**20],
+}
+
+# Fraction of the device memory kept free for the allocator's fragmentation and other processes
+MEMORY_HEADROOM = float(os.environ.get("MEMORY_HEADROOM", "0.1"))
+
+OFFLOAD_MODES = ("none", "model", "sequential")
+
+
+class MemoryPlanRejected(Exception):
+    """Raised when no resolution or batch size of a request fits in memory"""
+
+    def __init__(self, message, estimate):
+        super().__init__(message)
+        self.estimate = estimate
+
+
+def phase_features(
+    phase: str, height: int, width: int, batch_size: int, do_classifier_free_guidance: bool, text_length: int
+) -> List[float]:
+    """
+    Features the activation memory of `phase` is linear in: the number of pixels for the VAE, the number of tokens
+    and its square for the denoising step, always followed by a constant.
+    """
+    if phase in ("vae_encode", "vae_decode"):
+        return [float(batch_size * height * width), 1.0]
+    if phase == "denoise":
+        effective_batch = batch_size * (2 if do_classifier_free_guidance else 1)
+        tokens = (height // 16) * (width // 16) + text_length
+        return [float(effective_batch * tokens), float(effective_batch * tokens * tokens), 1.0]
+    raise ValueError(f"Unknown phase {phase!r}")
+
+
+def component_bytes(pipe) -> Dict[str, int]:
+    """Size of the weights and buffers of each model component of a loaded pipeline."""
+    sizes = {}
+    for name in DEFAULT_COMPONENT_BYTES:
+        module = getattr(pipe, name, None)
+        if module is None:
+            continue
+        tensors = list(module.parameters()) + list(module.buffers())
+        sizes[name] = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return sizes
+
+
+def downscale_buckets(width: int, height: int, min_side: int = 512, step: float = 0.875) -> List[Tuple[int, int]]:
+    """
+    Resolutions to fall back to for a `width` x `height` request, largest first: the requested size, then the same
+    aspect ratio shrunk by `step` at a time down to a shortest side of `min_side`, in multiples of 16 pixels.
+    """
+    buckets = [(width, height)]
+    scale = 1.0
+    while True:
+        scale *= step
+        bucket = (int(width * scale) // 16 * 16, int(height * scale) // 16 * 16)
+        if min(bucket) < min_side:
+            break
+        if bucket != buckets[-1]:
+            buckets.append(bucket)
+    return buckets
+
+
+class MemoryPlanner:
+    r"""
+    Predicts the peak device memory of a pipeline run and picks the largest configuration that fits.
+
+    The peak of each phase (VAE encode, denoising, VAE decode) is the weights resident during the phase plus its
+    activations. Resident weights follow the offload mode: every component without offloading, the components in use
+    with model CPU offloading, none with sequential offloading (one layer at a time, folded into the constant term).
+    Activations are linear in [`phase_features`]; the coefficients start from rough defaults and are fitted to
+    measured runs by [`~MemoryPlanner.calibrate`]. Runs sharing the device are accounted for in the peak, see
+    [`~MemoryPlanner.estimate`].
+
+    Args:
+        component_bytes (`Dict[str, int]`, *optional*):
+            Weight size of each component, see [`component_bytes`]. Defaults to FLUX.1-dev in bfloat16.
+        coefficients (`Dict[str, List[float]]`, *optional*):
+            Activation coefficients of each phase, in the order of [`phase_features`].
+        offload (`str`, defaults to `"none"`):
+            One of `"none"`, `"model"` or `"sequential"`.
+        headroom (`float`, defaults to `MEMORY_HEADROOM`):
+            Fraction of the budget kept free.
+    """
+
+    def __init__(
+        self,
+        component_bytes: Optional[Dict[str, int]] = None,
+        coefficients: Optional[Dict[str, List[float]]] = None,
+        offload: str = "none",
+        headroom: float = MEMORY_HEADROOM,
+    ):
+        if offload not in OFFLOAD_MODES:
+            raise ValueError(f"offload must be one of {OFFLOAD_MODES}, got {offload!r}")
+        self.component_bytes = dict(DEFAULT_COMPONENT_BYTES if component_bytes is None else component_bytes)
+        self.coefficients = {
+            phase: list(values) for phase, values in (coefficients or DEFAULT_COEFFICIENTS).items()
+        }
+        self.offload = offload
+        self.headroom = headroom
+
+    def resident_bytes(self, *phases: str) -> int:
+        """Bytes of the weights resident while any of `phases` runs"""
+        if self.offload == "sequential":
+            return 0
+        if self.offload == "model":
+            names = {name for phase in phases for name in PHASE_COMPONENTS[phase]}
+            return sum(self.component_bytes.get(name, 0) for name in names)
+        return sum(self.component_bytes.values())
+
+    def estimate(
+        self,
+        height: int,
+        width: int,
+        batch_size: int = 1,
+        do_classifier_free_guidance: bool = False,
+        text_length: int = 512,
+        concurrent_runs: int = 1,
+        staged: bool = False,
+    ) -> Dict[str, int]:
+        """
+        Predicted peak bytes of each phase and of the whole run (`"peak"`).
+
+        The phases are those of a run alone on the device. The peak accounts for the runs sharing it, assumed to be of
+        the same size: with `staged` execution one run is in each phase at a time, so the peak is the weights plus the
+        activations of every phase together; otherwise each of `concurrent_runs` runs may be in its largest phase.
+        """
+        estimate, activations = {}, {}
+        for phase, coefficients in self.coefficients.items():
+            features = phase_features(phase, height, width, batch_size, do_classifier_free_guidance, text_length)
+            activations[phase] = max(0.0, sum(c * f for c, f in zip(coefficients, features)))
+            estimate[phase] = int(self.resident_bytes(phase) + activations[phase])
+        if staged:
+            estimate["peak"] = int(self.resident_bytes(*activations) + sum(activations.values()))
+        elif concurrent_runs > 1:
+            estimate["peak"] = int(self.resident_bytes(*activations) + concurrent_runs * max(activations.values()))
+        else:
+            estimate["peak"] = max(estimate.values())
+        return estimate
+
+    def budget(self, device: Optional[torch.device] = None) -> Optional[int]:
+        """Bytes this process can use on a CUDA device, minus the headroom; `None` when there is no CUDA device."""
+        if not torch.cuda.is_available():
+            return None
+        free, _ = torch.cuda.mem_get_info(device)
+        # memory held by this process' caching allocator is reusable by the run
+        usable = free + torch.cuda.memory_reserved(device)
+        return int(usable * (1 - self.headroom))
+
+    def plan(
+        self,
+        height: int,
+        width: int,
+        batch_size: int = 1,
+        do_classifier_free_guidance: bool = False,
+        text_length: int = 512,
+        budget: Optional[int] = None,
+        buckets: Optional[Sequence[Tuple[int, int]]] = None,
+        concurrent_runs: int = 1,
+        staged: bool = False,
+    ) -> Dict:
+        """
+        Return the largest `{"width", "height", "batch_size", "estimate"}` whose peak fits in `budget` bytes.
+
+        The requested resolution is kept if some batch size fits, the batch being reduced first; otherwise the
+        resolution steps down through `buckets` (by default [`downscale_buckets`]) with a batch of one. Raises
+        [`MemoryPlanRejected`] when not even the smallest bucket fits. Without a budget the request is returned as is.
+        `concurrent_runs` and `staged` describe the other runs sharing the device, as in [`~MemoryPlanner.estimate`].
+        """
+        sharing = dict(concurrent_runs=concurrent_runs, staged=staged)
+        if budget is None:
+            estimate = self.estimate(height, width, batch_size, do_classifier_free_guidance, text_length, **sharing)
+            return {"width": width, "height": height, "batch_size": batch_size, "estimate": estimate}
+
+        if buckets is None:
+            buckets = downscale_buckets(width, height)
+        for index, (bucket_width, bucket_height) in enumerate(buckets):
+            batch_sizes = range(batch_size, 0, -1) if index == 0 else (1,)
+            for candidate in batch_sizes:
+                estimate = self.estimate(
+                    bucket_height, bucket_width, candidate, do_classifier_free_guidance, text_length, **sharing
+                )
+                if estimate["peak"] <= budget:
+                    return {
+                        "width": bucket_width,
+                        "height": bucket_height,
+                        "batch_size": candidate,
+                        "estimate": estimate,
+                    }
+
+        smallest = buckets[-1]
+        estimate = self.estimate(smallest[1], smallest[0], 1, do_classifier_free_guidance, text_length, **sharing)
+        raise MemoryPlanRejected(
+            f"{width}x{height} needs {estimate['peak'] / 2**30:.1f} GiB even at {smallest[0]}x{smallest[1]}, "
+            f"only {budget / 2**30:.1f} GiB available",
+            estimate,
+        )
+
+    def calibrate(self, measurements: List[Dict]):
+        """
+        Fit the activation coefficients to measured runs.
+
+        Each measurement holds the run configuration (`height`, `width`, `batch_size`, `do_classifier_free_guidance`,
+        `text_length`), the memory allocated before the run (`baseline`) and the peak of each phase (`peaks`), as
+        recorded by [`measure_run`]. The weights resident before the run are part of the baseline; with model
+        offloading the weights loaded for a phase are subtracted from its peak instead.
+        """
+        for phase in PHASE_STAGES:
+            rows, targets = [], []
+            for measurement in measurements:
+                if phase not in measurement["peaks"]:
+                    continue
+                rows.append(phase_features(
+                    phase,
+                    measurement["height"],
+                    measurement["width"],
+                    measurement["batch_size"],
+                    measurement["do_classifier_free_guidance"],
+                    measurement["text_length"],
+                ))
+                activations = measurement["peaks"][phase] - measurement["baseline"]
+                if self.offload == "model":
+                    activations -= self.resident_bytes(phase)
+                targets.append(activations)
+            if len(rows) < len(self.coefficients[phase]):
+                logger.warning(f"Not enough measurements to calibrate {phase}, keeping its coefficients.")
+                continue
+            rows = np.array(rows)
+            # the features span many orders of magnitude, solve on columns scaled to at most 1
+            scale = np.abs(rows).max(axis=0)
+            scale[scale == 0] = 1.0
+            solution, *_ = np.linalg.lstsq(rows / scale, np.array(targets, dtype=np.float64), rcond=None)
+            # negative costs are fitting noise, and would let the planner accept sizes that do not fit
+            self.coefficients[phase] = [max(0.0, float(value)) for value in solution / scale]
+        return self
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"offload": self.offload, "coefficients": self.coefficients}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str, component_bytes: Optional[Dict[str, int]] = None, **kwargs) -> "MemoryPlanner":
+        with open(path) as f:
+            calibration = json.load(f)
+        kwargs.setdefault("offload", calibration.get("offload", "none"))
+        return cls(component_bytes, coefficients=calibration["coefficients"], **kwargs)
+
+
+def measure_run(
+    pipe,
+    height: int,
+    width: int,
+    batch_size: int = 1,
+    true_guidance_scale: float = 1.0,
+    text_length: int = 512,
+    num_inference_steps: int = 2,
+) -> Dict:
+    """Run the pipeline once on a blank image and record the peak memory of each phase, for calibration."""
+    from PIL import Image
+
+    device = pipe._execution_device
+    torch.cuda.empty_cache()
+    # Calibration runs alone on the device, so the peaks of every stage can be reset rather than only read: a stage
+    # under the high-water mark of an earlier run, or of the denoising of this one, would otherwise look free
+    torch.cuda.reset_peak_memory_stats(device)
+    baseline = torch.cuda.memory_allocated(device)
+    image = Image.new("RGB", (width, height), (128, 128, 128))
+    mask = Image.new("RGB", (width, height), (255, 255, 255))
+    pipe(
+        prompt="calibration",
+        negative_prompt="",
+        height=height,
+        width=width,
+        control_image=image,
+        control_mask=mask,
+        num_inference_steps=num_inference_steps,
+        num_images_per_prompt=batch_size,
+        true_guidance_scale=true_guidance_scale,
+        max_sequence_length=text_length,
+        output_type="np",
+        record_stage_timings=True,
+        reset_stage_peak_memory=True,
+    )
+    # Stage peaks are relative to the memory allocated when each stage started; the tensors carried between stages
+    # are small next to the activations, so the run's baseline stands in for it
+    stage_peaks = pipe.stage_peak_memory
+    peaks = {
+        phase: baseline + max(stage_peaks[stage] for stage in stages if stage in stage_peaks)
+        for phase, stages in PHASE_STAGES.items()
+        if any(stage in stage_peaks for stage in stages)
+    }
+    return {
+        "height": height,
+        "width": width,
+        "batch_size": batch_size,
+        "do_classifier_free_guidance": true_guidance_scale > 1.0,
+        "text_length": text_length,
+        "baseline": baseline,
+        "peaks": peaks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the memory planner against measured pipeline runs")
+    parser.add_argument("--output", default="memory_calibration.json")
+    parser.add_argument("--sizes", default="512x512,768x768,1024x1024,1280x768,1024x1536", help="WIDTHxHEIGHT list")
+    parser.add_argument("--batch-sizes", default="1,2")
+    parser.add_argument("--offload", choices=OFFLOAD_MODES, default="none")
+    args = parser.parse_args()
+
+    from model_loader import load_inpainting_pipeline
+
+    pipe, _ = load_inpainting_pipeline(device="cuda", dtype=torch.bfloat16)
+    if args.offload == "model":
+        pipe.enable_model_cpu_offload()
+    elif args.offload == "sequential":
+        pipe.enable_sequential_cpu_offload()
+    planner = MemoryPlanner(component_bytes(pipe), offload=args.offload)
+
+    measurements = []
+    for size in args.sizes.split(","):
+        width, height = (int(value) for value in size.split("x"))
+        for batch_size in (int(value) for value in args.batch_sizes.split(",")):
+            for true_guidance_scale in (1.0, 3.5):
+                try:
+                    measurement = measure_run(pipe, height, width, batch_size, true_guidance_scale)
+                except torch.cuda.OutOfMemoryError:
+                    print(f"{width}x{height} batch {batch_size} cfg {true_guidance_scale > 1.0}: out of memory")
+                    continue
+                measurements.append(measurement)
+                predicted = planner.estimate(height, width, batch_size, true_guidance_scale > 1.0)
+                print(
+                    f"{width}x{height} batch {batch_size} cfg {true_guidance_scale > 1.0}: "
+                    f"measured {max(measurement['peaks'].values()) / 2**30:.2f} GiB, "
+                    f"default estimate {predicted['peak'] / 2**30:.2f} GiB"
+                )
+
+    planner.calibrate(measurements)
+    planner.save(args.output)
+    with open(os.path.splitext(args.output)[0] + ".measurements.json", "w") as f:
+        json.dump(measurements, f, indent=2)
+
+    errors = []
+    for measurement in measurements:
+        predicted = planner.estimate(
+            measurement["height"],
+            measurement["width"],
+            measurement["batch_size"],
+            measurement["do_classifier_free_guidance"],
+            measurement["text_length"],
+        )["peak"]
+        measured = max(measurement["peaks"].values())
+        errors.append(abs(predicted - measured) / measured)
+    if errors:
+        print(f"Calibrated on {len(measurements)} runs, mean error {100 * sum(errors) / len(errors):.1f}%")
+    print(f"Saved calibration to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from huggingface_hub import snapshot_download
+from safetensors import safe_open
+from transformers import (
+    CLIPTextModel,
+    CLIPTokenizer,
+    T5EncoderModel,
+    T5TokenizerFast,
+)
+
+from diffusers.models.autoencoders import AutoencoderKL
+from diffusers.schedulers import FlowMatchEulerDiscreteScheduler
+from diffusers.utils import logging
+
+from controlnet_flux import FluxControlNetModel
+from transformer_flux import FluxTransformer2DModel
+from pipeline_flux_controlnet_inpaint import FluxControlNetInpaintingPipeline
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+BASE_MODEL = "black-forest-labs/FLUX.1-dev"
+CONTROLNET_MODEL = "alimama-creative/FLUX.1-dev-Controlnet-Inpainting-Alpha"
+
+SAFETENSORS_WEIGHTS_NAME = "diffusion_pytorch_model.safetensors"
+SAFETENSORS_WEIGHTS_INDEX_NAME = "diffusion_pytorch_model.safetensors.index.json"
+
+
+def _safetensors_shards(model_dir: str):
+    index_file = os.path.join(model_dir, SAFETENSORS_WEIGHTS_INDEX_NAME)
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, shard) for shard in sorted(set(weight_map.values()))]
+
+    weights_file = os.path.join(model_dir, SAFETENSORS_WEIGHTS_NAME)
+    if not os.path.isfile(weights_file):
+        raise FileNotFoundError(f"No safetensors weights found in {model_dir}")
+    return [weights_file]
+
+
+def load_diffusers_model(
+    model_cls,
+    model_dir: str,
+    device: Union[str, torch.device],
+    dtype: torch.dtype,
+):
+    """
+    Build a diffusers model from the safetensors shards in `model_dir` without materializing it on the CPU first.
+
+    The model is created with empty (meta) weights and every tensor is read from the memory-mapped shards straight
+    onto `device`, then cast to `dtype` there.
+    """
+    device = torch.device(device)
+    config = model_cls.load_config(model_dir)
+    with init_empty_weights():
+        model = model_cls.from_config(config)
+
+    expected = set(model.state_dict().keys())
+    loaded = set()
+    for shard in _safetensors_shards(model_dir):
+        with safe_open(shard, framework="pt", device=str(device)) as f:
+            for name in f.keys():
+                if name not in expected:
+                    logger.warning(f"Unexpected weight {name} in {shard} is ignored.")
+                    continue
+                set_module_tensor_to_device(
+                    model, name, device, value=f.get_tensor(name), dtype=dtype
+                )
+                loaded.add(name)
+
+    missing = expected - loaded
+    if missing:
+        raise ValueError(
+            f"Missing weights for {model_cls.__name__} in {model_dir}: {sorted(missing)[:10]}"
+        )
+
+    model.register_to_config(_name_or_path=model_dir)
+    return model.eval()
+
+
+def _load_transformers_model(
+    model_cls,
+    model_dir: str,
+    device: Union[str, torch.device],
+    dtype: torch.dtype,
+):
+    # transformers memory-maps safetensors itself and places the weights on `device_map` as it reads them
+    return model_cls.from_pretrained(
+        model_dir,
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True,
+        device_map={"": torch.device(device)},
+    ).eval()
+
+
+def load_inpainting_pipeline(
+    base_model: str = BASE_MODEL,
+    controlnet_model: str = CONTROLNET_MODEL,
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: torch.dtype = torch.bfloat16,
+    max_workers: Optional[int] = None,
+) -> Tuple[FluxControlNetInpaintingPipeline, Dict[str, float]]:
+    """
+    Load the FLUX ControlNet inpainting pipeline with its components loaded concurrently.
+
+    Each component is downloaded (or found in the Hugging Face cache) and loaded in its own worker thread, directly
+    in `dtype` on `device`.
+
+    Returns:
+        The pipeline, and the wall time in seconds each component took to load.
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+    def timed(name, load):
+        def run():
+            start = time.perf_counter()
+            component = load()
+            return component, time.perf_counter() - start
+
+        return name, run
+
+    def subfolder(repo_id, name):
+        return os.path.join(
+            snapshot_download(repo_id, allow_patterns=[f"{name}/*"]), name
+        )
+
+    jobs = [
+        timed(
+            "transformer",
+            lambda: load_diffusers_model(
+                FluxTransformer2DModel, subfolder(base_model, "transformer"), device, dtype
+            ),
+        ),
+        timed(
+            "controlnet",
+            lambda: load_diffusers_model(
+                FluxControlNetModel,
+                snapshot_download(controlnet_model, allow_patterns=["*.json", "*.safetensors"]),
+                device,
+                dtype,
+            ),
+        ),
+        timed(
+            "vae",
+            lambda: load_diffusers_model(AutoencoderKL, subfolder(base_model, "vae"), device, dtype),
+        ),
+        timed(
+            "text_encoder",
+            lambda: _load_transformers_model(
+                CLIPTextModel, subfolder(base_model, "text_encoder"), device, dtype
+            ),
+        ),
+        timed(
+            "text_encoder_2",
+            lambda: _load_transformers_model(
+                T5EncoderModel, subfolder(base_model, "text_encoder_2"), device, dtype
+            ),
+        ),
+        timed("tokenizer", lambda: CLIPTokenizer.from_pretrained(subfolder(base_model, "tokenizer"))),
+        timed("tokenizer_2", lambda: T5TokenizerFast.from_pretrained(subfolder(base_model, "tokenizer_2"))),
+        timed(
+            "scheduler",
+            lambda: FlowMatchEulerDiscreteScheduler.from_pretrained(subfolder(base_model, "scheduler")),
+        ),
+    ]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as executor:
+        futures = {name: executor.submit(run) for name, run in jobs}
+        results = {name: future.result() for name, future in futures.items()}
+
+    components = {name: component for name, (component, _) in results.items()}
+    timings = {name: elapsed for name, (_, elapsed) in results.items()}
+
+    pipe = FluxControlNetInpaintingPipeline(**components)
+    timings["total"] = time.perf_counter() - start
+
+    return pipe, timings
+
+
+def format_load_timings(timings: Dict[str, float]) -> str:
+    """Render the per-component load times returned by `load_inpainting_pipeline`."""
+    return ", ".join(f"{name}: {elapsed:.1f}s" for name, elapsed in timings.items())
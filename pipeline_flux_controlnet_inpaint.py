@@ -1,5 +1,10 @@
 import inspect
-from typing import Any, Callable, Dict, List, Optional, Union
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -27,7 +32,7 @@ from diffusers.utils.torch_utils import randn_tensor
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from diffusers.pipelines.flux.pipeline_output import FluxPipelineOutput
 
-from transformer_flux import FluxTransformer2DModel
+from transformer_flux import FluxSparseTokenCache, FluxTransformer2DModel
 from controlnet_flux import FluxControlNetModel
 
 if is_torch_xla_available():
@@ -149,6 +154,197 @@ def retrieve_timesteps(
     return timesteps, num_inference_steps
 
 
+class FluxDenoisingStepContext:
+    r"""
+    Buffers reused by every step of a single denoising run.
+
+    The classifier-free guidance input batch, the scaled timestep and the guidance tensor are allocated once per
+    request and refreshed in place at each step, so the loop itself does not allocate on top of what the models and
+    the scheduler need.
+
+    Args:
+        latents (`torch.Tensor`):
+            The packed latents of the run, used to size the buffers.
+        do_classifier_free_guidance (`bool`):
+            Whether the model input is the latents duplicated for the unconditional and conditional branches.
+        guidance_scale (`float`, *optional*):
+            Value of the embedded guidance. `None` when the transformer has no guidance embedding.
+        residual_dtype (`torch.dtype`, *optional*):
+            Dtype the controlnet residuals have to be in before they are added by the transformer.
+        track_allocations (`bool`, defaults to `False`):
+            Record the number of allocator calls made during each step in `step_allocations`. Only available on
+            CUDA devices.
+    """
+
+    def __init__(
+        self,
+        latents: torch.Tensor,
+        do_classifier_free_guidance: bool,
+        guidance_scale: Optional[float] = None,
+        residual_dtype: Optional[torch.dtype] = None,
+        track_allocations: bool = False,
+    ):
+        self.do_classifier_free_guidance = do_classifier_free_guidance
+        self.guidance_scale = guidance_scale
+        self.residual_dtype = residual_dtype
+        self.device = latents.device
+        self.resize(latents)
+
+        if track_allocations and latents.device.type != "cuda":
+            logger.warning("Per-step allocation tracking is only available on CUDA devices and will be skipped.")
+            track_allocations = False
+        self.track_allocations = track_allocations
+        self.step_allocations = []
+        self._allocations_at_step_start = 0
+
+    def resize(self, latents: torch.Tensor):
+        """Allocate the buffers for latents of a new shape, e.g. when the resolution changes during the run."""
+        batch_size = latents.shape[0] * 2 if self.do_classifier_free_guidance else latents.shape[0]
+        self.latent_model_input = (
+            torch.empty((batch_size, *latents.shape[1:]), device=latents.device, dtype=latents.dtype)
+            if self.do_classifier_free_guidance
+            else None
+        )
+        self.timestep = torch.empty(batch_size, device=latents.device, dtype=latents.dtype)
+        self.guidance = (
+            torch.full((batch_size,), self.guidance_scale, device=latents.device, dtype=torch.float32)
+            if self.guidance_scale is not None
+            else None
+        )
+
+    def prepare(self, latents: torch.Tensor, t: torch.Tensor):
+        """Refresh the buffers for timestep `t` and return `(latent_model_input, timestep, guidance)`."""
+        if self.do_classifier_free_guidance:
+            half = latents.shape[0]
+            self.latent_model_input[:half].copy_(latents)
+            self.latent_model_input[half:].copy_(latents)
+            latent_model_input = self.latent_model_input
+        else:
+            latent_model_input = latents
+
+        # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transformer model (we should not
+        # keep it but I want to keep the inputs same for the model for testing)
+        self.timestep.fill_(t)
+        self.timestep.div_(1000)
+
+        return latent_model_input, self.timestep, self.guidance
+
+    def cast_residuals(self, samples):
+        """Cast controlnet residuals to `residual_dtype`, reusing them as-is when they already match."""
+        if samples is None or self.residual_dtype is None or samples[0].dtype == self.residual_dtype:
+            return samples
+        return [sample.to(dtype=self.residual_dtype) for sample in samples]
+
+    def begin_step(self):
+        if self.track_allocations:
+            self._allocations_at_step_start = torch.cuda.memory_stats(self.device)["allocation.all.allocated"]
+
+    def end_step(self):
+        if self.track_allocations:
+            allocated = torch.cuda.memory_stats(self.device)["allocation.all.allocated"]
+            self.step_allocations.append(allocated - self._allocations_at_step_start)
+
+
+class FluxStageTimer:
+    r"""
+    Wall-clock timings of the stages of a single pipeline run.
+
+    Kernels are launched asynchronously on accelerators, so when the run is on a CUDA or MPS device its stream is
+    synchronized at both ends of every timed stage. That makes the timings attributable to the stage that issued the
+    work, at the cost of the overlap between stages, which is why timing is opt-in. Disabled timers do nothing.
+
+    On CUDA the peak memory allocated during each stage, above what was allocated when it started, is recorded as well
+    in `peak_memory`. The device-wide peak statistics are only read, never reset, so concurrent runs and profilers do
+    not disturb each other. The peak of a stage is therefore exact when it raised the device's high-water mark; a stage
+    that stayed under an earlier peak is credited with the memory it still held at its end. A run alone on the device,
+    such as a calibration run, can pass `reset_peaks` to make every stage peak exact instead.
+
+    Args:
+        device (`torch.device`):
+            The execution device of the run.
+        enabled (`bool`, defaults to `False`):
+            Whether to record timings at all.
+        reset_peaks (`bool`, defaults to `False`):
+            Whether to reset the device-wide peak statistics at the start of every stage. This corrupts the peaks
+            measured by any other run or profiler on the device at the same time.
+    """
+
+    def __init__(self, device: torch.device, enabled: bool = False, reset_peaks: bool = False):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.reset_peaks = reset_peaks
+        self.timings = {}
+        self.peak_memory = {}
+
+    def synchronize(self):
+        # only the stream of the run, so that work other threads issue on other streams keeps overlapping
+        if self.device.type == "cuda":
+            torch.cuda.current_stream(self.device).synchronize()
+        elif self.device.type == "mps":
+            torch.mps.synchronize()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the with block and append the duration in seconds to `timings[name]`."""
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        if self.device.type == "cuda":
+            if self.reset_peaks:
+                torch.cuda.reset_peak_memory_stats(self.device)
+            baseline = torch.cuda.memory_allocated(self.device)
+            peak_before = torch.cuda.max_memory_allocated(self.device)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.timings.setdefault(name, []).append(time.perf_counter() - started)
+            if self.device.type == "cuda":
+                peak = torch.cuda.max_memory_allocated(self.device)
+                if peak <= peak_before and not self.reset_peaks:
+                    peak = max(baseline, torch.cuda.memory_allocated(self.device))
+                self.peak_memory[name] = max(peak - baseline, self.peak_memory.get(name, 0))
+
+
+class _FluxBlockInterrupt(Exception):
+    """Raised by the block hooks of `interrupt_between_blocks` to leave the denoising loop mid-step."""
+
+
+@dataclass
+class FluxLatentCheckpoint:
+    r"""
+    The packed latents of a run after its first `step` denoising steps.
+
+    Passed back to the pipeline as `resume_from`, the run continues from `step` instead of from pure noise. The
+    latents after the first steps mostly fix the layout of the image, so a run resumed with a slightly different
+    prompt keeps that layout and only pays for the remaining steps.
+
+    Args:
+        step (`int`):
+            Number of denoising steps the latents have been through.
+        num_inference_steps (`int`):
+            Number of denoising steps of the run. A resumed run must use the same schedule.
+        height (`int`):
+            Height in pixels of the run.
+        width (`int`):
+            Width in pixels of the run.
+        latents (`torch.Tensor`):
+            The packed latents, kept on the CPU.
+    """
+
+    step: int
+    num_inference_steps: int
+    height: int
+    width: int
+    latents: torch.Tensor
+
+    @property
+    def nbytes(self):
+        return self.latents.numel() * self.latents.element_size()
+
+
 class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
     r"""
     The Flux pipeline for text-to-image generation.
@@ -345,6 +541,8 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
         pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
         max_sequence_length: int = 512,
         lora_scale: Optional[float] = None,
+        negative_prompt_embeds: Optional[torch.FloatTensor] = None,
+        negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
     ):
         r"""
 
@@ -371,6 +569,11 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
             pooled_prompt_embeds (`torch.FloatTensor`, *optional*):
                 Pre-generated pooled text embeddings. Can be used to easily tweak text inputs, *e.g.* prompt weighting.
                 If not provided, pooled text embeddings will be generated from `prompt` input argument.
+            negative_prompt_embeds (`torch.FloatTensor`, *optional*):
+                Pre-generated negative text embeddings, used with `negative_pooled_prompt_embeds` instead of encoding
+                `negative_prompt`.
+            negative_pooled_prompt_embeds (`torch.FloatTensor`, *optional*):
+                Pre-generated negative pooled text embeddings.
             clip_skip (`int`, *optional*):
                 Number of layers to be skipped from CLIP while computing the prompt embeddings. A value of 1 means that
                 the output of the pre-final layer will be used for computing the prompt embeddings.
@@ -413,7 +616,7 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
                 device=device,
             )
 
-        if do_classifier_free_guidance:
+        if do_classifier_free_guidance and negative_prompt_embeds is None:
             # 处理 negative prompt
             negative_prompt = negative_prompt or ""
             negative_prompt_2 = negative_prompt_2 or negative_prompt
@@ -429,7 +632,7 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
                 max_sequence_length=max_sequence_length,
                 device=device,
             )
-        else:
+        elif not do_classifier_free_guidance:
             negative_pooled_prompt_embeds = None
             negative_prompt_embeds = None            
 
@@ -703,6 +906,187 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
 
         return packed_control_image, height, width
 
+    def prepare_sparse_token_mask(
+        self,
+        mask,
+        width,
+        height,
+        dilation,
+        device,
+    ):
+        r"""
+        Compute the image tokens touched by the inpainting mask, for masked-token sparse denoising.
+
+        Args:
+            mask (`PipelineImageInput`):
+                The inpainting mask, white where the image is modified.
+            width (`int`), height (`int`):
+                The size of the generated image.
+            dilation (`int`):
+                Number of tokens the masked area is grown by in every direction, so that the tokens around the edit
+                keep being computed.
+            device (`torch.device`):
+                The device of the returned mask.
+
+        Returns:
+            `torch.BoolTensor` of shape `(image_seq_len,)`, in the order of the packed latents.
+        """
+        if not isinstance(mask, torch.Tensor):
+            mask = self.mask_processor.preprocess(mask, height=height, width=width)
+        mask = (mask.to(device=device) > 0.5).float()
+
+        # one packed token covers `vae_scale_factor` x `vae_scale_factor` pixels
+        token_mask = torch.nn.functional.max_pool2d(mask, kernel_size=self.vae_scale_factor)
+        if dilation > 0:
+            token_mask = torch.nn.functional.max_pool2d(
+                token_mask, kernel_size=2 * dilation + 1, stride=1, padding=dilation
+            )
+        # tokens are shared across the batch, so keep the union of the masks
+        return token_mask.amax(dim=(0, 1)).flatten() > 0
+
+    @contextmanager
+    def _interruptible_blocks(self, should_interrupt):
+        # Polls should_interrupt before every block of the transformer and the controlnet, and ends the with block
+        # (the denoising loop) from the middle of a step once it returns True; the yielded state records whether it did.
+        # The models are shared by concurrent runs, so the hooks only act in the thread that registered them.
+        state = SimpleNamespace(interrupted=False)
+        handles = []
+        if should_interrupt is not None:
+            owner = threading.get_ident()
+
+            def check(module, args):
+                if threading.get_ident() == owner and should_interrupt():
+                    raise _FluxBlockInterrupt()
+
+            for model in (self.transformer, self.controlnet):
+                for blocks in (model.transformer_blocks, model.single_transformer_blocks):
+                    handles.extend(block.register_forward_pre_hook(check) for block in blocks)
+        try:
+            yield state
+        except _FluxBlockInterrupt:
+            state.interrupted = True
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def decode_latents(self, latents, height, width, output_type="pil", timer=None):
+        r"""
+        Decode the packed latents of a run into images.
+
+        Args:
+            latents (`torch.Tensor`):
+                The packed latents, e.g. returned by the pipeline with `output_type="latent"`.
+            height (`int`), width (`int`):
+                The size in pixels of the run.
+            output_type (`str`, *optional*, defaults to `"pil"`):
+                The output format of the images, `"pil"`, `"np"` or `"pt"`.
+            timer ([`FluxStageTimer`], *optional*):
+                Timer the `vae_decode` and `postprocess` stages are recorded by.
+        """
+        timer = timer or FluxStageTimer(latents.device)
+        latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
+        latents = (latents / self.vae.config.scaling_factor) + self.vae.config.shift_factor
+        latents = latents.to(self.vae.dtype)
+
+        with timer.stage("vae_decode"):
+            image = self.vae.decode(latents, return_dict=False)[0]
+        with timer.stage("postprocess"):
+            return self.image_processor.postprocess(image, output_type=output_type)
+
+    def prepare_resolution_phases(self, progressive_resolution, height, width, num_inference_steps):
+        r"""
+        Resolve a coarse-to-fine schedule into the resolution phases of a run.
+
+        Args:
+            progressive_resolution (`List[Tuple[float, int]]`, *optional*):
+                `(scale, steps)` pairs of the reduced resolution phases, in order.
+            height (`int`), width (`int`):
+                The size of the generated image.
+            num_inference_steps (`int`):
+                The number of denoising steps of the run.
+
+        Returns:
+            `List[Tuple[int, int, int]]`: `(end_step, height, width)` of every phase, the last one being the full
+            resolution up to `num_inference_steps`. Reduced sizes are rounded down to whole packed tokens.
+        """
+        phases = []
+        end_step = 0
+        for scale, steps in progressive_resolution or ():
+            if not 0 < scale < 1 or steps < 1:
+                raise ValueError(
+                    f"Progressive resolution phases need a scale between 0 and 1 and at least one step, got {scale}"
+                    f" for {steps} steps."
+                )
+            end_step += steps
+            phases.append(
+                (
+                    end_step,
+                    max(int(height * scale) // self.vae_scale_factor, 1) * self.vae_scale_factor,
+                    max(int(width * scale) // self.vae_scale_factor, 1) * self.vae_scale_factor,
+                )
+            )
+        if end_step >= num_inference_steps:
+            raise ValueError(
+                f"The reduced resolution phases take {end_step} steps, leaving none of the {num_inference_steps} steps"
+                " for the full resolution."
+            )
+        phases.append((num_inference_steps, height, width))
+        return phases
+
+    @staticmethod
+    def _resize_control_input(image, height, width, mode):
+        # PIL images are resized by the image processors, tensors have to be resized here
+        if isinstance(image, torch.Tensor) and image.shape[-2:] != (height, width):
+            return torch.nn.functional.interpolate(image, size=(height, width), mode=mode)
+        return image
+
+    def upsample_latents(
+        self,
+        latents,
+        noise_pred,
+        sigma,
+        next_sigma,
+        height,
+        width,
+        target_height,
+        target_width,
+        generator=None,
+    ):
+        r"""
+        Carry a run over to a higher resolution between two denoising steps.
+
+        Upsampling noisy latents would also stretch their noise, which the model does not expect at the new
+        resolution. Instead, the clean latents predicted by the flow-matching velocity at this step are upsampled and
+        fresh noise is mixed in for the noise level of the next step.
+
+        Args:
+            latents (`torch.Tensor`):
+                The packed latents the step was taken from.
+            noise_pred (`torch.Tensor`):
+                The velocity predicted for them.
+            sigma (`float`), next_sigma (`float`):
+                The noise levels of this step and of the next one.
+            height (`int`), width (`int`):
+                The size in pixels of the current phase.
+            target_height (`int`), target_width (`int`):
+                The size in pixels of the next phase.
+            generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
+                Generator(s) of the fresh noise.
+
+        Returns:
+            `torch.Tensor`: The packed latents of the next step at the target resolution.
+        """
+        batch_size = latents.shape[0]
+        denoised = latents.float() - sigma * noise_pred.float()
+        denoised = self._unpack_latents(denoised, height, width, self.vae_scale_factor)
+        latent_height = 2 * (target_height // self.vae_scale_factor)
+        latent_width = 2 * (target_width // self.vae_scale_factor)
+        denoised = torch.nn.functional.interpolate(denoised, size=(latent_height, latent_width), mode="bicubic")
+        denoised = self._pack_latents(denoised, batch_size, denoised.shape[1], latent_height, latent_width)
+
+        noise = randn_tensor(denoised.shape, generator=generator, device=denoised.device, dtype=denoised.dtype)
+        return ((1 - next_sigma) * denoised + next_sigma * noise).to(latents.dtype)
+
     @property
     def guidance_scale(self):
         return self._guidance_scale
@@ -719,6 +1103,22 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
     def interrupt(self):
         return self._interrupt
 
+    @property
+    def step_allocations(self):
+        return self._step_allocations
+
+    @property
+    def stage_timings(self):
+        return self._stage_timings
+
+    @property
+    def stage_peak_memory(self):
+        return self._stage_peak_memory
+
+    @property
+    def latent_checkpoints(self):
+        return self._latent_checkpoints
+
     @torch.no_grad()
     @replace_example_docstring(EXAMPLE_DOC_STRING)
     def __call__(
@@ -747,6 +1147,21 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 512,
+        report_step_allocations: bool = False,
+        interleave_controlnet: bool = False,
+        sparse_mask_denoising: bool = False,
+        sparse_mask_dilation: int = 2,
+        sparse_mask_refresh_every: int = 0,
+        record_stage_timings: bool = False,
+        reset_stage_peak_memory: bool = False,
+        checkpoint_steps: Optional[List[int]] = None,
+        resume_from: Optional[FluxLatentCheckpoint] = None,
+        progressive_resolution: Optional[List[Tuple[float, int]]] = None,
+        negative_prompt_embeds: Optional[torch.FloatTensor] = None,
+        negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
+        control_latents: Optional[torch.FloatTensor] = None,
+        should_interrupt: Optional[Callable[[], bool]] = None,
+        interrupt_between_blocks: bool = False,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -809,6 +1224,71 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
             max_sequence_length (`int` defaults to 512): Maximum sequence length to use with the `prompt`.
+            report_step_allocations (`bool`, *optional*, defaults to `False`):
+                Whether to record the number of allocator calls made during each denoising step. The counts are
+                logged at the end of the loop and available afterwards through `step_allocations`. Only supported on
+                CUDA devices.
+            interleave_controlnet (`bool`, *optional*, defaults to `False`):
+                Whether to run each controlnet block right before the transformer block that consumes its residual
+                instead of running the whole controlnet first. Only one controlnet residual is alive at a time, which
+                lowers the peak activation memory of the denoising step.
+            sparse_mask_denoising (`bool`, *optional*, defaults to `False`):
+                Whether to only compute the image tokens inside the dilated mask in the single transformer blocks after
+                the first step. The other tokens are frozen to the values of the last full pass, so the cost of these
+                blocks scales with the masked area. See [`FluxSparseTokenCache`].
+            sparse_mask_dilation (`int`, *optional*, defaults to 2):
+                Number of tokens (16 pixels each) the mask is dilated by for sparse denoising.
+            sparse_mask_refresh_every (`int`, *optional*, defaults to 0):
+                Run a full pass every `sparse_mask_refresh_every` steps to refresh the frozen tokens. With 0, only the
+                first step is a full pass.
+            record_stage_timings (`bool`, *optional*, defaults to `False`):
+                Whether to time the stages of the run: `encode_prompt`, `prepare_image_with_mask` (VAE encode of the
+                control image), `prepare_latents`, and at every denoising step `controlnet`, `transformer` and
+                `scheduler_step` (and `upsample_latents` between the phases of `progressive_resolution`), then
+                `vae_decode` and `postprocess`. The device is synchronized around each stage.
+                The durations in seconds are available afterwards through `stage_timings`, one entry per call of the
+                stage. With `interleave_controlnet` the controlnet blocks run inside the transformer, so their time is
+                counted in `transformer`. On CUDA the peak memory allocated during each stage above what was allocated
+                when it started, in bytes, is available through `stage_peak_memory` (see [`FluxStageTimer`]).
+            reset_stage_peak_memory (`bool`, *optional*, defaults to `False`):
+                With `record_stage_timings`, reset the device's peak memory statistics at the start of every stage so
+                that every `stage_peak_memory` entry is exact. Only for runs alone on the device, such as calibration
+                runs: it corrupts the peaks measured by concurrent runs.
+            checkpoint_steps (`List[int]`, *optional*):
+                Save a copy of the latents, on the CPU, after each of these numbers of denoising steps. The
+                [`FluxLatentCheckpoint`]s are available afterwards through `latent_checkpoints`, keyed by step.
+            resume_from ([`FluxLatentCheckpoint`], *optional*):
+                A checkpoint of a previous run to continue from, skipping the steps it has already been through. The
+                run must have the same size and `num_inference_steps` as the checkpoint, and typically the same
+                control image and mask. The prompt can differ: the layout set by the first steps is kept while the
+                remaining steps follow the new prompt. Cannot be combined with `latents`.
+            progressive_resolution (`List[Tuple[float, int]]`, *optional*):
+                Coarse-to-fine schedule of `(scale, steps)` pairs, e.g. `[(0.5, 8)]`, to run the first denoising steps
+                at a reduced resolution. Each phase runs its number of steps at `scale` times the height and width,
+                with the control image and mask downsampled to match and rotary ids for the reduced token grid. The
+                remaining steps run at full resolution. Between phases the denoised estimate of the last step is
+                upsampled and noised again to the noise level of the next step, so the early high-noise steps, which
+                mostly set the layout, cost a fraction of a full-resolution step. Cannot be combined with `latents`
+                or `sparse_mask_denoising`, and checkpoints can only be saved or resumed at full resolution.
+            negative_prompt_embeds (`torch.FloatTensor`, *optional*):
+                Pre-generated negative text embeddings, used with `negative_pooled_prompt_embeds` when
+                `true_guidance_scale > 1` instead of encoding `negative_prompt`.
+            negative_pooled_prompt_embeds (`torch.FloatTensor`, *optional*):
+                Pre-generated negative pooled text embeddings.
+            control_latents (`torch.FloatTensor`, *optional*):
+                Pre-encoded control image and mask, as returned by `prepare_image_with_mask` for the same size, batch
+                and guidance. Skips the VAE encode of `control_image`, e.g. when it already ran on another stream.
+                `control_image` and `control_mask` are still needed by `progressive_resolution` and
+                `sparse_mask_denoising`.
+            should_interrupt (`Callable[[], bool]`, *optional*):
+                Polled before every denoising step, e.g. to stop runs that were cancelled or ran past a deadline. Once
+                it returns `True` the run is interrupted: the remaining steps are skipped, nothing is decoded and the
+                returned images are `None`. Setting `interrupt` from a callback still skips the remaining steps and
+                decodes the latents as they are.
+            interrupt_between_blocks (`bool`, *optional*, defaults to `False`):
+                Whether to also poll `should_interrupt` before every transformer and controlnet block, so that the
+                run stops in the middle of a step instead of at its end. The block hooks only act in the thread of
+                this call, so runs sharing the models from other threads are not interrupted with it.
 
         Examples:
 
@@ -836,6 +1316,34 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
         self._guidance_scale = true_guidance_scale
         self._joint_attention_kwargs = joint_attention_kwargs
         self._interrupt = False
+        self._step_allocations = []
+        self._stage_timings = {}
+        self._stage_peak_memory = {}
+        self._latent_checkpoints = {}
+
+        if resume_from is not None:
+            if latents is not None:
+                raise ValueError("Only one of `latents` and `resume_from` can be passed.")
+            if resume_from.num_inference_steps != num_inference_steps:
+                raise ValueError(
+                    f"`resume_from` was saved from a run of {resume_from.num_inference_steps} steps, cannot resume"
+                    f" a run of {num_inference_steps} steps."
+                )
+            if not 0 <= resume_from.step < num_inference_steps:
+                raise ValueError(f"Cannot resume from step {resume_from.step} of {num_inference_steps}.")
+        checkpoint_steps = set(checkpoint_steps or ())
+        if progressive_resolution:
+            reduced_steps = sum(steps for _, steps in progressive_resolution)
+            if latents is not None or sparse_mask_denoising:
+                raise ValueError(
+                    "`progressive_resolution` cannot be combined with `latents` or `sparse_mask_denoising`."
+                )
+            if (resume_from is not None and resume_from.step < reduced_steps) or any(
+                step < reduced_steps for step in checkpoint_steps
+            ):
+                raise ValueError(
+                    f"Checkpoints can only be saved and resumed after the {reduced_steps} reduced resolution steps."
+                )
 
         # 2. Define call parameters
         if prompt is not None and isinstance(prompt, str):
@@ -847,31 +1355,35 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
 
         device = self._execution_device
         dtype = self.transformer.dtype
+        timer = FluxStageTimer(device, enabled=record_stage_timings, reset_peaks=reset_stage_peak_memory)
 
         lora_scale = (
             self.joint_attention_kwargs.get("scale", None)
             if self.joint_attention_kwargs is not None
             else None
         )
-        (            
-            prompt_embeds,
-            pooled_prompt_embeds,
-            negative_prompt_embeds,
-            negative_pooled_prompt_embeds,
-            text_ids
-        ) = self.encode_prompt(
-            prompt=prompt,
-            prompt_2=prompt_2,
-            prompt_embeds=prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            do_classifier_free_guidance = self.do_classifier_free_guidance,
-            negative_prompt = negative_prompt,
-            negative_prompt_2 = negative_prompt_2,
-            device=device,
-            num_images_per_prompt=num_images_per_prompt,
-            max_sequence_length=max_sequence_length,
-            lora_scale=lora_scale,
-        )
+        with timer.stage("encode_prompt"):
+            (            
+                prompt_embeds,
+                pooled_prompt_embeds,
+                negative_prompt_embeds,
+                negative_pooled_prompt_embeds,
+                text_ids
+            ) = self.encode_prompt(
+                prompt=prompt,
+                prompt_2=prompt_2,
+                prompt_embeds=prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                do_classifier_free_guidance = self.do_classifier_free_guidance,
+                negative_prompt = negative_prompt,
+                negative_prompt_2 = negative_prompt_2,
+                device=device,
+                num_images_per_prompt=num_images_per_prompt,
+                max_sequence_length=max_sequence_length,
+                lora_scale=lora_scale,
+                negative_prompt_embeds=negative_prompt_embeds,
+                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            )
         
         # 在 encode_prompt 之后
         if self.do_classifier_free_guidance:
@@ -881,38 +1393,88 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
 
         # 3. Prepare control image
         num_channels_latents = self.transformer.config.in_channels // 4
-        if isinstance(self.controlnet, FluxControlNetModel):
-            control_image, height, width = self.prepare_image_with_mask(
-                image=control_image,
-                mask=control_mask,
-                width=width,
-                height=height,
-                batch_size=batch_size * num_images_per_prompt,
-                num_images_per_prompt=num_images_per_prompt,
-                device=device,
-                dtype=dtype,
-                do_classifier_free_guidance=self.do_classifier_free_guidance,
-            )
+        resolution_phases = self.prepare_resolution_phases(progressive_resolution, height, width, num_inference_steps)
+        control_image_input = control_image
+        if control_latents is not None:
+            control_image = control_latents.to(device=device, dtype=dtype)
+        elif isinstance(self.controlnet, FluxControlNetModel):
+            with timer.stage("prepare_image_with_mask"):
+                control_image, height, width = self.prepare_image_with_mask(
+                    image=control_image,
+                    mask=control_mask,
+                    width=width,
+                    height=height,
+                    batch_size=batch_size * num_images_per_prompt,
+                    num_images_per_prompt=num_images_per_prompt,
+                    device=device,
+                    dtype=dtype,
+                    do_classifier_free_guidance=self.do_classifier_free_guidance,
+                )
 
         # 4. Prepare latent variables
         num_channels_latents = self.transformer.config.in_channels // 4
-        latents, latent_image_ids = self.prepare_latents(
-            batch_size * num_images_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            prompt_embeds.dtype,
-            device,
-            generator,
-            latents,
-        )
-        
-        if self.do_classifier_free_guidance:
-            latent_image_ids = torch.cat([latent_image_ids] * 2)
+        if resume_from is not None:
+            if (resume_from.height, resume_from.width) != (height, width):
+                raise ValueError(
+                    f"`resume_from` was saved from a {resume_from.width}x{resume_from.height} run, cannot resume a"
+                    f" {width}x{height} run."
+                )
+            if resume_from.latents.shape[0] != batch_size * num_images_per_prompt:
+                raise ValueError(
+                    f"`resume_from` holds {resume_from.latents.shape[0]} latents, expected"
+                    f" {batch_size * num_images_per_prompt}."
+                )
+            latents = resume_from.latents
+
+        # resumed runs start after the reduced resolution phases
+        phase_index = len(resolution_phases) - 1 if resume_from is not None else 0
+        _, start_height, start_width = resolution_phases[phase_index]
+        with timer.stage("prepare_latents"):
+            latents, latent_image_ids = self.prepare_latents(
+                batch_size * num_images_per_prompt,
+                num_channels_latents,
+                start_height,
+                start_width,
+                prompt_embeds.dtype,
+                device,
+                generator,
+                latents,
+            )
+
+        # control latents and rotary ids of each resolution phase, a single phase unless denoising progressively
+        phase_inputs = []
+        for _, phase_height, phase_width in resolution_phases:
+            if (phase_height, phase_width) == (height, width):
+                phase_control_image = control_image
+            else:
+                with timer.stage("prepare_image_with_mask"):
+                    phase_control_image, _, _ = self.prepare_image_with_mask(
+                        image=self._resize_control_input(control_image_input, phase_height, phase_width, "bilinear"),
+                        mask=self._resize_control_input(control_mask, phase_height, phase_width, "nearest"),
+                        width=phase_width,
+                        height=phase_height,
+                        batch_size=batch_size * num_images_per_prompt,
+                        num_images_per_prompt=num_images_per_prompt,
+                        device=device,
+                        dtype=dtype,
+                        do_classifier_free_guidance=self.do_classifier_free_guidance,
+                    )
+            phase_image_ids = self._prepare_latent_image_ids(
+                batch_size * num_images_per_prompt,
+                2 * (phase_height // self.vae_scale_factor),
+                2 * (phase_width // self.vae_scale_factor),
+                device,
+                prompt_embeds.dtype,
+            )
+            if self.do_classifier_free_guidance:
+                phase_image_ids = torch.cat([phase_image_ids] * 2)
+            phase_inputs.append((phase_control_image, phase_image_ids))
+        control_image, latent_image_ids = phase_inputs[phase_index]
 
         # 5. Prepare timesteps
         sigmas = np.linspace(1.0, 1 / num_inference_steps, num_inference_steps)
-        image_seq_len = latents.shape[1]
+        # the schedule is the one of the full resolution, whatever resolution the run starts at
+        image_seq_len = (height // self.vae_scale_factor) * (width // self.vae_scale_factor)
         mu = calculate_shift(
             image_seq_len,
             self.scheduler.config.base_image_seq_len,
@@ -934,73 +1496,130 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
         )
         self._num_timesteps = len(timesteps)
 
+        sparse_cache = None
+        if sparse_mask_denoising:
+            image_token_mask = self.prepare_sparse_token_mask(
+                control_mask,
+                width=width,
+                height=height,
+                dilation=sparse_mask_dilation,
+                device=device,
+            )
+            logger.info(
+                f"Sparse mask denoising on {int(image_token_mask.sum())}/{image_token_mask.shape[0]} image tokens"
+            )
+            sparse_cache = FluxSparseTokenCache(
+                image_token_mask, refresh_every=sparse_mask_refresh_every
+            )
+
+        step_context = FluxDenoisingStepContext(
+            latents,
+            do_classifier_free_guidance=self.do_classifier_free_guidance,
+            guidance_scale=guidance_scale if self.transformer.config.guidance_embeds else None,
+            residual_dtype=self.transformer.dtype,
+            track_allocations=report_step_allocations,
+        )
+
+        resume_step = resume_from.step if resume_from is not None else 0
+        if resume_step:
+            # the first step taken is not the first of the schedule
+            self.scheduler.set_begin_index(resume_step)
+
         # 6. Denoising loop
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
+        # a stop requested by should_interrupt is kept apart from `interrupt`, which callbacks set to skip the
+        # remaining steps but still decode
+        interrupted = False
+        with self.progress_bar(total=num_inference_steps - resume_step) as progress_bar, self._interruptible_blocks(
+            should_interrupt if interrupt_between_blocks else None
+        ) as blocks:
             for i, t in enumerate(timesteps):
-                if self.interrupt:
+                if not interrupted and should_interrupt is not None and should_interrupt():
+                    interrupted = True
+                if interrupted or self.interrupt or i < resume_step:
                     continue
-                
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
 
-                # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-                timestep = t.expand(latent_model_input.shape[0]).to(latent_model_input.dtype)
-
-                # handle guidance
-                if self.transformer.config.guidance_embeds:
-                    guidance = torch.tensor([guidance_scale], device=device)
-                    guidance = guidance.expand(latent_model_input.shape[0])
-                else:
-                    guidance = None
+                step_context.begin_step()
+                latent_model_input, timestep, guidance = step_context.prepare(latents, t)
 
                 # controlnet
-                (
-                    controlnet_block_samples,
-                    controlnet_single_block_samples,
-                ) = self.controlnet(
-                    hidden_states=latent_model_input,
-                    controlnet_cond=control_image,
-                    conditioning_scale=controlnet_conditioning_scale,
-                    timestep=timestep / 1000,
-                    guidance=guidance,
-                    pooled_projections=pooled_prompt_embeds,
-                    encoder_hidden_states=prompt_embeds,
-                    txt_ids=text_ids,
-                    img_ids=latent_image_ids,
-                    joint_attention_kwargs=self.joint_attention_kwargs,
-                    return_dict=False,
-                )
+                with timer.stage("controlnet"):
+                    (
+                        controlnet_block_samples,
+                        controlnet_single_block_samples,
+                    ) = self.controlnet(
+                        hidden_states=latent_model_input,
+                        controlnet_cond=control_image,
+                        conditioning_scale=controlnet_conditioning_scale,
+                        timestep=timestep,
+                        guidance=guidance,
+                        pooled_projections=pooled_prompt_embeds,
+                        encoder_hidden_states=prompt_embeds,
+                        txt_ids=text_ids,
+                        img_ids=latent_image_ids,
+                        joint_attention_kwargs=self.joint_attention_kwargs,
+                        return_dict=False,
+                        interleaved=interleave_controlnet,
+                        residual_dtype=self.transformer.dtype if interleave_controlnet else None,
+                    )
+                    if not interleave_controlnet:
+                        controlnet_block_samples = step_context.cast_residuals(controlnet_block_samples)
+                        controlnet_single_block_samples = step_context.cast_residuals(controlnet_single_block_samples)
+
+                with timer.stage("transformer"):
+                    noise_pred = self.transformer(
+                        hidden_states=latent_model_input,
+                        timestep=timestep,
+                        guidance=guidance,
+                        pooled_projections=pooled_prompt_embeds,
+                        encoder_hidden_states=prompt_embeds,
+                        controlnet_block_samples=controlnet_block_samples,
+                        controlnet_single_block_samples=controlnet_single_block_samples,
+                        txt_ids=text_ids,
+                        img_ids=latent_image_ids,
+                        joint_attention_kwargs=self.joint_attention_kwargs,
+                        return_dict=False,
+                        sparse_cache=sparse_cache,
+                    )[0]
+                del controlnet_block_samples, controlnet_single_block_samples
 
-                noise_pred = self.transformer(
-                    hidden_states=latent_model_input,
-                    # YiYi notes: divide it by 1000 for now because we scale it by 1000 in the transforme rmodel (we should not keep it but I want to keep the inputs same for the model for testing)
-                    timestep=timestep / 1000,
-                    guidance=guidance,
-                    pooled_projections=pooled_prompt_embeds,
-                    encoder_hidden_states=prompt_embeds,
-                    controlnet_block_samples=[
-                        sample.to(dtype=self.transformer.dtype)
-                        for sample in controlnet_block_samples
-                    ],
-                    controlnet_single_block_samples=[
-                        sample.to(dtype=self.transformer.dtype)
-                        for sample in controlnet_single_block_samples
-                    ] if controlnet_single_block_samples is not None else controlnet_single_block_samples,
-                    txt_ids=text_ids,
-                    img_ids=latent_image_ids,
-                    joint_attention_kwargs=self.joint_attention_kwargs,
-                    return_dict=False,
-                )[0]
-                
                 # 在生成循环中
                 if self.do_classifier_free_guidance:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + true_guidance_scale * (noise_pred_text - noise_pred_uncond)
+                    noise_pred = (
+                        noise_pred_text.sub_(noise_pred_uncond)
+                        .mul_(true_guidance_scale)
+                        .add_(noise_pred_uncond)
+                    )
 
                 # compute the previous noisy sample x_t -> x_t-1
                 latents_dtype = latents.dtype
-                latents = self.scheduler.step(
-                    noise_pred, t, latents, return_dict=False
-                )[0]
+                step_latents = latents
+                with timer.stage("scheduler_step"):
+                    latents = self.scheduler.step(
+                        noise_pred, t, latents, return_dict=False
+                    )[0]
+
+                phase_end, phase_height, phase_width = resolution_phases[phase_index]
+                if i + 1 == phase_end and phase_index + 1 < len(resolution_phases):
+                    # move on to the next resolution, from the denoised estimate of this step
+                    phase_index += 1
+                    _, next_height, next_width = resolution_phases[phase_index]
+                    step_index = self.scheduler.step_index
+                    with timer.stage("upsample_latents"):
+                        latents = self.upsample_latents(
+                            step_latents,
+                            noise_pred,
+                            sigma=self.scheduler.sigmas[step_index - 1],
+                            next_sigma=self.scheduler.sigmas[step_index],
+                            height=phase_height,
+                            width=phase_width,
+                            target_height=next_height,
+                            target_width=next_width,
+                            generator=generator,
+                        )
+                    control_image, latent_image_ids = phase_inputs[phase_index]
+                    step_context.resize(latents)
+                del step_latents
 
                 if latents.dtype != latents_dtype:
                     if torch.backends.mps.is_available():
@@ -1016,6 +1635,17 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
                     latents = callback_outputs.pop("latents", latents)
                     prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
 
+                step_context.end_step()
+
+                if i + 1 in checkpoint_steps:
+                    self._latent_checkpoints[i + 1] = FluxLatentCheckpoint(
+                        step=i + 1,
+                        num_inference_steps=num_inference_steps,
+                        height=height,
+                        width=width,
+                        latents=latents.to("cpu", copy=True),
+                    )
+
                 # call the callback, if provided
                 if i == len(timesteps) - 1 or (
                     (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
@@ -1025,20 +1655,27 @@ class FluxControlNetInpaintingPipeline(DiffusionPipeline, FluxLoraLoaderMixin):
                 if XLA_AVAILABLE:
                     xm.mark_step()
 
-        if output_type == "latent":
+        self._step_allocations = step_context.step_allocations
+        if step_context.track_allocations:
+            logger.info(f"Allocator calls per denoising step: {self._step_allocations}")
+
+        if interrupted or blocks.interrupted:
+            # the run was abandoned, its latents are not worth decoding
+            image = None
+
+        elif output_type == "latent":
             image = latents
 
         else:
-            latents = self._unpack_latents(
-                latents, height, width, self.vae_scale_factor
+            image = self.decode_latents(latents, height, width, output_type=output_type, timer=timer)
+
+        self._stage_timings = timer.timings
+        self._stage_peak_memory = timer.peak_memory
+        if timer.enabled:
+            logger.info(
+                "Stage timings: "
+                + ", ".join(f"{name} {sum(durations):.3f}s" for name, durations in self._stage_timings.items())
             )
-            latents = (
-                latents / self.vae.config.scaling_factor
-            ) + self.vae.config.shift_factor
-            latents = latents.to(self.vae.dtype)
-
-            image = self.vae.decode(latents, return_dict=False)[0]
-            image = self.image_processor.postprocess(image, output_type=output_type)
 
         # Offload all models
         self.maybe_free_model_hooks()
@@ -0,0 +1,208 @@
+import os
+from flask import Flask, render_template, request, jsonify, send_from_directory
+
+from admission import AdmissionController, AdmissionRejected, client_key
+from asset_store import AssetStore, AssetUploadError, LocalAssetUploader, fal_storage_uploader
+from backends import BackendBusy, BackendRejected, FalGenerationBackend, HybridRouter, LocalHTTPBackend, StubBackend
+from fal_backend import FalBackend, FalBackendBusy
+from health import CircuitOpen, HealthMonitor
+from mask_codec import validate_mask
+from metrics import Counter, Gauge, metrics_response
+from singleflight import SingleFlight, request_key
+from styles import PREDEFINED_STYLES
+
+# Initialize Flask app
+app = Flask(__name__)
+
+# Front service that sends each generation to the local GPU pipeline (local.py) while it keeps up,
+# and overflows to fal otherwise. ROUTER_BACKENDS=stub replaces both backends with in-process stubs.
+ROUTER_BACKENDS = os.environ.get("ROUTER_BACKENDS", "live")
+LOCAL_BACKEND_URL = os.environ.get("LOCAL_BACKEND_URL", "http://localhost:5002")
+LOCAL_CONCURRENCY = int(os.environ.get("LOCAL_CONCURRENCY", "1"))
+LOCAL_MAX_QUEUE = int(os.environ.get("LOCAL_MAX_QUEUE", "4"))
+
+# Where inputs sent to fal are uploaded, as in server.py
+ASSET_STORE = os.environ.get("ASSET_STORE", "fal")
+LOCAL_ASSET_DIR = os.environ.get("LOCAL_ASSET_DIR", "assets")
+LOCAL_ASSET_BASE_URL = os.environ.get("LOCAL_ASSET_BASE_URL", "http://localhost:5000/assets")
+
+# Uploads keep their aspect ratio, as fal expects (see server.py); local.py resizes them to its pipeline size itself
+UPLOAD_TARGET = {"width": 1280, "height": 1280, "resize": "contain", "format": "image/webp", "quality": 0.92}
+
+if ROUTER_BACKENDS == "stub":
+    local_backend = StubBackend(
+        "local",
+        concurrency=LOCAL_CONCURRENCY,
+        latency=float(os.environ.get("STUB_LOCAL_LATENCY", "2.0")),
+        requires_mask=True,
+    )
+    remote_backend = StubBackend(
+        "fal",
+        concurrency=int(os.environ.get("STUB_FAL_CONCURRENCY", "64")),
+        latency=float(os.environ.get("STUB_FAL_LATENCY", "4.0")),
+    )
+else:
+    if ASSET_STORE == "local":
+        asset_store = AssetStore(LocalAssetUploader(LOCAL_ASSET_DIR, LOCAL_ASSET_BASE_URL))
+    else:
+        asset_store = AssetStore(fal_storage_uploader)
+    local_backend = LocalHTTPBackend(LOCAL_BACKEND_URL, concurrency=LOCAL_CONCURRENCY)
+    remote_backend = FalGenerationBackend(FalBackend(), asset_store)
+
+def probe_backends():
+    """Health probe: the local pipeline's own cached status plus the routing state"""
+    details = {"routing": router.stats()}
+    if isinstance(local_backend, LocalHTTPBackend):
+        try:
+            details["local"] = local_backend.probe()
+        except Exception as e:
+            # fal still serves every request while the local pipeline is down
+            details["local"] = {"status": "error", "message": str(e)}
+    return details
+
+# Backends turning requests away under load, or refusing a single request, are not failing: those requests go to fal
+# without opening the local circuit
+health = HealthMonitor(probe_backends, ignored_errors=(FalBackendBusy, BackendBusy, BackendRejected))
+router = HybridRouter(local_backend, remote_backend, health, max_local_queue=LOCAL_MAX_QUEUE)
+
+# Identical concurrent /generate requests share one generation
+generate_flight = SingleFlight("generate")
+
+# Bounded queue in front of both backends together
+admission = AdmissionController(
+    "router",
+    concurrency=int(os.environ.get("ROUTER_MAX_IN_FLIGHT", "64")),
+    max_queue=int(os.environ.get("ROUTER_MAX_QUEUE", "256")),
+    expected_duration=remote_backend.latency,
+)
+
+routed_requests = Counter(
+    "router_requests_total",
+    "Generations completed by each backend",
+    labelnames=("backend",),
+)
+for backend in (local_backend, remote_backend):
+    Gauge(
+        f"router_{backend.name}_in_flight",
+        f"Generations accepted by the {backend.name} backend, running or queued",
+        callback=lambda backend=backend: backend.in_flight,
+    )
+    Gauge(
+        f"router_{backend.name}_latency_seconds",
+        f"Moving average service time of the {backend.name} backend",
+        callback=lambda backend=backend: backend.latency,
+    )
+
+@app.route('/')
+def index():
+    """Render the main application page"""
+    return render_template('index.html')
+
+if ASSET_STORE == "local":
+    @app.route('/assets/<path:filename>')
+    def serve_asset(filename):
+        """Serve assets uploaded to the local asset store"""
+        return send_from_directory(os.path.abspath(LOCAL_ASSET_DIR), filename)
+
+@app.route('/get-predefined-styles', methods=['GET'])
+def get_predefined_styles():
+    """Return the list of predefined styles for the frontend"""
+    styles_list = []
+    for key, style in PREDEFINED_STYLES.items():
+        styles_list.append({
+            "id": key,
+            "name": style["name"],
+        })
+    return jsonify(styles_list)
+
+@app.route('/upload-config')
+def get_upload_config():
+    """Return the size and encoding the frontend should prepare uploads with"""
+    return jsonify(UPLOAD_TARGET)
+
+@app.route('/metrics')
+def metrics():
+    """Expose serving metrics in the Prometheus text format"""
+    return metrics_response()
+
+@app.route('/api-status')
+def check_api_status():
+    """Report the cached backend health, routing state and per-backend latency percentiles"""
+    health.start()
+    state = health.snapshot()
+    state["routing"] = router.stats()
+    state["admission"] = admission.stats()
+    return jsonify(state), health.status_code(state)
+
+@app.route('/generate', methods=['POST'])
+def generate_design():
+    """Generate a design on the local pipeline or on fal, whichever is expected to finish first"""
+    try:
+        data = request.json
+        image_data = data.get('image')
+        mask_data = data.get('mask')
+        prompt = data.get('prompt')
+        selected_style = data.get('style')
+
+        # Validate inputs
+        if not image_data:
+            return jsonify({'error': 'Missing image data'}), 400
+        if not prompt and selected_style not in PREDEFINED_STYLES:
+            return jsonify({'error': 'Missing prompt or style'}), 400
+        error = validate_mask(mask_data)
+        if error:
+            return jsonify({'error': error}), 400
+
+        def admitted_generation():
+            with admission.admit(client):
+                return router.generate(image_data, mask_data, prompt, selected_style)
+
+        client = client_key(request)
+        key = request_key(image_data, mask_data, "router", prompt, {"style": selected_style})
+        try:
+            (result_url, backend_name), shared = generate_flight.do(key, admitted_generation)
+        except AdmissionRejected as e:
+            print(f"Not admitted: {str(e)}")
+            response = jsonify({
+                'error': 'Too many generations in progress',
+                'details': str(e),
+                'retry_after': e.retry_after
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, e.status
+        except AssetUploadError as e:
+            print(f"Error uploading inputs: {str(e)}")
+            return jsonify({'error': f"Error uploading inputs: {str(e)}"}), 502
+        except (CircuitOpen, FalBackendBusy, BackendBusy) as e:
+            print(f"Rejecting request: {str(e)}")
+            response = jsonify({
+                'error': 'Too many generations in progress',
+                'details': 'Please try again in a moment'
+            })
+            if isinstance(e, CircuitOpen):
+                response.headers['Retry-After'] = str(int(e.retry_after))
+            elif isinstance(e, BackendBusy) and e.retry_after is not None:
+                response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+        except Exception as e:
+            print(f"Error generating design: {str(e)}")
+            return jsonify({'error': f"Error generating design: {str(e)}"}), 500
+
+        if not shared:
+            routed_requests.inc(backend=backend_name)
+        print(f"Generated on the {backend_name} backend")
+        return jsonify({'result_url': result_url, 'backend': backend_name})
+
+    except Exception as e:
+        print(f"Error in generate_design: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+if __name__ == '__main__':
+    health.start()
+    print(f"Starting hybrid router ({ROUTER_BACKENDS} backends)...")
+    print("Open your browser and navigate to http://localhost:5000")
+
+    # Run the Flask app
+    app.run(debug=True, port=5000, threaded=True)
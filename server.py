@@ -1,50 +1,112 @@
-import fal_client
+import asyncio
 import base64
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify
+import uvicorn
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory
+
+from admission import AdmissionController, AdmissionRejected, client_key, client_key_for
+from asgi import HybridApp, JSONResponse
+from asset_store import AssetStore, AssetUploadError, LocalAssetUploader, fal_storage_uploader
+from backends import FAL_EXPECTED_LATENCY, extract_result_url, fal_arguments, fal_generation_target
+from fal_backend import DEFAULT_CONCURRENCY, MODEL_CONCURRENCY, FalBackend, FalBackendBusy, StubFalBackend
+from health import CircuitOpen, HealthMonitor
+from mask_codec import is_encoded_mask, validate_mask
+from metrics import SIZE_BUCKETS, Histogram, metrics_response
+from singleflight import SingleFlight, request_key
+from styles import PREDEFINED_STYLES
 
 # Initialize Flask app
 app = Flask(__name__)
 
-# Predefined styles with carefully crafted prompts
-PREDEFINED_STYLES = {
-    "modern": {
-        "name": "Modern",
-        "prompt": "Transform this area into a sleek modern design with clean lines, neutral colors, minimalist furniture, and subtle lighting. Use contemporary materials like glass, metal, and polished surfaces. Maintain a spacious and uncluttered look.",
-        "model": "fal-ai/ideogram/v3/edit"
-    },
-    "scandinavian": {
-        "name": "Scandinavian",
-        "prompt": "Convert this space into a bright Scandinavian style with white walls, light wooden floors, simple functional furniture, and plenty of natural light. Include cozy textiles, muted colors, and touches of greenery for warmth.",
-        "model": "fal-ai/ideogram/v3/edit"
-    },
-    "industrial": {
-        "name": "Industrial",
-        "prompt": "Redesign this area with industrial aesthetics featuring exposed brick walls, metal fixtures, weathered wood, and vintage furniture. Add Edison bulbs, open shelving, and raw materials like concrete and steel to create an urban warehouse feel.",
-        "model": "fal-ai/ideogram/v3/edit"
-    },
-    "mid_century": {
-        "name": "Mid-Century Modern",
-        "prompt": "Transform this space into a mid-century modern design with iconic furniture shapes, warm wood tones, bold geometric patterns, and pops of color. Include tapered legs, functional forms, and retro-inspired decor from the 1950s-60s era.",
-        "model": "fal-ai/ideogram/v3/edit"
-    },
-    "indian": {
-        "name": "Indian Traditional",
-        "prompt": "Redesign this space with rich Indian traditional decor featuring vibrant textiles, intricate patterns, wooden carved furniture, and warm colors like deep reds, oranges, and golds. Add brass accents, decorative pillows, ornate details, archways, and traditional Indian artwork or tapestries.",
-        "model": "fal-ai/flux/dev/image-to-image"
-    },
-    "bohemian": {
-        "name": "Bohemian",
-        "prompt": "Transform this area with bohemian style featuring layered textiles, eclectic patterns, mixed furniture, macramé, and plenty of plants. Include global-inspired elements, vibrant colors, natural materials, and artistic touches for a free-spirited atmosphere.",
-        "model": "fal-ai/flux/dev/image-to-image"
-    },
-    "luxury": {
-        "name": "Luxury",
-        "prompt": "Redesign this space with opulent luxury featuring plush velvet furniture, crystal chandeliers, marble surfaces, and gold accents. Create a sophisticated palette with rich colors, symmetrical arrangements, and high-end finishes for an elegant, refined ambiance.",
-        "model": "fal-ai/flux/dev/image-to-image"
-    }
-}
+# /generate is served as a coroutine on the ASGI server's event loop (see asgi_app below); the other routes run on
+# this many WSGI threads
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "32"))
+
+# Shared async fal client: one pooled HTTP session and per-model concurrency limits.
+# FAL_BACKEND=stub replaces the fal round trip with a sleep of STUB_FAL_LATENCY seconds (load tests).
+FAL_BACKEND = os.environ.get("FAL_BACKEND", "live")
+if FAL_BACKEND == "stub":
+    fal_backend = StubFalBackend(
+        latency=float(os.environ.get("STUB_FAL_LATENCY", "4.0")),
+        failure_rate=float(os.environ.get("STUB_FAILURE_RATE", "0")),
+    )
+else:
+    fal_backend = FalBackend()
+
+def probe_fal():
+    """Health probe: a round trip through the fal queue with the echo model"""
+    result = fal_backend.subscribe(
+        "fal-ai/test/echo",
+        arguments={
+            "message": "ping"
+        }
+    )
+    if not result:
+        raise RuntimeError("API returned empty response")
+    return {"pending": fal_backend.pending}
+
+# /api-status reads the state cached by a background prober instead of calling fal per check
+health = HealthMonitor(probe_fal, probe_model="fal-ai/test/echo", ignored_errors=(FalBackendBusy,))
+
+# Where input images and masks are uploaded before being sent to the model:
+# "fal" for fal storage, "local" to serve them from this app (tests and fake endpoints)
+ASSET_STORE = os.environ.get("ASSET_STORE", "fal")
+LOCAL_ASSET_DIR = os.environ.get("LOCAL_ASSET_DIR", "assets")
+LOCAL_ASSET_BASE_URL = os.environ.get("LOCAL_ASSET_BASE_URL", "http://localhost:5001/assets")
+
+if ASSET_STORE == "local":
+    asset_store = AssetStore(LocalAssetUploader(LOCAL_ASSET_DIR, LOCAL_ASSET_BASE_URL))
+else:
+    asset_store = AssetStore(fal_storage_uploader)
+
+# Identical concurrent /generate requests share one remote generation
+generate_flight = SingleFlight("generate")
+
+# Requests waiting for a fal model slot, per slot, before new ones are turned away with Retry-After
+FAL_QUEUE_PER_SLOT = int(os.environ.get("FAL_QUEUE_PER_SLOT", "4"))
+admission_controllers = {}
+admission_lock = threading.Lock()
+
+def admission_for(model):
+    """Admission controller bounding the queue in front of a fal model"""
+    with admission_lock:
+        if model not in admission_controllers:
+            concurrency = MODEL_CONCURRENCY.get(model, DEFAULT_CONCURRENCY)
+            admission_controllers[model] = AdmissionController(
+                "fal_" + "".join(c if c.isalnum() else "_" for c in model),
+                concurrency=concurrency,
+                max_queue=concurrency * FAL_QUEUE_PER_SLOT,
+                expected_duration=FAL_EXPECTED_LATENCY,
+            )
+        return admission_controllers[model]
+
+# Maximum number of styles of one /generate-batch request generated at the same time
+BATCH_MAX_PARALLEL = int(os.environ.get("BATCH_MAX_PARALLEL", "8"))
+
+generation_stage_seconds = Histogram(
+    "generation_stage_seconds",
+    "Duration of the stages of a fal generation: input upload (with mask PNG encoding) and inference",
+    labelnames=("model", "stage"),
+)
+codec_seconds = Histogram(
+    "codec_seconds",
+    "Time spent decoding request masks",
+    labelnames=("operation",),
+)
+payload_bytes = Histogram(
+    "payload_bytes",
+    "Size of request and response bodies",
+    labelnames=("endpoint", "direction"),
+    buckets=SIZE_BUCKETS,
+)
+
+# Bucket the browser downscales uploads to before sending them: the fal models accept any size up to this
+UPLOAD_TARGET = {"width": 1280, "height": 1280, "resize": "contain", "format": "image/webp", "quality": 0.9}
 
 def encode_image_to_base64(image_data):
     """
@@ -74,17 +136,31 @@ def encode_image_to_base64(image_data):
     # Default case
     return image_data
 
-def on_queue_update(update):
-    """Print progress updates from the API"""
-    if isinstance(update, fal_client.InProgress):
-        for log in update.logs:
-            print(log["message"])
+def on_log(message):
+    """Print progress logs from the API"""
+    print(message)
 
 @app.route('/')
 def index():
     """Render the main application page"""
     return render_template('index.html')
 
+@app.after_request
+def observe_payload_sizes(response):
+    """Record the body sizes of batch requests; their streamed responses have no known size"""
+    if request.endpoint == 'generate_batch':
+        if request.content_length is not None:
+            payload_bytes.observe(request.content_length, endpoint=request.endpoint, direction="request")
+        if response.content_length is not None:
+            payload_bytes.observe(response.content_length, endpoint=request.endpoint, direction="response")
+    return response
+
+if ASSET_STORE == "local":
+    @app.route('/assets/<path:filename>')
+    def serve_asset(filename):
+        """Serve assets uploaded to the local asset store"""
+        return send_from_directory(os.path.abspath(LOCAL_ASSET_DIR), filename)
+
 @app.route('/get-predefined-styles', methods=['GET'])
 def get_predefined_styles():
     """Return the list of predefined styles for the frontend"""
@@ -96,30 +172,113 @@ def get_predefined_styles():
         })
     return jsonify(styles_list)
 
+@app.route('/upload-config')
+def get_upload_config():
+    """Return the size and encoding the frontend should prepare uploads with"""
+    return jsonify(UPLOAD_TARGET)
+
+@app.route('/metrics')
+def metrics():
+    """Expose serving metrics in the Prometheus text format"""
+    return metrics_response()
+
 @app.route('/api-status')
 def check_api_status():
-    """Check if the FAL API is available"""
-    try:
-        # Make a simple call to the API to check connectivity
-        result = fal_client.subscribe(
-            "fal-ai/test/echo",
-            arguments={
-                "message": "ping"
-            }
-        )
-        if result:
-            return jsonify({"status": "ok"})
-        else:
-            return jsonify({"status": "error", "message": "API returned empty response"}), 500
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+    """Report the cached FAL API health, latency percentiles and circuit states"""
+    health.start()
+    state = health.snapshot()
+    state["admission"] = {model: controller.stats() for model, controller in admission_controllers.items()}
+    return jsonify(state), health.status_code(state)
+
+def run_generation(image_data, mask_data, model, final_prompt, use_mask, client):
+    """
+    Generate one design on the FAL API, sharing the call with identical in-flight requests.
+    Returns the API result.
+    """
+    def generate():
+        # Wait for a slot of the model, or be turned away if the wait would be too long
+        with admission_for(model).admit(client):
+            with generation_stage_seconds.time(model=model, stage="upload"):
+                api_args = fal_arguments(asset_store, image_data, mask_data, final_prompt, use_mask)
+            
+            # Make API call using the provided images
+            print(f"Calling FAL AI API with model: {model}...")
+            with generation_stage_seconds.time(model=model, stage="inference"):
+                return health.call(model, lambda: fal_backend.subscribe(
+                    model,
+                    arguments=api_args,
+                    on_log=on_log,
+                ))
+    
+    key = request_key(image_data, mask_data if use_mask else None, model, final_prompt)
+    result, shared = generate_flight.do(key, generate)
+    if shared:
+        print("Shared the result of an identical in-flight generation")
+    return result
+
+async def run_generation_async(image_data, mask_data, model, final_prompt, use_mask, client):
+    """
+    Coroutine equivalent of run_generation: waiting for a model slot and for the remote run costs a coroutine rather
+    than a thread. Identical requests of either kind share one generation.
+    """
+    async def generate():
+        with await admission_for(model).admit_async(client):
+            with generation_stage_seconds.time(model=model, stage="upload"):
+                api_args = await asyncio.to_thread(
+                    fal_arguments, asset_store, image_data, mask_data, final_prompt, use_mask
+                )
 
-@app.route('/generate', methods=['POST'])
-def generate_design():
+            print(f"Calling FAL AI API with model: {model}...")
+            with generation_stage_seconds.time(model=model, stage="inference"):
+                return await health.call_async(model, lambda: fal_backend.asubscribe(
+                    model,
+                    arguments=api_args,
+                    on_log=on_log,
+                ))
+
+    key = request_key(image_data, mask_data if use_mask else None, model, final_prompt)
+    result, shared = await generate_flight.do_async(key, generate)
+    if shared:
+        print("Shared the result of an identical in-flight generation")
+    return result
+
+def generation_error(e, model):
+    """Map a generation failure to an error payload, HTTP status and optional Retry-After seconds"""
+    if isinstance(e, AssetUploadError):
+        print(f"Error uploading inputs: {str(e)}")
+        return {'error': f"Error uploading inputs: {str(e)}"}, 502, None
+    if isinstance(e, AdmissionRejected):
+        print(f"Not admitted: {str(e)}")
+        return {
+            'error': 'Too many generations in progress',
+            'details': str(e),
+            'retry_after': e.retry_after
+        }, e.status, e.retry_after
+    if isinstance(e, CircuitOpen):
+        print(f"Failing fast: {str(e)}")
+        return {
+            'error': f"{model} is temporarily unavailable",
+            'details': 'Please try a different style or try again shortly'
+        }, 503, int(e.retry_after)
+    if isinstance(e, FalBackendBusy):
+        print(f"Rejecting request: {str(e)}")
+        return {
+            'error': 'Too many generations in progress',
+            'details': 'Please try again in a moment'
+        }, 503, None
+    print(f"Error calling model {model}: {str(e)}")
+    return {
+        'error': f"Error generating design with {model}: {str(e)}",
+        'details': 'Please try a different style or check your internet connection'
+    }, 500, None
+
+async def generate_design(request):
     """Process the user's request and generate a new design"""
     try:
         # Get form data
-        data = request.json
+        data = request.json()
+        if not isinstance(data, dict):
+            return JSONResponse({'error': 'Request body must be a JSON object'}, 400)
         image_data = data.get('image')
         mask_data = data.get('mask')
         prompt = data.get('prompt')
@@ -127,85 +286,122 @@ def generate_design():
         
         # Validate inputs
         if not image_data:
-            return jsonify({'error': 'Missing image data'}), 400
+            return JSONResponse({'error': 'Missing image data'}, 400)
+        
+        with codec_seconds.time(operation="decode_mask"):
+            error = await asyncio.to_thread(validate_mask, mask_data)
+        if error:
+            return JSONResponse({'error': error}, 400)
         
         # Print debug information
         print(f"Received request with prompt: {prompt}")
         print(f"Image data length: {len(image_data)}")
-        if mask_data:
+        if is_encoded_mask(mask_data):
+            print(f"Mask: {mask_data['width']}x{mask_data['height']} {mask_data['encoding']}, {len(mask_data.get('data') or '')} bytes")
+        elif mask_data:
             print(f"Mask data length: {len(mask_data)}")
         
         # Determine which model and prompt to use
-        model = "fal-ai/ideogram/v3/edit"  # Default model
-        final_prompt = prompt
-        use_mask = True
-        
-        if selected_style and selected_style in PREDEFINED_STYLES:
-            # Use predefined style
-            style_info = PREDEFINED_STYLES[selected_style]
-            model = style_info["model"]
-            final_prompt = style_info["prompt"]
-            print(f"Using predefined style: {style_info['name']} with model: {model}")
-            
-            # For flux model, no need for mask
-            if model == "fal-ai/flux/dev/image-to-image":
-                use_mask = False
-        
-        # Prepare arguments based on the model
-        api_args = {
-            "image_url": image_data,
-            "prompt": final_prompt
-        }
-        
-        # Add mask only if needed and available
-        if use_mask and mask_data:
-            api_args["mask_url"] = mask_data
+        model, final_prompt, use_mask = fal_generation_target(selected_style, prompt)
         
-        # Make API call using the provided images
-        print(f"Calling FAL AI API with model: {model}...")
+        client = client_key_for(request.headers, request.remote_addr)
         try:
-            result = fal_client.subscribe(
-                model,
-                arguments=api_args,
-                with_logs=True,
-                on_queue_update=on_queue_update,
-            )
+            result = await run_generation_async(image_data, mask_data, model, final_prompt, use_mask, client)
         except Exception as e:
-            print(f"Error calling model {model}: {str(e)}")
-            return jsonify({
-                'error': f"Error generating design with {model}: {str(e)}",
-                'details': 'Please try a different style or check your internet connection'
-            }), 500
-        
-        # Extract the result URL - based on the API response format
-        print("Got API result:", result)
-        
-        if 'images' in result and len(result['images']) > 0 and 'url' in result['images'][0]:
-            image_url = result['images'][0]['url']
-            print("Successfully received image result:", image_url)
-            
-            # Return the generated image directly without upscaling
-            print("Successfully received image result:", image_url)
-            return jsonify({'result_url': image_url})
-        
-        elif 'image' in result:
-            # Handle legacy or alternative response format
-            print("Successfully received image result (legacy format)")
-            image_url = result['image']
-            
-            # Return the generated image directly without upscaling
-            print("Successfully received image result:", image_url)
-            return jsonify({'result_url': image_url})
+            payload, status, retry_after = generation_error(e, model)
+            headers = {'Retry-After': retry_after} if retry_after is not None else None
+            return JSONResponse(payload, status, headers)
         
-        else:
-            print("No image in result:", result)
-            return jsonify({'error': 'Failed to generate image'}), 500
+        # Return the generated image directly without upscaling
+        image_url = extract_result_url(result)
+        if image_url is None:
+            return JSONResponse({'error': 'Failed to generate image'}, 500)
+        print("Successfully received image result:", image_url)
+        return JSONResponse({'result_url': image_url})
             
     except Exception as e:
         print(f"Error in generate_design: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        return JSONResponse({'error': str(e)}, 500)
+
+async def observed_generate_design(request):
+    """generate_design, recording the body sizes of its requests and responses"""
+    response = await generate_design(request)
+    payload_bytes.observe(request.content_length, endpoint='generate_design', direction="request")
+    payload_bytes.observe(response.content_length, endpoint='generate_design', direction="response")
+    return response
+
+@app.route('/generate-batch', methods=['POST'])
+def generate_batch():
+    """
+    Generate several predefined styles concurrently and stream each result as soon as it is ready.
+    The response is newline-delimited JSON: one line per style, then a final summary line.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    image_data = data.get('image')
+    mask_data = data.get('mask')
+    style_ids = data.get('styles') or list(PREDEFINED_STYLES)
+    
+    # Validate inputs
+    if not image_data:
+        return jsonify({'error': 'Missing image data'}), 400
+    if not isinstance(style_ids, list) or not all(isinstance(style_id, str) for style_id in style_ids):
+        return jsonify({'error': 'styles must be a list of style ids'}), 400
+    with codec_seconds.time(operation="decode_mask"):
+        error = validate_mask(mask_data)
+    if error:
+        return jsonify({'error': error}), 400
+    unknown = [style_id for style_id in style_ids if style_id not in PREDEFINED_STYLES]
+    if unknown:
+        return jsonify({'error': f"Unknown styles: {', '.join(unknown)}"}), 400
+    style_ids = list(dict.fromkeys(style_ids))
+    
+    print(f"Received batch request for styles: {', '.join(style_ids)}")
+    client = client_key(request)
+    
+    def generate_style(style_id):
+        model, final_prompt, use_mask = fal_generation_target(style_id, None)
+        try:
+            result = run_generation(image_data, mask_data, model, final_prompt, use_mask, client)
+        except Exception as e:
+            payload, status, retry_after = generation_error(e, model)
+            payload.update({'status': status, 'retry_after': retry_after})
+            return payload
+        image_url = extract_result_url(result)
+        if image_url is None:
+            return {'error': 'Failed to generate image', 'status': 500}
+        return {'result_url': image_url, 'status': 200}
+    
+    def stream():
+        started = time.monotonic()
+        # Each worker only waits on the shared fal backend, which enforces the per-model limits
+        executor = ThreadPoolExecutor(max_workers=min(len(style_ids), BATCH_MAX_PARALLEL))
+        try:
+            futures = {executor.submit(generate_style, style_id): style_id for style_id in style_ids}
+            failed = 0
+            for future in as_completed(futures):
+                style_id = futures[future]
+                line = {'style': style_id, 'name': PREDEFINED_STYLES[style_id]['name'], **future.result()}
+                if line['status'] != 200:
+                    failed += 1
+                yield json.dumps(line) + '\n'
+            yield json.dumps({
+                'done': True,
+                'completed': len(style_ids) - failed,
+                'failed': failed,
+                'elapsed_ms': round((time.monotonic() - started) * 1000),
+            }) + '\n'
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    return Response(stream(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+# What the ASGI server runs: /generate awaits the shared fal backend on the server's event loop, so thousands of
+# pending generations cost a coroutine each; everything else is the Flask app on a pool of WSGI_THREADS threads
+asgi_app = HybridApp(app, {('POST', '/generate'): observed_generate_design}, threads=WSGI_THREADS)
 
 if __name__ == '__main__':
     # Create directories if they don't exist
@@ -213,8 +409,9 @@ if __name__ == '__main__':
     os.makedirs('static/js', exist_ok=True)
     os.makedirs('templates', exist_ok=True)
     
+    health.start()
     print("Starting Interior Design Modification app...")
     print("Open your browser and navigate to http://localhost:5001")
     
-    # Run the Flask app
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    # Run the app on an ASGI server
+    uvicorn.run(asgi_app, host="127.0.0.1", port=5001)
\ No newline at end of file
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import json
+import threading
+
+from metrics import Counter, Gauge
+
+singleflight_calls = Counter(
+    "singleflight_calls_total",
+    "Calls made through a singleflight group, by whether they ran the work (leader) or attached to it (follower)",
+    labelnames=("flight", "role"),
+)
+
+
+def request_key(image, mask, model, prompt, parameters=None):
+    """Content hash identifying a generation request; image and mask may be strings or JSON payloads"""
+    digest = hashlib.sha256()
+    for part in (image or "", mask or "", model or "", prompt or ""):
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True)
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    digest.update(json.dumps(parameters or {}, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = []
+
+    def waiter(self):
+        # Future of the running loop resolved when the call is done, for followers that must not block a thread
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.append((loop, future))
+        return future
+
+    def finish(self):
+        self.done.set()
+        for loop, future in self.waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time.
+    Callers arriving with the key of an in-flight computation wait for it and share its result (or its error).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        Gauge(
+            f"singleflight_{name}_in_flight",
+            f"Computations currently running in the {name} singleflight group",
+            callback=lambda: len(self._calls),
+        )
+
+    def do(self, key, fn):
+        """
+        Run fn() unless a computation for key is already running.
+        Returns (result, shared), shared being True when the result came from another caller's computation.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            singleflight_calls.inc(flight=self.name, role="follower")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        singleflight_calls.inc(flight=self.name, role="leader")
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.finish()
+        return call.result, False
+
+    async def do_async(self, key, fn):
+        """
+        Coroutine equivalent of do(): fn() returns an awaitable, and followers wait without holding a thread.
+        Computations started by do() and do_async() with the same key are shared.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                # Registered under the lock, so the leader cannot finish without resolving it
+                waiter = call.waiter()
+
+        if not leader:
+            singleflight_calls.inc(flight=self.name, role="follower")
+            await waiter
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        singleflight_calls.inc(flight=self.name, role="leader")
+        try:
+            call.result = await fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.finish()
+        return call.result, False
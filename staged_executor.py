@@ -0,0 +1,139 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from metrics import Gauge, Histogram
+
+executor_stage_seconds = Histogram(
+    "executor_stage_seconds",
+    "Time each job spends in a stage of a staged executor, not counting the wait in front of it",
+    labelnames=("executor", "stage"),
+)
+executor_queue_wait_seconds = Histogram(
+    "executor_queue_wait_seconds",
+    "Time each job waits in the queue in front of a stage of a staged executor",
+    labelnames=("executor", "stage"),
+)
+
+
+class Stage:
+    """
+    One step of a staged executor: fn(job) -> job, run by `workers` threads.
+    With use_stream, each worker issues its GPU work on its own CUDA stream.
+    """
+
+    def __init__(self, name, fn, workers=1, use_stream=True):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.use_stream = use_stream
+
+
+def _record_stream(value, stream):
+    # Tensors allocated on another stage's stream must not be reused by the allocator while this stream uses them
+    if isinstance(value, torch.Tensor):
+        if value.is_cuda:
+            value.record_stream(stream)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _record_stream(item, stream)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _record_stream(item, stream)
+
+
+class StagedExecutor:
+    """
+    Runs jobs through a sequence of stages, each with its own worker threads and a bounded queue in front of it, so
+    that different jobs are in different stages at the same time: while one job is being denoised, the next one is
+    text- and VAE-encoded and the previous one decoded.
+
+    On CUDA every worker of a stage with use_stream gets its own stream and synchronizes it before handing the job
+    on, so the next stage only sees finished tensors while the other stages keep running. A full queue blocks the
+    stage feeding it, which bounds the number of jobs (and their tensors) in flight.
+    """
+
+    def __init__(self, name, stages, queue_size=1, device=None):
+        self.name = name
+        self.stages = stages
+        self.device = torch.device(device) if device is not None else None
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._threads = []
+        self._busy = {stage.name: 0 for stage in stages}
+        self._lock = threading.Lock()
+
+        for index, stage in enumerate(stages):
+            Gauge(
+                f"executor_{name}_{stage.name}_queue_depth",
+                f"Jobs waiting for the {stage.name} stage of the {name} executor",
+                callback=lambda q=self._queues[index]: q.qsize(),
+            )
+
+    def start(self):
+        """Start the worker threads of every stage"""
+        if self._threads:
+            return
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index,),
+                    name=f"{self.name}-{stage.name}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, job):
+        """Queue a job for the first stage and return a Future of the output of the last stage"""
+        self.start()
+        future = Future()
+        self._queues[0].put((job, future, time.monotonic()))
+        return future
+
+    def stats(self):
+        """Queue depth and busy workers of every stage"""
+        with self._lock:
+            return {
+                stage.name: {"queued": self._queues[index].qsize(), "busy": self._busy[stage.name]}
+                for index, stage in enumerate(self.stages)
+            }
+
+    def _work(self, index):
+        stage = self.stages[index]
+        stream = None
+        if stage.use_stream and self.device is not None and self.device.type == "cuda":
+            stream = torch.cuda.Stream(self.device)
+
+        while True:
+            job, future, enqueued = self._queues[index].get()
+            # Futures cancelled before the first stage started are dropped
+            if index == 0 and not future.set_running_or_notify_cancel():
+                continue
+            executor_queue_wait_seconds.observe(time.monotonic() - enqueued, executor=self.name, stage=stage.name)
+            with self._lock:
+                self._busy[stage.name] += 1
+            started = time.monotonic()
+            try:
+                if stream is not None:
+                    _record_stream(job, stream)
+                    with torch.cuda.stream(stream):
+                        job = stage.fn(job)
+                    stream.synchronize()
+                else:
+                    job = stage.fn(job)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            finally:
+                executor_stage_seconds.observe(time.monotonic() - started, executor=self.name, stage=stage.name)
+                with self._lock:
+                    self._busy[stage.name] -= 1
+
+            if index + 1 == len(self.stages):
+                future.set_result(job)
+            else:
+                self._queues[index + 1].put((job, future, time.monotonic()))
@@ -48,6 +48,17 @@ document.addEventListener('DOMContentLoaded', function() {
             console.error('Error loading styles:', error);
         });
     
+    // Size and encoding uploads are prepared with, provided by the backend, and whether it accepts /cancel
+    let uploadConfig = { width: 1280, height: 768, resize: 'exact', format: 'image/webp', quality: 0.9 };
+    fetch('/upload-config')
+        .then(response => response.json())
+        .then(config => {
+            uploadConfig = config;
+        })
+        .catch(error => {
+            console.error('Error loading upload config, using defaults:', error);
+        });
+    
     // Handle style selection
     styleSelect.addEventListener('change', function() {
         if (this.value) {
@@ -64,12 +75,15 @@ document.addEventListener('DOMContentLoaded', function() {
     // App state
     let originalImage = null;
     let maskImage = null;
+    let maskPayload = null;  // Compact encoding of maskImage, sent instead of its data URL when available
     let isDrawing = false;
     let lastX = 0;
     let lastY = 0;
     let maskCtx = null;
-    let maskHistory = [];
-    let maskHistoryIndex = -1;
+    let maskStrokes = [];       // Brush strokes of the mask editor, oldest first
+    let maskSnapshots = [];     // Canvas copies taken every MASK_SNAPSHOT_INTERVAL strokes
+    let maskHistoryIndex = 0;   // Number of strokes currently applied
+    let currentStroke = null;
     
     // Initialize mask canvas
     function initMaskCanvas() {
@@ -231,6 +245,7 @@ document.addEventListener('DOMContentLoaded', function() {
         img.onload = function() {
             errorMessage.textContent = "";
             maskImage = img;
+            maskPayload = null;
             maskInput.value = url;
             
             // Show preview of the mask
@@ -255,6 +270,101 @@ document.addEventListener('DOMContentLoaded', function() {
         img.src = url;
     }
     
+    // Decode, orient, downscale and re-encode uploads in a worker when the browser supports OffscreenCanvas
+    const uploadWorker = (typeof Worker !== 'undefined' && typeof OffscreenCanvas !== 'undefined')
+        ? new Worker('/static/js/upload-worker.js')
+        : null;
+    const pendingUploads = new Map();
+    let nextUploadId = 0;
+    
+    if (uploadWorker) {
+        uploadWorker.onmessage = function(e) {
+            const pending = pendingUploads.get(e.data.id);
+            if (!pending) return;
+            pendingUploads.delete(e.data.id);
+            
+            if (e.data.error) {
+                pending.reject(new Error(e.data.error));
+            } else {
+                pending.resolve(e.data);
+            }
+        };
+    }
+    
+    function blobToDataURL(blob) {
+        return new Promise((resolve, reject) => {
+            const reader = new FileReader();
+            reader.onload = () => resolve(reader.result);
+            reader.onerror = () => reject(reader.error);
+            reader.readAsDataURL(blob);
+        });
+    }
+    
+    // Same steps as upload-worker.js on the main thread, for browsers without OffscreenCanvas
+    async function prepareUploadOnMainThread(request) {
+        const bitmap = await createImageBitmap(request.file, { imageOrientation: 'from-image' });
+        let width = request.target.width;
+        let height = request.target.height;
+        if (request.target.resize !== 'exact') {
+            const scale = Math.min(1, width / bitmap.width, height / bitmap.height);
+            width = Math.max(1, Math.round(bitmap.width * scale));
+            height = Math.max(1, Math.round(bitmap.height * scale));
+        }
+        
+        const canvas = document.createElement('canvas');
+        canvas.width = width;
+        canvas.height = height;
+        const ctx = canvas.getContext('2d');
+        ctx.imageSmoothingEnabled = request.kind !== 'mask';
+        ctx.imageSmoothingQuality = 'high';
+        ctx.drawImage(bitmap, 0, 0, width, height);
+        
+        const type = request.kind === 'mask' ? 'image/png' : request.format;
+        let blob = await new Promise(resolve => canvas.toBlob(resolve, type, request.quality));
+        if (blob.type !== type && type === 'image/webp') {
+            blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', request.quality));
+        }
+        
+        const result = { blob: blob, width: width, height: height, sourceWidth: bitmap.width, sourceHeight: bitmap.height };
+        if (request.kind === 'mask') {
+            const pixels = ctx.getImageData(0, 0, width, height).data;
+            result.rle = encodeMaskRLE(maskBitsFromRGBA(pixels), width, height);
+        }
+        bitmap.close();
+        return result;
+    }
+    
+    // Prepare a file for upload at the backend's target size
+    // Masks are sized to match the prepared image so both reach the backend at the same resolution
+    async function prepareUpload(file, kind) {
+        const target = (kind === 'mask' && originalImage)
+            ? { width: originalImage.width, height: originalImage.height, resize: 'exact' }
+            : uploadConfig;
+        const request = {
+            file: file,
+            kind: kind,
+            target: target,
+            format: uploadConfig.format,
+            quality: uploadConfig.quality
+        };
+        
+        let prepared;
+        if (uploadWorker) {
+            request.id = nextUploadId++;
+            prepared = await new Promise((resolve, reject) => {
+                pendingUploads.set(request.id, { resolve: resolve, reject: reject });
+                uploadWorker.postMessage(request);
+            });
+        } else {
+            prepared = await prepareUploadOnMainThread(request);
+        }
+        
+        prepared.dataUrl = await blobToDataURL(prepared.blob);
+        console.log(`Prepared ${kind}: ${prepared.sourceWidth}x${prepared.sourceHeight} (${file.size} bytes) -> ` +
+            `${prepared.width}x${prepared.height} ${prepared.blob.type} (${prepared.blob.size} bytes)`);
+        return prepared;
+    }
+    
     // Handle image upload
     function handleImageUpload(e) {
         const file = e.target.files[0];
@@ -275,50 +385,46 @@ document.addEventListener('DOMContentLoaded', function() {
         // Display a message that the image is loading
         showError("Loading image...");
         
-        const reader = new FileReader();
-        
-        reader.onload = function(event) {
-            console.log("File loaded successfully");
-            const img = new Image();
-            
-            img.onload = function() {
-                console.log("Image loaded with dimensions:", img.width, "x", img.height);
-                errorMessage.textContent = ""; // Clear the loading message
-                
-                originalImage = img;
+        prepareUpload(file, 'image')
+            .then(prepared => {
+                console.log("File prepared successfully");
+                const img = new Image();
                 
-                // Update the image URL input field
-                imageInput.value = event.target.result;
-                
-                // Show preview of the image
-                const previewImg = document.createElement('img');
-                previewImg.src = event.target.result;
-                previewImg.className = 'image-preview';
+                img.onload = function() {
+                    console.log("Image loaded with dimensions:", img.width, "x", img.height);
+                    errorMessage.textContent = ""; // Clear the loading message
+                    
+                    originalImage = img;
+                    
+                    // Update the image URL input field
+                    imageInput.value = prepared.dataUrl;
+                    
+                    // Show preview of the image
+                    const previewImg = document.createElement('img');
+                    previewImg.src = prepared.dataUrl;
+                    previewImg.className = 'image-preview';
+                    
+                    const previewContainer = document.querySelector('.input-field');
+                    const existingPreview = previewContainer.querySelector('.image-preview');
+                    
+                    if (existingPreview) {
+                        previewContainer.replaceChild(previewImg, existingPreview);
+                    } else {
+                        previewContainer.appendChild(previewImg);
+                    }
+                };
                 
-                const previewContainer = document.querySelector('.input-field');
-                const existingPreview = previewContainer.querySelector('.image-preview');
+                img.onerror = function() {
+                    console.error("Error loading image");
+                    showError("Error loading image. Please try a different file.");
+                };
                 
-                if (existingPreview) {
-                    previewContainer.replaceChild(previewImg, existingPreview);
-                } else {
-                    previewContainer.appendChild(previewImg);
-                }
-            };
-            
-            img.onerror = function() {
-                console.error("Error loading image");
-                showError("Error loading image. Please try a different file.");
-            };
-            
-            img.src = event.target.result;
-        };
-        
-        reader.onerror = function() {
-            console.error("Error reading file");
-            showError("Error reading file. Please try again.");
-        };
-        
-        reader.readAsDataURL(file);
+                img.src = prepared.dataUrl;
+            })
+            .catch(error => {
+                console.error("Error preparing image:", error);
+                showError("Error reading file. Please try a different file.");
+            });
     }
     
     // Handle mask upload
@@ -336,50 +442,47 @@ document.addEventListener('DOMContentLoaded', function() {
         // Display a message that the mask is loading
         showError("Loading mask...");
         
-        const reader = new FileReader();
-        
-        reader.onload = function(event) {
-            console.log("Mask file loaded successfully");
-            const img = new Image();
-            
-            img.onload = function() {
-                console.log("Mask loaded with dimensions:", img.width, "x", img.height);
-                errorMessage.textContent = ""; // Clear the loading message
-                
-                maskImage = img;
+        prepareUpload(file, 'mask')
+            .then(prepared => {
+                console.log("Mask file prepared successfully");
+                const img = new Image();
                 
-                // Update the mask URL input field
-                maskInput.value = event.target.result;
-                
-                // Show preview of the mask
-                const previewImg = document.createElement('img');
-                previewImg.src = event.target.result;
-                previewImg.className = 'mask-preview';
+                img.onload = function() {
+                    console.log("Mask loaded with dimensions:", img.width, "x", img.height);
+                    errorMessage.textContent = ""; // Clear the loading message
+                    
+                    maskImage = img;
+                    maskPayload = prepared.rle;
+                    
+                    // Update the mask URL input field
+                    maskInput.value = prepared.dataUrl;
+                    
+                    // Show preview of the mask
+                    const previewImg = document.createElement('img');
+                    previewImg.src = prepared.dataUrl;
+                    previewImg.className = 'mask-preview';
+                    
+                    const previewContainer = document.querySelector('.input-field:nth-child(3)');
+                    const existingPreview = previewContainer.querySelector('.mask-preview');
+                    
+                    if (existingPreview) {
+                        previewContainer.replaceChild(previewImg, existingPreview);
+                    } else {
+                        previewContainer.appendChild(previewImg);
+                    }
+                };
                 
-                const previewContainer = document.querySelector('.input-field:nth-child(3)');
-                const existingPreview = previewContainer.querySelector('.mask-preview');
+                img.onerror = function() {
+                    console.error("Error loading mask image");
+                    showError("Error loading mask image. Please try a different file.");
+                };
                 
-                if (existingPreview) {
-                    previewContainer.replaceChild(previewImg, existingPreview);
-                } else {
-                    previewContainer.appendChild(previewImg);
-                }
-            };
-            
-            img.onerror = function() {
-                console.error("Error loading mask image");
-                showError("Error loading mask image. Please try a different file.");
-            };
-            
-            img.src = event.target.result;
-        };
-        
-        reader.onerror = function() {
-            console.error("Error reading mask file");
-            showError("Error reading mask file. Please try again.");
-        };
-        
-        reader.readAsDataURL(file);
+                img.src = prepared.dataUrl;
+            })
+            .catch(error => {
+                console.error("Error preparing mask:", error);
+                showError("Error reading mask file. Please try again.");
+            });
     }
     
     // Open mask editor
@@ -430,12 +533,8 @@ document.addEventListener('DOMContentLoaded', function() {
         maskCtx.textAlign = 'center';
         maskCtx.fillText('Draw on areas you want to modify', width/2, 30);
         
-        // Reset the history for undo/redo
-        maskHistory = [];
-        maskHistoryIndex = -1;
-        
-        // Save the initial state
-        saveMaskState();
+        // Reset the history for undo/redo, with the initial state as its base
+        resetMaskHistory();
     }
     
     // Close mask editor
@@ -450,6 +549,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const rect = maskCanvas.getBoundingClientRect();
         lastX = e.clientX - rect.left;
         lastY = e.clientY - rect.top;
+        beginStroke(lastX, lastY);
     }
     
     function handleTouchStart(e) {
@@ -459,35 +559,28 @@ document.addEventListener('DOMContentLoaded', function() {
         const touch = e.touches[0];
         lastX = touch.clientX - rect.left;
         lastY = touch.clientY - rect.top;
+        beginStroke(lastX, lastY);
     }
     
-    function draw(e) {
-        if (!isDrawing) return;
-        
-        const rect = maskCanvas.getBoundingClientRect();
-        const currentX = e.clientX - rect.left;
-        const currentY = e.clientY - rect.top;
-        
+    // Draw a round brush segment by stamping circles along the path
+    function drawBrushSegment(fromX, fromY, toX, toY, brushRadius) {
         // Make sure we're using a bright red color that's easily detectable
         maskCtx.fillStyle = '#FF0000';  // Pure bright red
         
-        // Draw a circle at each point along the path for consistent roundness
-        const brushRadius = parseInt(brushSize.value) / 2;
-        
         // Calculate points along the path for smoother brush
-        const dist = Math.sqrt(Math.pow(currentX - lastX, 2) + Math.pow(currentY - lastY, 2));
-        const angle = Math.atan2(currentY - lastY, currentX - lastX);
+        const dist = Math.sqrt(Math.pow(toX - fromX, 2) + Math.pow(toY - fromY, 2));
+        const angle = Math.atan2(toY - fromY, toX - fromX);
         
         // For very small movements, just draw a circle
         if (dist < brushRadius/2) {
             maskCtx.beginPath();
-            maskCtx.arc(currentX, currentY, brushRadius, 0, Math.PI * 2);
+            maskCtx.arc(toX, toY, brushRadius, 0, Math.PI * 2);
             maskCtx.fill();
         } else {
             // For longer movements, draw circles along the path
             for (let i = 0; i < dist; i += brushRadius/2) {
-                const x = lastX + Math.cos(angle) * i;
-                const y = lastY + Math.sin(angle) * i;
+                const x = fromX + Math.cos(angle) * i;
+                const y = fromY + Math.sin(angle) * i;
                 maskCtx.beginPath();
                 maskCtx.arc(x, y, brushRadius, 0, Math.PI * 2);
                 maskCtx.fill();
@@ -495,14 +588,26 @@ document.addEventListener('DOMContentLoaded', function() {
             
             // Always draw at the current position
             maskCtx.beginPath();
-            maskCtx.arc(currentX, currentY, brushRadius, 0, Math.PI * 2);
+            maskCtx.arc(toX, toY, brushRadius, 0, Math.PI * 2);
             maskCtx.fill();
         }
+    }
+    
+    function drawTo(currentX, currentY) {
+        drawBrushSegment(lastX, lastY, currentX, currentY, currentStroke.radius);
+        currentStroke.points.push(currentX, currentY);
         
         lastX = currentX;
         lastY = currentY;
     }
     
+    function draw(e) {
+        if (!isDrawing) return;
+        
+        const rect = maskCanvas.getBoundingClientRect();
+        drawTo(e.clientX - rect.left, e.clientY - rect.top);
+    }
+    
     function handleTouchMove(e) {
         e.preventDefault();
         
@@ -510,48 +615,13 @@ document.addEventListener('DOMContentLoaded', function() {
         
         const rect = maskCanvas.getBoundingClientRect();
         const touch = e.touches[0];
-        const currentX = touch.clientX - rect.left;
-        const currentY = touch.clientY - rect.top;
-        
-        // Make sure we're using a bright red color that's easily detectable
-        maskCtx.fillStyle = '#FF0000';  // Pure bright red
-        
-        // Draw with perfect round brush effect (same as mouse drawing)
-        const brushRadius = parseInt(brushSize.value) / 2;
-        
-        // Calculate points along the path for smoother brush
-        const dist = Math.sqrt(Math.pow(currentX - lastX, 2) + Math.pow(currentY - lastY, 2));
-        const angle = Math.atan2(currentY - lastY, currentX - lastX);
-        
-        // For very small movements, just draw a circle
-        if (dist < brushRadius/2) {
-            maskCtx.beginPath();
-            maskCtx.arc(currentX, currentY, brushRadius, 0, Math.PI * 2);
-            maskCtx.fill();
-        } else {
-            // For longer movements, draw circles along the path
-            for (let i = 0; i < dist; i += brushRadius/2) {
-                const x = lastX + Math.cos(angle) * i;
-                const y = lastY + Math.sin(angle) * i;
-                maskCtx.beginPath();
-                maskCtx.arc(x, y, brushRadius, 0, Math.PI * 2);
-                maskCtx.fill();
-            }
-            
-            // Always draw at the current position
-            maskCtx.beginPath();
-            maskCtx.arc(currentX, currentY, brushRadius, 0, Math.PI * 2);
-            maskCtx.fill();
-        }
-        
-        lastX = currentX;
-        lastY = currentY;
+        drawTo(touch.clientX - rect.left, touch.clientY - rect.top);
     }
     
     function stopDrawing() {
         if (isDrawing) {
             isDrawing = false;
-            saveMaskState();
+            commitStroke();
         }
     }
     
@@ -574,25 +644,74 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // Save mask state for undo/redo
-    function saveMaskState() {
-        // Remove any states after the current index if we're in the middle of the history
-        if (maskHistoryIndex < maskHistory.length - 1) {
-            maskHistory = maskHistory.slice(0, maskHistoryIndex + 1);
+    // Mask history is a log of brush strokes plus a canvas snapshot every MASK_SNAPSHOT_INTERVAL strokes
+    // Undo restores the nearest snapshot and replays at most MASK_SNAPSHOT_INTERVAL - 1 strokes, so its cost does not
+    // depend on how long the history is; redo replays a single stroke
+    const MASK_SNAPSHOT_INTERVAL = 10;
+    const MASK_HISTORY_LIMIT = 100;  // Strokes kept for undo, a multiple of MASK_SNAPSHOT_INTERVAL
+    
+    function snapshotMaskCanvas() {
+        const snapshot = document.createElement('canvas');
+        snapshot.width = maskCanvas.width;
+        snapshot.height = maskCanvas.height;
+        snapshot.getContext('2d').drawImage(maskCanvas, 0, 0);
+        return snapshot;
+    }
+    
+    // Start a new history whose base is the current canvas
+    function resetMaskHistory() {
+        maskStrokes = [];
+        maskSnapshots = [snapshotMaskCanvas()];
+        maskHistoryIndex = 0;
+        updateUndoRedoButtons();
+    }
+    
+    function beginStroke(x, y) {
+        currentStroke = { radius: parseInt(brushSize.value) / 2, points: [x, y] };
+    }
+    
+    // Record the finished stroke for undo/redo
+    function commitStroke() {
+        const stroke = currentStroke;
+        currentStroke = null;
+        
+        // A click without movement draws nothing
+        if (!stroke || stroke.points.length < 4) return;
+        
+        // Drawing after an undo discards the undone strokes and the snapshots taken after them
+        if (maskHistoryIndex < maskStrokes.length) {
+            maskStrokes.length = maskHistoryIndex;
+            maskSnapshots.length = Math.floor(maskHistoryIndex / MASK_SNAPSHOT_INTERVAL) + 1;
+        }
+        
+        maskStrokes.push(stroke);
+        maskHistoryIndex = maskStrokes.length;
+        if (maskHistoryIndex % MASK_SNAPSHOT_INTERVAL === 0) {
+            maskSnapshots.push(snapshotMaskCanvas());
         }
         
-        // Add current state to history
-        maskHistory.push(maskCanvas.toDataURL());
-        maskHistoryIndex = maskHistory.length - 1;
+        // Forget the oldest strokes, the next snapshot becomes the base of the history
+        if (maskStrokes.length > MASK_HISTORY_LIMIT) {
+            maskStrokes.splice(0, MASK_SNAPSHOT_INTERVAL);
+            maskSnapshots.shift();
+            maskHistoryIndex -= MASK_SNAPSHOT_INTERVAL;
+        }
         
         // Enable/disable undo/redo buttons
         updateUndoRedoButtons();
     }
     
+    function replayStroke(stroke) {
+        const points = stroke.points;
+        for (let i = 2; i < points.length; i += 2) {
+            drawBrushSegment(points[i - 2], points[i - 1], points[i], points[i + 1], stroke.radius);
+        }
+    }
+    
     // Update undo/redo buttons based on history state
     function updateUndoRedoButtons() {
         undoBtn.disabled = maskHistoryIndex <= 0;
-        redoBtn.disabled = maskHistoryIndex >= maskHistory.length - 1 || maskHistory.length === 0;
+        redoBtn.disabled = maskHistoryIndex >= maskStrokes.length;
     }
     
     // Undo last mask edit
@@ -605,177 +724,266 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Redo last undone mask edit
     function redoMaskEdit() {
-        if (maskHistoryIndex < maskHistory.length - 1) {
+        if (maskHistoryIndex < maskStrokes.length) {
+            replayStroke(maskStrokes[maskHistoryIndex]);
             maskHistoryIndex++;
-            restoreMaskState();
+            updateUndoRedoButtons();
         }
     }
     
-    // Restore mask state from history
+    // Restore the canvas to maskHistoryIndex strokes: nearest snapshot, then replay the strokes after it
     function restoreMaskState() {
-        if (maskHistory.length === 0 || maskHistoryIndex < 0) return;
+        const snapshotIndex = Math.floor(maskHistoryIndex / MASK_SNAPSHOT_INTERVAL);
+        maskCtx.clearRect(0, 0, maskCanvas.width, maskCanvas.height);
+        maskCtx.drawImage(maskSnapshots[snapshotIndex], 0, 0);
         
-        const img = new Image();
-        img.onload = function() {
-            maskCtx.clearRect(0, 0, maskCanvas.width, maskCanvas.height);
-            maskCtx.drawImage(img, 0, 0);
-            updateUndoRedoButtons();
-        };
-        img.src = maskHistory[maskHistoryIndex];
+        for (let i = snapshotIndex * MASK_SNAPSHOT_INTERVAL; i < maskHistoryIndex; i++) {
+            replayStroke(maskStrokes[i]);
+        }
+        updateUndoRedoButtons();
     }
     
-    // Download the mask
-    function downloadMask() {
-        // Create a new canvas to extract just the mask (white areas)
-        const extractedMaskCanvas = document.createElement('canvas');
-        extractedMaskCanvas.width = maskCanvas.width;
-        extractedMaskCanvas.height = maskCanvas.height;
-        const extractedMaskCtx = extractedMaskCanvas.getContext('2d');
-        
-        // Fill with black (transparent areas in the final mask)
-        extractedMaskCtx.fillStyle = 'black';
-        extractedMaskCtx.fillRect(0, 0, extractedMaskCanvas.width, extractedMaskCanvas.height);
-        
-        // Get the data from the editor canvas
-        const imageData = maskCtx.getImageData(0, 0, maskCanvas.width, maskCanvas.height);
-        const data = imageData.data;
-        
-        // Create a new ImageData for the extracted mask
-        const extractedData = extractedMaskCtx.createImageData(maskCanvas.width, maskCanvas.height);
-        const extractedDataArray = extractedData.data;
-        
-        // Detect red brush strokes (our mask color is red)
-        for (let i = 0; i < data.length; i += 4) {
-            // If the pixel is predominantly red (R > G+B significantly)
-            // Using a more relaxed threshold to better detect our red marks
-            if (data[i] > 200 && data[i] > (data[i+1] * 2) && data[i] > (data[i+2] * 2)) {
-                extractedDataArray[i] = 255;     // R
-                extractedDataArray[i+1] = 255;   // G
-                extractedDataArray[i+2] = 255;   // B
-                extractedDataArray[i+3] = 255;   // A
+    // Extract masks in a worker when the browser supports OffscreenCanvas
+    const maskWorker = (typeof Worker !== 'undefined' && typeof OffscreenCanvas !== 'undefined')
+        ? new Worker('/static/js/mask-worker.js')
+        : null;
+    const pendingMasks = new Map();
+    let nextMaskId = 0;
+    
+    if (maskWorker) {
+        maskWorker.onmessage = function(e) {
+            const pending = pendingMasks.get(e.data.id);
+            if (!pending) return;
+            pendingMasks.delete(e.data.id);
+            
+            if (e.data.error) {
+                pending.reject(new Error(e.data.error));
             } else {
-                extractedDataArray[i] = 0;       // R
-                extractedDataArray[i+1] = 0;     // G
-                extractedDataArray[i+2] = 0;     // B
-                extractedDataArray[i+3] = 255;   // A
+                pending.resolve(e.data);
+            }
+        };
+    }
+    
+    // Same pass as mask-worker.js on the main thread, for browsers without OffscreenCanvas
+    async function extractMaskOnMainThread(imageData, outWidth, outHeight) {
+        const { width, height } = imageData;
+        const source = new Uint8ClampedArray(imageData.data.buffer);
+        const maskPixels = new ImageData(width, height);
+        const overlayPixels = new ImageData(width, height);
+        const mask = maskPixels.data;
+        const overlay = overlayPixels.data;
+        let masked = 0;
+        
+        for (let i = 0; i < source.length; i += 4) {
+            const isMasked = source[i] > 200 && source[i] > source[i+1] * 2 && source[i] > source[i+2] * 2;
+            const value = isMasked ? 255 : 0;
+            mask[i] = mask[i+1] = mask[i+2] = value;
+            mask[i+3] = 255;
+            if (isMasked) {
+                overlay[i] = 255;
+                overlay[i+3] = 153;  // Red at 60% opacity
+                masked++;
             }
         }
         
-        // Apply the extracted data to the canvas
-        extractedMaskCtx.putImageData(extractedData, 0, 0);
+        const maskCanvasSmall = document.createElement('canvas');
+        maskCanvasSmall.width = width;
+        maskCanvasSmall.height = height;
+        maskCanvasSmall.getContext('2d').putImageData(maskPixels, 0, 0);
+        
+        const output = document.createElement('canvas');
+        output.width = outWidth;
+        output.height = outHeight;
+        const outputCtx = output.getContext('2d');
+        outputCtx.imageSmoothingEnabled = false;
+        outputCtx.drawImage(maskCanvasSmall, 0, 0, outWidth, outHeight);
+        
+        const overlayCanvas = document.createElement('canvas');
+        overlayCanvas.width = width;
+        overlayCanvas.height = height;
+        overlayCanvas.getContext('2d').putImageData(overlayPixels, 0, 0);
+        
+        const maskBlob = await new Promise(resolve => output.toBlob(resolve, 'image/png'));
+        const bits = maskBitsFromRGBA(outputCtx.getImageData(0, 0, outWidth, outHeight).data);
+        const rle = encodeMaskRLE(bits, outWidth, outHeight);
+        return { mask: maskBlob, rle: rle, overlay: overlayCanvas, masked: masked };
+    }
+    
+    // Turn the red strokes on the editor canvas into a black and white PNG mask at the uploaded image size,
+    // along with a red overlay for previewing it
+    function extractMask() {
+        const imageData = maskCtx.getImageData(0, 0, maskCanvas.width, maskCanvas.height);
+        const outWidth = originalImage ? originalImage.width : maskCanvas.width;
+        const outHeight = originalImage ? originalImage.height : maskCanvas.height;
         
-        // Create a download link
-        const link = document.createElement('a');
-        link.download = 'mask.png';
-        link.href = extractedMaskCanvas.toDataURL('image/png');
-        link.click();
+        if (!maskWorker) {
+            return extractMaskOnMainThread(imageData, outWidth, outHeight);
+        }
+        
+        const id = nextMaskId++;
+        return new Promise((resolve, reject) => {
+            pendingMasks.set(id, { resolve: resolve, reject: reject });
+            maskWorker.postMessage({
+                id: id,
+                pixels: imageData.data.buffer,
+                width: imageData.width,
+                height: imageData.height,
+                outWidth: outWidth,
+                outHeight: outHeight
+            }, [imageData.data.buffer]);
+        });
+    }
+    
+    // Download the mask
+    function downloadMask() {
+        extractMask()
+            .then(result => {
+                // Create a download link
+                const link = document.createElement('a');
+                link.download = 'mask.png';
+                link.href = URL.createObjectURL(result.mask);
+                link.click();
+                setTimeout(() => URL.revokeObjectURL(link.href), 0);
+            })
+            .catch(error => {
+                console.error("Error extracting mask:", error);
+                showError("Error creating mask. Please try again.");
+            });
     }
     
     // Apply the created mask to the main app
     function applyMask() {
-        // Create a new canvas to extract just the mask (white areas)
-        const extractedMaskCanvas = document.createElement('canvas');
-        extractedMaskCanvas.width = maskCanvas.width;
-        extractedMaskCanvas.height = maskCanvas.height;
-        const extractedMaskCtx = extractedMaskCanvas.getContext('2d');
-        
-        // Fill with black (transparent areas in the final mask)
-        extractedMaskCtx.fillStyle = 'black';
-        extractedMaskCtx.fillRect(0, 0, extractedMaskCanvas.width, extractedMaskCanvas.height);
-        
-        // Get the data from the editor canvas
-        const imageData = maskCtx.getImageData(0, 0, maskCanvas.width, maskCanvas.height);
-        const data = imageData.data;
-        
-        // Create a new ImageData for the extracted mask
-        const extractedData = extractedMaskCtx.createImageData(maskCanvas.width, maskCanvas.height);
-        const extractedDataArray = extractedData.data;
-        
-        // Detect red brush strokes (our mask color is red)
-        for (let i = 0; i < data.length; i += 4) {
-            // If the pixel is predominantly red (R > G+B significantly)
-            // Using a more relaxed threshold to better detect our red marks
-            if (data[i] > 200 && data[i] > (data[i+1] * 2) && data[i] > (data[i+2] * 2)) {
-                extractedDataArray[i] = 255;     // R
-                extractedDataArray[i+1] = 255;   // G
-                extractedDataArray[i+2] = 255;   // B
-                extractedDataArray[i+3] = 255;   // A
-            } else {
-                extractedDataArray[i] = 0;       // R
-                extractedDataArray[i+1] = 0;     // G
-                extractedDataArray[i+2] = 0;     // B
-                extractedDataArray[i+3] = 255;   // A
+        useMaskBtn.disabled = true;
+        const editorState = maskCtx.getImageData(0, 0, maskCanvas.width, maskCanvas.height);
+        
+        extractMask()
+            .then(result => {
+                // Preview the mask over the original image: two composited draws on a canvas of its own,
+                // shown in the mask preview once the editor closes
+                const previewCanvas = document.createElement('canvas');
+                previewCanvas.width = maskCanvas.width;
+                previewCanvas.height = maskCanvas.height;
+                const previewCtx = previewCanvas.getContext('2d');
+                previewCtx.drawImage(originalImage, 0, 0, maskCanvas.width, maskCanvas.height);
+                previewCtx.drawImage(result.overlay, 0, 0);
+                if (result.overlay.close) {
+                    result.overlay.close();
+                }
+                console.log(`Mask covers ${result.masked} editor pixels, ${result.rle.data.length} bytes encoded`);
+                maskPayload = result.rle;
+                return Promise.all([
+                    blobToDataURL(result.mask),
+                    new Promise(resolve => previewCanvas.toBlob(resolve, 'image/jpeg', 0.85))
+                ]);
+            })
+            .then(([dataUrl, previewBlob]) => {
+                const previewUrl = URL.createObjectURL(previewBlob);
+                
+                // Update the mask image and input
+                maskImage = new Image();
+                maskImage.onload = function() {
+                    // Update the mask URL input field
+                    maskInput.value = dataUrl;
+                    
+                    // Show the mask over the image
+                    const previewImg = document.createElement('img');
+                    previewImg.src = previewUrl;
+                    previewImg.className = 'mask-preview';
+                    
+                    const previewContainer = document.querySelector('.input-field:nth-child(3)');
+                    const existingPreview = previewContainer.querySelector('.mask-preview');
+                    
+                    if (existingPreview) {
+                        if (existingPreview.src.startsWith('blob:')) {
+                            URL.revokeObjectURL(existingPreview.src);
+                        }
+                        previewContainer.replaceChild(previewImg, existingPreview);
+                    } else {
+                        previewContainer.appendChild(previewImg);
+                    }
+                    
+                    console.log("Mask created and applied:", maskImage.width, "x", maskImage.height);
+                    
+                    // Restore the editor view and close the mask editor
+                    maskCtx.putImageData(editorState, 0, 0);
+                    useMaskBtn.disabled = false;
+                    closeMaskEditor();
+                };
+                maskImage.src = dataUrl;
+            })
+            .catch(error => {
+                console.error("Error applying mask:", error);
+                maskCtx.putImageData(editorState, 0, 0);
+                useMaskBtn.disabled = false;
+                showError("Error creating mask. Please try again.");
+            });
+    }
+    
+    // Identifies this browser to the servers' per-client quotas
+    const clientId = (() => {
+        try {
+            let id = localStorage.getItem('clientId');
+            if (!id) {
+                id = Math.random().toString(36).slice(2) + Date.now().toString(36);
+                localStorage.setItem('clientId', id);
             }
+            return id;
+        } catch (e) {
+            return Math.random().toString(36).slice(2);
         }
+    })();
+    
+    // Request id of the generation in progress, so that it can be cancelled when the page is closed
+    let pendingRequestId = null;
+    
+    window.addEventListener('pagehide', () => {
+        if (pendingRequestId && uploadConfig.cancellation && navigator.sendBeacon) {
+            const body = new Blob([JSON.stringify({ request_id: pendingRequestId })], { type: 'application/json' });
+            navigator.sendBeacon('/cancel', body);
+        }
+    });
+    
+    const MAX_BUSY_RETRIES = 3;
+    const MAX_RETRY_DELAY_SECONDS = 120;
+    
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+    
+    // POST to /generate, waiting and retrying as told by Retry-After when the server is busy (429/503)
+    async function postGenerate(body, attempt) {
+        const response = await fetch('/generate', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Client-Id': clientId
+            },
+            body: body
+        });
         
-        // Apply the extracted data to the canvas
-        extractedMaskCtx.putImageData(extractedData, 0, 0);
-        
-        // Preview the mask before applying
-        const tempPreviewCanvas = document.createElement('canvas');
-        tempPreviewCanvas.width = maskCanvas.width;
-        tempPreviewCanvas.height = maskCanvas.height;
-        const tempCtx = tempPreviewCanvas.getContext('2d');
-        
-        // Draw original image
-        tempCtx.drawImage(originalImage, 0, 0, maskCanvas.width, maskCanvas.height);
-        
-        // Overlay the mask with semi-transparency
-        tempCtx.globalAlpha = 0.6;
-        tempCtx.fillStyle = 'red';
-        
-        // Get mask data
-        const maskImageData = extractedMaskCtx.getImageData(0, 0, maskCanvas.width, maskCanvas.height);
-        const maskData = maskImageData.data;
-        
-        // Draw red overlay only where mask is white
-        for (let i = 0; i < maskData.length; i += 4) {
-            if (maskData[i] > 200) { // If white in mask
-                // Calculate position
-                const pixelIndex = i / 4;
-                const x = pixelIndex % maskCanvas.width;
-                const y = Math.floor(pixelIndex / maskCanvas.width);
-                
-                tempCtx.fillRect(x, y, 1, 1);
+        if ((response.status === 429 || response.status === 503) && response.headers.has('Retry-After')
+                && attempt < MAX_BUSY_RETRIES) {
+            const retryAfter = Math.min(parseInt(response.headers.get('Retry-After'), 10) || 5, MAX_RETRY_DELAY_SECONDS);
+            const loadingMessage = document.getElementById('loadingMessage');
+            for (let remaining = retryAfter; remaining > 0; remaining--) {
+                loadingMessage.textContent = `Server is busy, retrying in ${remaining}s...`;
+                await sleep(1000);
             }
+            loadingMessage.textContent = 'Generating your new design...';
+            return postGenerate(body, attempt + 1);
         }
         
-        // Show preview briefly
-        const currentCanvas = maskCtx.getImageData(0, 0, maskCanvas.width, maskCanvas.height);
-        maskCtx.drawImage(tempPreviewCanvas, 0, 0);
-        
-        // Store the generated mask after a brief preview
-        setTimeout(() => {
-            // Restore the original view
-            maskCtx.putImageData(currentCanvas, 0, 0);
-            
-            // Update the mask image and input
-            maskImage = new Image();
-            maskImage.onload = function() {
-                // Update the mask URL input field
-                maskInput.value = maskImage.src;
-                
-                // Show preview of the mask
-                const previewImg = document.createElement('img');
-                previewImg.src = maskImage.src;
-                previewImg.className = 'mask-preview';
-                
-                const previewContainer = document.querySelector('.input-field:nth-child(3)');
-                const existingPreview = previewContainer.querySelector('.mask-preview');
-                
-                if (existingPreview) {
-                    previewContainer.replaceChild(previewImg, existingPreview);
-                } else {
-                    previewContainer.appendChild(previewImg);
-                }
-                
-                console.log("Mask created and applied:", maskImage.src);
-                
-                // Close the mask editor
-                closeMaskEditor();
-            };
-            maskImage.src = extractedMaskCanvas.toDataURL('image/png');
-        }, 1500);
+        if (!response.ok) {
+            let message = 'Network response was not ok';
+            try {
+                const data = await response.json();
+                message = data.error || message;
+            } catch (e) {
+                // Keep the generic message for non-JSON errors
+            }
+            throw new Error(message);
+        }
+        return response.json();
     }
     
     // Generate design
@@ -818,26 +1026,22 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Prepare the image and mask data
         const imageData = imageInput.value;
-        const maskData = maskInput.value;
+        const maskData = maskPayload || maskInput.value;
         
         // Send data to server
-        fetch('/generate', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                image: imageData,
-                mask: maskData,
-                prompt: customPrompt,
-                style: selectedStyle
-            })
-        })
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('Network response was not ok');
+        const requestId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+        pendingRequestId = requestId;
+        postGenerate(JSON.stringify({
+            image: imageData,
+            mask: maskData,
+            prompt: customPrompt,
+            style: selectedStyle,
+            request_id: requestId
+        }), 0)
+        .finally(() => {
+            if (pendingRequestId === requestId) {
+                pendingRequestId = null;
             }
-            return response.json();
         })
         .then(data => {
             // Display result
@@ -883,6 +1087,7 @@ document.addEventListener('DOMContentLoaded', function() {
         // Reset state
         originalImage = null;
         maskImage = null;
+        maskPayload = null;
         
         // Clear previews
         const previews = document.querySelectorAll('.image-preview, .mask-preview');
@@ -0,0 +1,66 @@
+// Compact wire format for binary inpainting masks, decoded by mask_codec.py on the servers
+// { encoding: 'rle-v1', width, height, data }: data is the base64 of the row-major run lengths as unsigned LEB128
+// varints, alternating unmasked and masked runs and starting with an unmasked run (which may be empty)
+
+// Threshold RGBA pixels into one byte per pixel, 1 where the red channel is above half (masks are black and white)
+function maskBitsFromRGBA(rgba) {
+    const bits = new Uint8Array(rgba.length / 4);
+    for (let i = 0, j = 0; j < bits.length; i += 4, j++) {
+        bits[j] = rgba[i] > 127 ? 1 : 0;
+    }
+    return bits;
+}
+
+// Nearest-neighbour resample of a one byte per pixel mask
+function resampleMaskBits(bits, width, height, outWidth, outHeight) {
+    if (width === outWidth && height === outHeight) {
+        return bits;
+    }
+
+    const columns = new Uint32Array(outWidth);
+    for (let x = 0; x < outWidth; x++) {
+        columns[x] = Math.min(width - 1, Math.floor((x + 0.5) * width / outWidth));
+    }
+
+    const out = new Uint8Array(outWidth * outHeight);
+    for (let y = 0; y < outHeight; y++) {
+        const sourceRow = Math.min(height - 1, Math.floor((y + 0.5) * height / outHeight)) * width;
+        const outRow = y * outWidth;
+        for (let x = 0; x < outWidth; x++) {
+            out[outRow + x] = bits[sourceRow + columns[x]];
+        }
+    }
+    return out;
+}
+
+function encodeMaskRLE(bits, width, height) {
+    const bytes = [];
+    const pushVarint = value => {
+        while (value >= 0x80) {
+            bytes.push((value & 0x7f) | 0x80);
+            value = Math.floor(value / 128);
+        }
+        bytes.push(value);
+    };
+
+    let current = 0;
+    let run = 0;
+    for (let i = 0; i < bits.length; i++) {
+        if (bits[i] === current) {
+            run++;
+        } else {
+            pushVarint(run);
+            current = bits[i];
+            run = 1;
+        }
+    }
+    pushVarint(run);
+
+    // btoa takes a binary string; build it in chunks to stay under argument limits
+    let binary = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        binary += String.fromCharCode.apply(null, bytes.slice(i, i + 0x8000));
+    }
+
+    return { encoding: 'rle-v1', width: width, height: height, data: btoa(binary) };
+}
@@ -0,0 +1,87 @@
+// Web Worker that turns the mask editor canvas into a black and white mask and a red preview overlay
+// Request:  { id, pixels (RGBA ArrayBuffer, transferred), width, height, outWidth, outHeight }
+// Response: { id, mask (PNG Blob at outWidth x outHeight), rle (compact mask at outWidth x outHeight),
+//             overlay (ImageBitmap at width x height), masked } or { id, error }
+
+importScripts('/static/js/mask-codec.js');
+
+// Pixels are read and written as 32-bit words; canvas memory is RGBA bytes, so on little-endian machines a word
+// is 0xAABBGGRR
+const LITTLE_ENDIAN = new Uint8Array(new Uint32Array([1]).buffer)[0] === 1;
+
+function rgba(r, g, b, a) {
+    return LITTLE_ENDIAN
+        ? ((a << 24) | (b << 16) | (g << 8) | r) >>> 0
+        : ((r << 24) | (g << 16) | (b << 8) | a) >>> 0;
+}
+
+const MASK_ON = rgba(255, 255, 255, 255);
+const MASK_OFF = rgba(0, 0, 0, 255);
+const OVERLAY_ON = rgba(255, 0, 0, 153);  // Red at 60% opacity
+const OVERLAY_OFF = 0;
+
+// One pass over the editor pixels: brush strokes are predominantly red (R > 200 and R > 2G and R > 2B)
+function extract(pixels, width, height) {
+    const source = new Uint32Array(pixels);
+    const mask = new Uint32Array(width * height);
+    const overlay = new Uint32Array(width * height);
+    const bits = new Uint8Array(width * height);
+    let masked = 0;
+
+    for (let i = 0; i < source.length; i++) {
+        const word = source[i];
+        const r = LITTLE_ENDIAN ? word & 0xff : word >>> 24;
+        const g = LITTLE_ENDIAN ? (word >>> 8) & 0xff : (word >>> 16) & 0xff;
+        const b = LITTLE_ENDIAN ? (word >>> 16) & 0xff : (word >>> 8) & 0xff;
+
+        if (r > 200 && r > g * 2 && r > b * 2) {
+            mask[i] = MASK_ON;
+            overlay[i] = OVERLAY_ON;
+            bits[i] = 1;
+            masked++;
+        } else {
+            mask[i] = MASK_OFF;
+            overlay[i] = OVERLAY_OFF;
+        }
+    }
+    return { mask: mask, overlay: overlay, bits: bits, masked: masked };
+}
+
+async function render(request) {
+    const width = request.width;
+    const height = request.height;
+    const result = extract(request.pixels, width, height);
+
+    // Preview overlay at editor size, composited over the photo by the caller with one drawImage
+    const overlayCanvas = new OffscreenCanvas(width, height);
+    overlayCanvas.getContext('2d').putImageData(
+        new ImageData(new Uint8ClampedArray(result.overlay.buffer), width, height), 0, 0
+    );
+    const overlay = overlayCanvas.transferToImageBitmap();
+
+    // Mask at upload size, scaled without smoothing to keep hard edges
+    const maskCanvas = new OffscreenCanvas(width, height);
+    maskCanvas.getContext('2d').putImageData(
+        new ImageData(new Uint8ClampedArray(result.mask.buffer), width, height), 0, 0
+    );
+    let output = maskCanvas;
+    if (request.outWidth !== width || request.outHeight !== height) {
+        output = new OffscreenCanvas(request.outWidth, request.outHeight);
+        const ctx = output.getContext('2d');
+        ctx.imageSmoothingEnabled = false;
+        ctx.drawImage(maskCanvas, 0, 0, request.outWidth, request.outHeight);
+    }
+    const mask = await output.convertToBlob({ type: 'image/png' });
+
+    // Same mask in the compact wire format, resampled the same way
+    const bits = resampleMaskBits(result.bits, width, height, request.outWidth, request.outHeight);
+    const rle = encodeMaskRLE(bits, request.outWidth, request.outHeight);
+
+    return { id: request.id, mask: mask, rle: rle, overlay: overlay, masked: result.masked };
+}
+
+self.onmessage = function(e) {
+    render(e.data)
+        .then(result => self.postMessage(result, [result.overlay]))
+        .catch(error => self.postMessage({ id: e.data.id, error: error.message || String(error) }));
+};
@@ -0,0 +1,72 @@
+// Web Worker that decodes, orients, downscales and re-encodes uploads off the main thread
+// Request:  { id, file, kind: 'image' | 'mask', target: { width, height, resize }, format, quality }
+// Response: { id, blob, width, height, sourceWidth, sourceHeight, rle (masks only) } or { id, error }
+
+importScripts('/static/js/mask-codec.js');
+
+// Size the image to the backend's target bucket
+// "exact" stretches to the bucket (the backend resizes to it anyway), "contain" fits inside it keeping the aspect ratio
+function targetSize(sourceWidth, sourceHeight, target) {
+    if (target.resize === 'exact') {
+        return { width: target.width, height: target.height };
+    }
+
+    const scale = Math.min(1, target.width / sourceWidth, target.height / sourceHeight);
+    return {
+        width: Math.max(1, Math.round(sourceWidth * scale)),
+        height: Math.max(1, Math.round(sourceHeight * scale))
+    };
+}
+
+async function encode(canvas, type, quality) {
+    const blob = await canvas.convertToBlob({ type: type, quality: quality });
+
+    // Browsers without a WebP encoder silently return PNG, fall back to JPEG for photos
+    if (blob.type !== type && type === 'image/webp') {
+        return canvas.convertToBlob({ type: 'image/jpeg', quality: quality });
+    }
+    return blob;
+}
+
+async function prepare(request) {
+    // Apply the EXIF orientation while decoding so phone photos come out upright
+    const bitmap = await createImageBitmap(request.file, { imageOrientation: 'from-image' });
+    const size = targetSize(bitmap.width, bitmap.height, request.target);
+
+    const canvas = new OffscreenCanvas(size.width, size.height);
+    const ctx = canvas.getContext('2d');
+
+    if (request.kind === 'mask') {
+        // Keep mask edges hard and encode losslessly
+        ctx.imageSmoothingEnabled = false;
+    } else {
+        ctx.imageSmoothingEnabled = true;
+        ctx.imageSmoothingQuality = 'high';
+    }
+    ctx.drawImage(bitmap, 0, 0, size.width, size.height);
+
+    const type = request.kind === 'mask' ? 'image/png' : request.format;
+    const blob = await encode(canvas, type, request.quality);
+
+    const result = {
+        id: request.id,
+        blob: blob,
+        width: size.width,
+        height: size.height,
+        sourceWidth: bitmap.width,
+        sourceHeight: bitmap.height
+    };
+    if (request.kind === 'mask') {
+        // Masks are sent in the compact wire format, the PNG is only used for the preview
+        const pixels = ctx.getImageData(0, 0, size.width, size.height).data;
+        result.rle = encodeMaskRLE(maskBitsFromRGBA(pixels), size.width, size.height);
+    }
+    bitmap.close();
+    return result;
+}
+
+self.onmessage = function(e) {
+    prepare(e.data)
+        .then(result => self.postMessage(result))
+        .catch(error => self.postMessage({ id: e.data.id, error: error.message || String(error) }));
+};
@@ -0,0 +1,45 @@
+# fal model used for custom prompts; predefined styles name their own
+DEFAULT_FAL_MODEL = "fal-ai/ideogram/v3/edit"
+
+# fal models that restyle the whole image and take no mask
+MASKLESS_FAL_MODELS = {"fal-ai/flux/dev/image-to-image"}
+
+# Predefined styles with carefully crafted prompts, shared by every backend.
+# "model" is the fal model for the style; the local pipeline inpaints every style with FLUX.
+PREDEFINED_STYLES = {
+    "modern": {
+        "name": "Modern",
+        "prompt": "Transform this area into a sleek modern design with clean lines, neutral colors, minimalist furniture, and subtle lighting. Use contemporary materials like glass, metal, and polished surfaces. Maintain a spacious and uncluttered look.",
+        "model": "fal-ai/ideogram/v3/edit"
+    },
+    "scandinavian": {
+        "name": "Scandinavian",
+        "prompt": "Convert this space into a bright Scandinavian style with white walls, light wooden floors, simple functional furniture, and plenty of natural light. Include cozy textiles, muted colors, and touches of greenery for warmth.",
+        "model": "fal-ai/ideogram/v3/edit"
+    },
+    "industrial": {
+        "name": "Industrial",
+        "prompt": "Redesign this area with industrial aesthetics featuring exposed brick walls, metal fixtures, weathered wood, and vintage furniture. Add Edison bulbs, open shelving, and raw materials like concrete and steel to create an urban warehouse feel.",
+        "model": "fal-ai/ideogram/v3/edit"
+    },
+    "mid_century": {
+        "name": "Mid-Century Modern",
+        "prompt": "Transform this space into a mid-century modern design with iconic furniture shapes, warm wood tones, bold geometric patterns, and pops of color. Include tapered legs, functional forms, and retro-inspired decor from the 1950s-60s era.",
+        "model": "fal-ai/ideogram/v3/edit"
+    },
+    "indian": {
+        "name": "Indian Traditional",
+        "prompt": "Redesign this space with rich Indian traditional decor featuring vibrant textiles, intricate patterns, wooden carved furniture, and warm colors like deep reds, oranges, and golds. Add brass accents, decorative pillows, ornate details, archways, and traditional Indian artwork or tapestries.",
+        "model": "fal-ai/flux/dev/image-to-image"
+    },
+    "bohemian": {
+        "name": "Bohemian",
+        "prompt": "Transform this area with bohemian style featuring layered textiles, eclectic patterns, mixed furniture, macramé, and plenty of plants. Include global-inspired elements, vibrant colors, natural materials, and artistic touches for a free-spirited atmosphere.",
+        "model": "fal-ai/flux/dev/image-to-image"
+    },
+    "luxury": {
+        "name": "Luxury",
+        "prompt": "Redesign this space with opulent luxury featuring plush velvet furniture, crystal chandeliers, marble surfaces, and gold accents. Create a sophisticated palette with rich colors, symmetrical arrangements, and high-end finishes for an elegant, refined ambiance.",
+        "model": "fal-ai/flux/dev/image-to-image"
+    }
+}
@@ -0,0 +1,63 @@
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+from backends import BackendBusy, BackendError, BackendRejected, HybridRouter, LocalHTTPBackend, StubBackend
+from health import HealthMonitor
+from mask_codec import encode_mask
+
+MASK = encode_mask(2, 2, [0, 255, 255, 0])
+
+
+def local_backend(status, payload=None, headers=None):
+    """A LocalHTTPBackend whose local.py answers every generation with status"""
+    backend = LocalHTTPBackend("http://local.test")
+    backend.client = httpx.Client(transport=httpx.MockTransport(
+        lambda request: httpx.Response(status, json=payload or {"error": f"status {status}"}, headers=headers)
+    ))
+    return backend
+
+
+def hybrid(local):
+    health = HealthMonitor(lambda: {}, ignored_errors=(BackendBusy, BackendRejected))
+    return HybridRouter(local, StubBackend("fal", concurrency=8, latency=0.0), health), health
+
+
+def test_local_result():
+    backend = local_backend(200, {"result_url": "data:image/png;base64,AA=="})
+    assert backend.generate("image", MASK, "prompt", None) == "data:image/png;base64,AA=="
+
+
+@pytest.mark.parametrize("status, error", [
+    (400, BackendRejected),
+    (409, BackendRejected),
+    (413, BackendRejected),
+    (499, BackendRejected),
+    (504, BackendRejected),
+    (429, BackendBusy),
+    (503, BackendBusy),
+    (500, BackendError),
+    (502, BackendError),
+])
+def test_local_statuses(status, error):
+    with pytest.raises(error):
+        local_backend(status, headers={"Retry-After": "3"}).generate("image", MASK, "prompt", None)
+
+
+@pytest.mark.parametrize("status", [413, 400, 504])
+def test_rejected_requests_fall_back_without_opening_the_local_circuit(status):
+    router, health = hybrid(local_backend(status))
+    for _ in range(10):
+        assert router.generate("image", MASK, "prompt", None)[1] == "fal"
+
+    assert health.breaker("local").state == "closed"
+    assert router.stats()["local"]["routed"] == 10
+
+
+def test_server_errors_open_the_local_circuit():
+    router, health = hybrid(local_backend(500))
+    for _ in range(10):
+        assert router.generate("image", MASK, "prompt", None)[1] == "fal"
+
+    assert health.breaker("local").state == "open"
+    assert router.stats()["local"]["routed"] < 10
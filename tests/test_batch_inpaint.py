@@ -0,0 +1,62 @@
+import json
+
+from batch_inpaint import BUCKETS, nearest_bucket, read_manifest, read_progress, row_seed
+
+
+def test_read_jsonl_manifest(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    rows = [
+        {"image": "a.png", "mask": "a-mask.png", "prompt": "oak floors"},
+        {"image": "b.png", "mask": "b-mask.png", "style": "modern", "id": "kitchen", "seed": 7},
+        {"image": "c.png", "mask": "c-mask.png", "prompt": "tiles", "id": 0},
+    ]
+    path.write_text("\n".join(json.dumps(row) for row in rows) + "\n\n")
+
+    manifest = read_manifest(str(path))
+
+    assert [row["id"] for row in manifest] == ["0", "kitchen", "0"]
+    assert manifest[1]["style"] == "modern"
+    assert manifest[1]["seed"] == 7
+
+
+def test_read_csv_manifest(tmp_path):
+    path = tmp_path / "manifest.csv"
+    path.write_text("id,image,mask,prompt,seed\n,a.png,a-mask.png,oak floors,\nliving,b.png,b-mask.png,tiles,0\n")
+
+    manifest = read_manifest(str(path))
+
+    assert [row["id"] for row in manifest] == ["0", "living"]
+    assert manifest[0]["prompt"] == "oak floors"
+    assert [row_seed(row, 24) for row in manifest] == [24, 0]
+
+
+def test_row_seed():
+    assert row_seed({}, 24) == 24
+    assert row_seed({"seed": None}, 24) == 24
+    assert row_seed({"seed": ""}, 24) == 24
+    assert row_seed({"seed": 0}, 24) == 0
+    assert row_seed({"seed": "0"}, 24) == 0
+    assert row_seed({"seed": "7"}, 24) == 7
+
+
+def test_read_progress(tmp_path):
+    path = tmp_path / "progress.jsonl"
+    assert read_progress(str(path)) == set()
+
+    records = [
+        {"id": "0", "status": "ok", "output": "0.png"},
+        {"id": "1", "status": "error", "error": "Error loading inputs"},
+        {"id": "2", "status": "ok", "output": "2.png"},
+    ]
+    path.write_text("\n".join(json.dumps(record) for record in records) + "\n")
+
+    assert read_progress(str(path)) == {"0", "2"}
+
+
+def test_nearest_bucket():
+    assert nearest_bucket(4000, 4000) == (1024, 1024)
+    assert nearest_bucket(1920, 1080) == (1344, 768)
+    assert nearest_bucket(3024, 4032) == (896, 1152)
+    assert nearest_bucket(100, 1000) == (640, 1536)
+    for width, height in BUCKETS:
+        assert nearest_bucket(width, height) == (width, height)
@@ -0,0 +1,141 @@
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from block_profiler import BlockProfiler, estimate_block_flops
+from transformer_flux import FluxSingleTransformerBlock, FluxSparseTokenCache, FluxTransformerBlock
+
+DIM = 8
+
+
+class TinyDoubleBlock(FluxTransformerBlock):
+    """A Flux double block reduced to one linear layer per stream, so that it runs instantly on the CPU"""
+
+    def __init__(self):
+        torch.nn.Module.__init__(self)
+        self.proj = torch.nn.Linear(DIM, DIM)
+        self.proj_context = torch.nn.Linear(DIM, DIM)
+
+    def forward(self, hidden_states, encoder_hidden_states, temb, image_rotary_emb=None):
+        return self.proj_context(encoder_hidden_states), self.proj(hidden_states)
+
+
+class TinySingleBlock(FluxSingleTransformerBlock):
+    def __init__(self):
+        torch.nn.Module.__init__(self)
+        self.proj = torch.nn.Linear(DIM, DIM)
+
+    def forward(self, hidden_states, temb, image_rotary_emb=None, sparse_cache=None, block_index=None):
+        return self.proj(hidden_states)
+
+
+class TinyTransformer(torch.nn.Module):
+    def __init__(self, double=2, single=3):
+        super().__init__()
+        self.transformer_blocks = torch.nn.ModuleList(TinyDoubleBlock() for _ in range(double))
+        self.single_transformer_blocks = torch.nn.ModuleList(TinySingleBlock() for _ in range(single))
+
+    def forward(self, hidden_states, encoder_hidden_states, sparse_cache=None):
+        for block in self.transformer_blocks:
+            encoder_hidden_states, hidden_states = block(
+                hidden_states=hidden_states, encoder_hidden_states=encoder_hidden_states, temb=None
+            )
+        hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+        if sparse_cache is not None:
+            sparse_cache.begin_pass(encoder_hidden_states.shape[1])
+            hidden_states, _ = sparse_cache.gather(hidden_states, None)
+        for index, block in enumerate(self.single_transformer_blocks):
+            hidden_states = block(hidden_states=hidden_states, temb=None, sparse_cache=sparse_cache, block_index=index)
+        return hidden_states
+
+
+def inputs(batch_size=2, image_tokens=16, text_tokens=4):
+    return torch.randn(batch_size, image_tokens, DIM), torch.randn(batch_size, text_tokens, DIM)
+
+
+def test_estimate_block_flops():
+    hidden_states, encoder_hidden_states = inputs()
+    joint = torch.randn(2, 20, DIM)
+
+    assert estimate_block_flops(TinyDoubleBlock(), hidden_states, encoder_hidden_states) == 2 * (
+        24 * 20 * DIM**2 + 4 * 20 * 20 * DIM + 24 * DIM**2
+    )
+    assert estimate_block_flops(TinySingleBlock(), joint) == 2 * (24 * 20 * DIM**2 + 4 * 20 * 20 * DIM + 6 * DIM**2)
+    assert estimate_block_flops(torch.nn.Linear(DIM, DIM), joint) == 0
+
+
+def test_sparse_passes_attend_to_every_token():
+    hidden_states, encoder_hidden_states = inputs()
+    image_token_mask = torch.zeros(16, dtype=torch.bool)
+    image_token_mask[:4] = True
+    cache = FluxSparseTokenCache(image_token_mask)
+    # The first pass refreshes the cache and runs every token; the second only the 4 text and 4 masked image tokens
+    cache.hidden_states = torch.zeros(1)
+
+    model = TinyTransformer(double=0, single=1)
+    with BlockProfiler().attach(model, "transformer") as profiler:
+        model(hidden_states, encoder_hidden_states, sparse_cache=cache)
+
+    record, = profiler.records
+    assert record["flops"] == 2 * (24 * 8 * DIM**2 + 4 * 8 * 20 * DIM + 6 * DIM**2)
+
+
+def test_records_every_block_of_every_step():
+    model = TinyTransformer()
+    profiler = BlockProfiler().attach(model, "transformer")
+    for _ in range(2):
+        model(*inputs())
+    profiler.detach()
+    model(*inputs())
+
+    assert not profiler.attached
+    assert len(profiler.records) == 2 * 5
+    assert [record["step"] for record in profiler.records] == [0] * 5 + [1] * 5
+    assert [(record["stack"], record["block"]) for record in profiler.records[:5]] == [
+        ("transformer_blocks", 0),
+        ("transformer_blocks", 1),
+        ("single_transformer_blocks", 0),
+        ("single_transformer_blocks", 1),
+        ("single_transformer_blocks", 2),
+    ]
+    double = profiler.records[0]
+    # Both streams of the double block: 2 x 16 image and 2 x 4 text tokens of DIM float32
+    assert double["activation_bytes"] == (2 * 16 + 2 * 4) * DIM * 4
+    assert double["peak_memory_delta"] is None
+
+
+def test_summary_and_chrome_trace(tmp_path):
+    model = TinyTransformer()
+    with BlockProfiler() as profiler:
+        profiler.attach(model, "transformer")
+        model(*inputs())
+        model(*inputs())
+
+    rows = profiler.summary_rows()
+    assert len(rows) == 5
+    assert all(row["calls"] == 2 for row in rows)
+    assert [row["total_ms"] for row in rows] == sorted((row["total_ms"] for row in rows), reverse=True)
+    assert sum(row["share"] for row in rows) == pytest.approx(1.0)
+    table = profiler.summary(limit=2).splitlines()
+    assert len(table) == 2 + 2
+    assert table[0].split()[:2] == ["model", "block"]
+
+    path = tmp_path / "blocks.json"
+    profiler.export_chrome_trace(str(path))
+    trace = json.loads(path.read_text())
+    metadata = [event for event in trace["traceEvents"] if event["ph"] == "M"]
+    events = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert metadata == [{"name": "thread_name", "ph": "M", "pid": 0, "tid": 0, "args": {"name": "transformer"}}]
+    assert len(events) == 10
+    assert events[0]["name"] == "transformer_blocks.0"
+    assert events[0]["args"]["step"] == 0 and events[-1]["args"]["step"] == 1
+    assert all(event["dur"] >= 0 for event in events)
+
+
+def test_attaching_a_name_twice_is_an_error():
+    profiler = BlockProfiler().attach(TinyTransformer(), "transformer")
+    with pytest.raises(ValueError):
+        profiler.attach(TinyTransformer(), "transformer")
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from backends import BackendError
+from fake_fal import FakeFal
+from fal_backend import FalBackend, FalBackendBusy
+
+
+@pytest.fixture
+def fake():
+    with FakeFal(latency=0.2) as fake:
+        yield fake
+
+
+def make_backend(fake, **kwargs):
+    return FalBackend(queue_url=fake.url, key="test", poll_interval=0.02, **kwargs)
+
+
+def test_subscribe_returns_result_and_logs(fake):
+    backend = make_backend(fake)
+    # The loop thread only starts with the first generation
+    assert backend.loop is None
+    logs = []
+    try:
+        result = backend.subscribe("fal-ai/flux/dev/image-to-image", {"prompt": "oak floors"}, on_log=logs.append)
+        assert backend.loop is not None
+    finally:
+        backend.close()
+
+    assert result["images"][0]["url"] == fake.result_url
+    assert fake.submitted == [("fal-ai/flux/dev/image-to-image", {"prompt": "oak floors"})]
+    assert logs[-1] == "fal-ai/flux/dev/image-to-image completed"
+    assert backend.pending == 0
+
+
+def test_failed_status_raises_backend_error(fake):
+    fake.failure_rate = 1.0
+    backend = make_backend(fake)
+    try:
+        with pytest.raises(BackendError, match="ERROR"):
+            backend.subscribe("fal-ai/ideogram/v3/edit", {"prompt": "grey sofa"})
+    finally:
+        backend.close()
+
+
+def test_per_model_concurrency_limits(fake):
+    backend = make_backend(fake, model_concurrency={"fal-ai/ideogram/v3/edit": 2, "fal-ai/flux/dev/image-to-image": 3})
+    try:
+        futures = [
+            backend.submit(model, {"prompt": str(index)})
+            for model in ("fal-ai/ideogram/v3/edit", "fal-ai/flux/dev/image-to-image")
+            for index in range(6)
+        ]
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        backend.close()
+
+    assert fake.max_active == {"fal-ai/ideogram/v3/edit": 2, "fal-ai/flux/dev/image-to-image": 3}
+
+
+def test_pending_generations_are_bounded(fake):
+    backend = make_backend(fake, max_pending=2)
+    try:
+        futures = [backend.submit("fal-ai/ideogram/v3/edit", {"prompt": str(index)}) for index in range(2)]
+        with pytest.raises(FalBackendBusy):
+            backend.submit("fal-ai/ideogram/v3/edit", {"prompt": "one too many"})
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        backend.close()
+
+
+def test_thousands_of_pending_generations_share_one_thread(fake):
+    fake.latency = 0.05
+    backend = make_backend(fake, default_concurrency=100, max_pending=1000)
+    try:
+        futures = [backend.submit("fal-ai/test/model", {"prompt": str(index)}) for index in range(1000)]
+        # One loop thread for all of them, at most 100 running remotely at a time
+        assert [thread.name for thread in threading.enumerate()].count("fal-backend") == 1
+        assert backend.pending == 1000
+        for future in futures:
+            assert future.result(timeout=60)["images"]
+    finally:
+        backend.close()
+
+    assert fake.max_active == {"fal-ai/test/model": 100}
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("httpx")
+
+from loadtest import percentile, summarize
+
+
+def test_percentile_is_nearest_rank():
+    values = [0.1, 0.2, 0.3, 0.4]
+    assert percentile(values, 0.50) == 0.2
+    assert percentile(values, 0.95) == 0.4
+    assert percentile([], 0.5) is None
+
+
+def test_summarize():
+    # (operation, status, latency in seconds, response bytes)
+    results = [
+        ("generate", 200, 1.0, 100),
+        ("generate", 200, 2.0, 300),
+        ("generate", 503, 0.01, 50),
+        ("styles", 200, 0.005, 1000),
+    ]
+    summary = summarize(results, elapsed=2.0)
+
+    assert summary["overall"] == {
+        "requests": 4,
+        "ok": 3,
+        "statuses": {"200": 3, "503": 1},
+        "throughput_rps": 2.0,
+        "ok_throughput_rps": 1.5,
+        "p50_ms": 10.0,
+        "p95_ms": 2000.0,
+        "p99_ms": 2000.0,
+        "max_ms": 2000.0,
+        "mean_response_bytes": 362,
+    }
+    assert sorted(summary["operations"]) == ["generate", "styles"]
+    generate = summary["operations"]["generate"]
+    assert (generate["requests"], generate["ok"], generate["p50_ms"]) == (3, 2, 1000.0)
+    assert generate["statuses"] == {"200": 2, "503": 1}
+    assert summary["operations"]["styles"]["p99_ms"] == 5.0
+
+
+def test_summarize_without_time_or_results():
+    assert summarize([], elapsed=0)["overall"]["throughput_rps"] is None
+    assert summarize([], elapsed=1)["overall"]["p50_ms"] is None
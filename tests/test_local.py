@@ -0,0 +1,95 @@
+import base64
+import importlib
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("flask_cors")
+Image = pytest.importorskip("PIL.Image")
+
+from mask_codec import encode_mask
+
+
+def png(width, height):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (128, 128, 128)).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+@pytest.fixture(scope="module")
+def local():
+    """local.py with the stub pipeline, slow enough to cancel a generation while it runs"""
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv("LOCAL_PIPELINE", "stub")
+        env.setenv("STUB_LOCAL_LATENCY", "0.5")
+        env.setenv("LOCAL_CONCURRENCY", "2")
+        sys.modules.pop("local", None)
+        local = importlib.import_module("local")
+        local.pipe = None
+        local.load_model().jitter = 0.0
+        yield local
+        sys.modules.pop("local", None)
+
+
+def payload(request_id, prompt="oak floors"):
+    return {
+        "image": png(64, 48),
+        "mask": encode_mask(4, 3, [0, 255, 255, 0] * 3),
+        "prompt": prompt,
+        "request_id": request_id,
+    }
+
+
+def post(local, path, body):
+    with local.app.test_client() as client:
+        return client.post(path, json=body)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_generate(local):
+    response = post(local, "/generate", payload("plain", prompt="walnut floors"))
+
+    assert response.status_code == 200
+    assert response.get_json()["result_url"].startswith("data:image/png;base64,")
+
+
+def test_identical_requests_share_one_generation(local):
+    with ThreadPoolExecutor(3) as pool:
+        responses = list(pool.map(
+            lambda request_id: post(local, "/generate", payload(request_id, prompt="shared")), ["s1", "s2", "s3"]
+        ))
+
+    assert [response.status_code for response in responses] == [200] * 3
+
+
+def test_cancelled_request_alone_is_stopped(local):
+    with ThreadPoolExecutor(1) as pool:
+        pending = pool.submit(post, local, "/generate", payload("alone", prompt="cancel me"))
+        wait_for(lambda: local.cancellations.stats()["requests"] == 1)
+        assert post(local, "/cancel", {"request_id": "alone"}).get_json() == {"cancelled": True}
+
+        assert pending.result().status_code == 499
+
+
+def test_identical_request_after_a_cancellation_gets_its_own_generation(local):
+    # The cancelled generation keeps running until its next check; an identical request arriving meanwhile must not
+    # be handed its 499
+    with ThreadPoolExecutor(2) as pool:
+        cancelled = pool.submit(post, local, "/generate", payload("first", prompt="same"))
+        wait_for(lambda: local.cancellations.stats()["requests"] == 1)
+        assert post(local, "/cancel", {"request_id": "first"}).get_json() == {"cancelled": True}
+        second = pool.submit(post, local, "/generate", payload("second", prompt="same"))
+
+        assert cancelled.result().status_code == 499
+        assert second.result().status_code == 200
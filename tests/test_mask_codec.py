@@ -0,0 +1,27 @@
+import pytest
+
+from mask_codec import decode_mask, encode_mask, validate_mask
+
+
+def test_round_trip():
+    pixels = bytearray([0, 255, 255, 0, 0, 255])
+    assert decode_mask(encode_mask(3, 2, pixels)) == (3, 2, pixels)
+    assert validate_mask(encode_mask(3, 2, pixels)) is None
+
+
+@pytest.mark.parametrize("mask", [None, "data:image/png;base64,iVBORw0KGgo=", "https://example.com/mask.png"])
+def test_images_and_absent_masks_are_left_to_the_caller(mask):
+    assert validate_mask(mask) is None
+
+
+@pytest.mark.parametrize("mask", [
+    {"width": 3, "height": 2, "data": encode_mask(3, 2, [0] * 6)["data"]},
+    dict(encode_mask(1, 1, [0]), width=True),
+    dict(encode_mask(1, 1, [0]), height=True),
+    dict(encode_mask(3, 2, [0] * 6), width=4),
+    dict(encode_mask(3, 2, [0] * 6), data="not base64!"),
+    [0, 255],
+    42,
+])
+def test_malformed_masks_are_rejected(mask):
+    assert validate_mask(mask).startswith("Invalid mask")
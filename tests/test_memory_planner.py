@@ -0,0 +1,130 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from memory_planner import MemoryPlanner, MemoryPlanRejected, downscale_buckets, phase_features
+
+GiB = 2**30
+COMPONENTS = {"transformer": 10 * GiB, "controlnet": 2 * GiB, "vae": 1 * GiB}
+# Activations: 1 KiB per VAE pixel, 1 MiB per denoising token, no squared term, no constants
+COEFFICIENTS = {
+    "vae_encode": [1024.0, 0.0],
+    "denoise": [2.0**20, 0.0, 0.0],
+    "vae_decode": [1024.0, 0.0],
+}
+
+
+def planner(**kwargs):
+    return MemoryPlanner(COMPONENTS, COEFFICIENTS, **kwargs)
+
+
+def test_phase_features():
+    assert phase_features("vae_encode", 64, 32, 2, False, 512) == [2 * 64 * 32, 1.0]
+    tokens = 4 * 2 + 512
+    assert phase_features("denoise", 64, 32, 2, True, 512) == [4 * tokens, 4 * tokens * tokens, 1.0]
+    with pytest.raises(ValueError):
+        phase_features("upscale", 64, 64, 1, False, 512)
+
+
+def test_estimate_adds_resident_weights_to_activations():
+    estimate = planner().estimate(1024, 1024, text_length=0)
+
+    assert estimate["vae_encode"] == 13 * GiB + 1024 * 1024 * 1024
+    assert estimate["denoise"] == 13 * GiB + 4096 * 2**20
+    assert estimate["peak"] == estimate["denoise"]
+
+
+def test_estimate_follows_the_offload_mode():
+    model = planner(offload="model").estimate(1024, 1024, text_length=0)
+    sequential = planner(offload="sequential").estimate(1024, 1024, text_length=0)
+
+    assert model["vae_decode"] == 1 * GiB + GiB
+    assert model["denoise"] == 12 * GiB + 4 * GiB
+    assert sequential["denoise"] == 4 * GiB
+
+
+def test_estimate_of_runs_sharing_the_device():
+    alone = planner().estimate(1024, 1024, text_length=0)
+    concurrent = planner().estimate(1024, 1024, text_length=0, concurrent_runs=3)
+    staged = planner().estimate(1024, 1024, text_length=0, staged=True)
+
+    assert concurrent["denoise"] == alone["denoise"]
+    assert concurrent["peak"] == 13 * GiB + 3 * 4 * GiB
+    assert staged["peak"] == 13 * GiB + 4 * GiB + 2 * GiB
+
+
+def test_plan_keeps_requests_that_fit():
+    plan = planner().plan(1024, 1024, batch_size=2, text_length=0, budget=30 * GiB)
+    assert (plan["width"], plan["height"], plan["batch_size"]) == (1024, 1024, 2)
+
+
+def test_plan_reduces_the_batch_then_the_resolution():
+    reduced_batch = planner().plan(1024, 1024, batch_size=4, text_length=0, budget=22 * GiB)
+    downscaled = planner().plan(1024, 1024, batch_size=2, text_length=0, budget=16 * GiB)
+
+    assert (reduced_batch["width"], reduced_batch["height"], reduced_batch["batch_size"]) == (1024, 1024, 2)
+    assert downscaled["batch_size"] == 1
+    assert (downscaled["width"], downscaled["height"]) in downscale_buckets(1024, 1024)[1:]
+    assert downscaled["estimate"]["peak"] <= 16 * GiB
+
+
+def test_plan_rejects_what_never_fits():
+    with pytest.raises(MemoryPlanRejected) as rejected:
+        planner().plan(1024, 1024, text_length=0, budget=12 * GiB)
+    assert rejected.value.estimate["peak"] > 12 * GiB
+
+
+def test_plan_without_budget_returns_the_request():
+    plan = planner().plan(1024, 768, batch_size=3, text_length=0)
+    assert (plan["width"], plan["height"], plan["batch_size"]) == (768, 1024, 3)
+
+
+def measurement(height, width, batch_size, cfg, baseline, coefficients, offload_weights=0):
+    """A measured run whose activations follow coefficients exactly"""
+    peaks = {}
+    for phase, values in coefficients.items():
+        features = phase_features(phase, height, width, batch_size, cfg, 512)
+        peaks[phase] = baseline + offload_weights + int(sum(c * f for c, f in zip(values, features)))
+    return {
+        "height": height,
+        "width": width,
+        "batch_size": batch_size,
+        "do_classifier_free_guidance": cfg,
+        "text_length": 512,
+        "baseline": baseline,
+        "peaks": peaks,
+    }
+
+
+def test_calibrate_recovers_the_coefficients():
+    truth = {
+        "vae_encode": [1500.0, 300 * 2**20],
+        "denoise": [90_000.0, 4.0, 600 * 2**20],
+        "vae_decode": [4000.0, 200 * 2**20],
+    }
+    measurements = [
+        measurement(height, width, batch_size, cfg, 13 * GiB, truth)
+        for height, width in ((512, 512), (768, 768), (1024, 1024), (768, 1280))
+        for batch_size in (1, 2)
+        for cfg in (False, True)
+    ]
+    calibrated = MemoryPlanner(COMPONENTS).calibrate(measurements)
+
+    for phase, values in truth.items():
+        assert calibrated.coefficients[phase] == pytest.approx(values, rel=1e-3)
+
+
+def test_calibrate_keeps_defaults_without_enough_measurements():
+    planner = MemoryPlanner(COMPONENTS, COEFFICIENTS)
+    planner.calibrate([measurement(512, 512, 1, False, 0, COEFFICIENTS)])
+    assert planner.coefficients["denoise"] == COEFFICIENTS["denoise"]
+
+
+def test_calibrate_clamps_negative_costs():
+    # Activations shrinking with size are noise, not savings
+    measurements = [
+        measurement(size, size, 1, False, 0, {"vae_encode": [-1.0, GiB]}) for size in (512, 768, 1024)
+    ]
+    calibrated = MemoryPlanner(COMPONENTS).calibrate(measurements)
+    assert calibrated.coefficients["vae_encode"][0] == 0.0
@@ -0,0 +1,92 @@
+import importlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("flask")
+
+from admission import AdmissionController
+from mask_codec import encode_mask
+
+IMAGE = "data:image/png;base64,iVBORw0KGgo="
+MASK = encode_mask(2, 2, [0, 255, 255, 0])
+
+
+@pytest.fixture
+def routed(monkeypatch):
+    """router.py with stub backends: one local slot and no local queue, so that overflow goes to fal"""
+    monkeypatch.setenv("ROUTER_BACKENDS", "stub")
+    monkeypatch.setenv("LOCAL_CONCURRENCY", "1")
+    monkeypatch.setenv("LOCAL_MAX_QUEUE", "0")
+    monkeypatch.setenv("STUB_LOCAL_LATENCY", "0.3")
+    monkeypatch.setenv("STUB_FAL_LATENCY", "0.3")
+    sys.modules.pop("router", None)
+    router = importlib.import_module("router")
+    yield router
+    sys.modules.pop("router", None)
+
+
+def post(router, payload, client_id="test-client"):
+    with router.app.test_client() as client:
+        return client.post("/generate", json=payload, headers={"X-Client-Id": client_id})
+
+
+def post_all(router, payloads):
+    """POST the payloads concurrently, each as its own client"""
+    with ThreadPoolExecutor(len(payloads)) as pool:
+        return list(pool.map(post, [router] * len(payloads), payloads, [f"client-{i}" for i in range(len(payloads))]))
+
+
+def test_overflow_and_unmasked_requests_go_to_fal(routed):
+    responses = post_all(routed, [{"image": IMAGE, "mask": MASK, "prompt": f"design {i}"} for i in range(3)])
+    unmasked = post(routed, {"image": IMAGE, "prompt": "no mask"})
+
+    assert [response.status_code for response in responses] == [200] * 3
+    assert sorted(response.get_json()["backend"] for response in responses) == ["fal", "fal", "local"]
+    assert unmasked.status_code == 200
+    assert unmasked.get_json()["backend"] == "fal"
+    stats = routed.router.stats()
+    assert stats["local"]["routed"] == 1
+    assert stats["fal"]["routed"] == 3
+
+
+def test_local_failure_falls_back_to_fal(routed):
+    routed.local_backend.failure_rate = 1.0
+    response = post(routed, {"image": IMAGE, "mask": MASK, "prompt": "oak floors"})
+
+    assert response.status_code == 200
+    assert response.get_json()["backend"] == "fal"
+    stats = routed.router.stats()
+    assert stats["local"]["routed"] == 1
+    assert stats["fal"]["routed"] == 1
+
+
+def test_admission_rejects_with_retry_after(routed):
+    routed.admission = AdmissionController(
+        "router_test", concurrency=1, max_queue=0, expected_duration=1.0, client_quota=1
+    )
+    first = threading.Thread(target=post, args=(routed, {"image": IMAGE, "prompt": "holds the slot"}, "owner"))
+    first.start()
+    try:
+        deadline = time.monotonic() + 5
+        while routed.admission.running == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        over_quota = post(routed, {"image": IMAGE, "prompt": "second from owner"}, "owner")
+        saturated = post(routed, {"image": IMAGE, "prompt": "from another client"}, "other")
+    finally:
+        first.join()
+
+    assert over_quota.status_code == 429
+    assert saturated.status_code == 503
+    for response in (over_quota, saturated):
+        assert int(response.headers["Retry-After"]) >= 1
+        assert response.get_json()["retry_after"] == int(response.headers["Retry-After"])
+
+
+def test_uploads_keep_their_aspect_ratio_for_fal(routed):
+    with routed.app.test_client() as client:
+        config = client.get("/upload-config").get_json()
+    assert config["resize"] == "contain"
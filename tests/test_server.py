@@ -0,0 +1,158 @@
+import asyncio
+import importlib
+import json
+import sys
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("flask")
+pytest.importorskip("a2wsgi")
+pytest.importorskip("uvicorn")
+
+from fake_fal import FakeFal
+from fal_backend import FalBackend
+from mask_codec import encode_mask
+
+IMAGE = "data:image/png;base64,iVBORw0KGgo="
+
+
+@pytest.fixture(scope="module")
+def served(tmp_path_factory):
+    """server.py pointed at a fake fal queue API, with inputs kept in a local asset store"""
+    with FakeFal(latency=0.2) as fake, pytest.MonkeyPatch.context() as env:
+        env.setenv("ASSET_STORE", "local")
+        env.setenv("LOCAL_ASSET_DIR", str(tmp_path_factory.mktemp("assets")))
+        sys.modules.pop("server", None)
+        server = importlib.import_module("server")
+        server.fal_backend = FalBackend(queue_url=fake.url, key="test", poll_interval=0.02)
+        # Admission estimates waits from the fake's latency rather than fal's
+        server.FAL_EXPECTED_LATENCY = fake.latency
+        try:
+            yield server, fake
+        finally:
+            server.fal_backend.close()
+            sys.modules.pop("server", None)
+
+
+def post_all(server, payloads, clients=None):
+    """POST the payloads to /generate concurrently, as the given client ids or all as one client"""
+    clients = clients or [None] * len(payloads)
+
+    async def post():
+        transport = httpx.ASGITransport(app=server.asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await asyncio.gather(*[
+                client.post("/generate", json=payload, headers={"X-Client-Id": client_id} if client_id else None)
+                for payload, client_id in zip(payloads, clients)
+            ])
+    return asyncio.run(post())
+
+
+def test_generate_awaits_fal(served):
+    server, fake = served
+    response, = post_all(server, [{"image": IMAGE, "prompt": "oak floors"}])
+
+    assert response.status_code == 200
+    assert response.json() == {"result_url": fake.result_url}
+    model, arguments = fake.submitted[-1]
+    assert model == "fal-ai/ideogram/v3/edit"
+    assert arguments["prompt"] == "oak floors"
+    assert arguments["image_url"].startswith(server.LOCAL_ASSET_BASE_URL)
+
+
+def test_more_pending_generations_than_wsgi_threads(served):
+    server, fake = served
+    # Distinct clients, so that no per-client quota applies
+    count = server.WSGI_THREADS + 8
+    responses = post_all(
+        server,
+        [{"image": IMAGE, "prompt": f"design {index}"} for index in range(count)],
+        clients=[f"client-{index}" for index in range(count)],
+    )
+
+    assert [response.status_code for response in responses] == [200] * count
+
+
+def test_identical_requests_share_one_generation(served):
+    server, fake = served
+    submitted = len(fake.submitted)
+    responses = post_all(server, [{"image": IMAGE, "prompt": "shared"}] * 3)
+
+    assert [response.status_code for response in responses] == [200] * 3
+    assert len(fake.submitted) == submitted + 1
+
+
+def test_fal_failure_is_an_error(served):
+    server, fake = served
+    fake.failure_rate = 1.0
+    try:
+        response, = post_all(server, [{"image": IMAGE, "prompt": "fails"}])
+    finally:
+        fake.failure_rate = 0.0
+
+    assert response.status_code == 500
+    assert "fake failure" in response.json()["error"]
+
+
+def test_invalid_requests_are_rejected(served):
+    server, _ = served
+    mask = encode_mask(2, 2, [0, 255, 255, 0])
+    responses = post_all(server, [
+        {"prompt": "no image"},
+        ["not", "an", "object"],
+        {"image": IMAGE, "prompt": "no encoding", "mask": {"width": 2, "height": 2, "data": mask["data"]}},
+        {"image": IMAGE, "prompt": "boolean size", "mask": dict(mask, width=True)},
+        {"image": IMAGE, "prompt": "not a mask", "mask": [0, 1]},
+    ])
+
+    assert [response.status_code for response in responses] == [400] * len(responses)
+
+
+@pytest.mark.parametrize("styles", ["modern", {"modern": True}, ["modern", 3], [["modern"]]])
+def test_batch_styles_must_be_a_list_of_style_ids(served, styles):
+    server, _ = served
+
+    async def post():
+        transport = httpx.ASGITransport(app=server.asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post("/generate-batch", json={"image": IMAGE, "styles": styles})
+    response = asyncio.run(post())
+
+    assert response.status_code == 400
+    assert "styles" in response.json()["error"]
+
+
+def test_batch_streams_each_style_as_it_completes(served):
+    server, fake = served
+    # The image-to-image styles finish first; the slower editing model fails
+    fast, slow = "fal-ai/flux/dev/image-to-image", "fal-ai/ideogram/v3/edit"
+    fake.model_latency = {fast: 0.05, slow: 0.5}
+    fake.model_failure_rate = {slow: 1.0}
+
+    async def post():
+        transport = httpx.ASGITransport(app=server.asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post(
+                "/generate-batch", json={"image": IMAGE, "styles": ["modern", "indian", "bohemian"]}
+            )
+    try:
+        response = asyncio.run(post())
+    finally:
+        fake.model_latency, fake.model_failure_rate = {}, {}
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 4
+    assert sorted(line["style"] for line in lines[:2]) == ["bohemian", "indian"]
+    for line in lines[:2]:
+        assert line["status"] == 200
+        assert line["result_url"] == fake.result_url
+        assert line["name"] == server.PREDEFINED_STYLES[line["style"]]["name"]
+    assert lines[2]["style"] == "modern"
+    assert lines[2]["status"] == 500
+    assert "fake failure" in lines[2]["error"]
+    summary = lines[3]
+    assert (summary["done"], summary["completed"], summary["failed"]) == (True, 2, 1)
+    assert summary["elapsed_ms"] >= 500
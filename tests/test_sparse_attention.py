@@ -0,0 +1,76 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from transformer_flux import EmbedND, FluxChunkedAttnProcessor, FluxSingleTransformerBlock, FluxSparseTokenCache
+
+DIM, HEADS, TEXT_TOKENS, IMAGE_TOKENS = 32, 2, 3, 12
+
+
+def setup(processor=None):
+    torch.manual_seed(0)
+    block = FluxSingleTransformerBlock(DIM, HEADS, DIM // HEADS).eval()
+    if processor is not None:
+        block.attn.set_processor(processor)
+    hidden_states = torch.randn(1, TEXT_TOKENS + IMAGE_TOKENS, DIM)
+    temb = torch.randn(1, DIM)
+    ids = torch.randint(0, 8, (1, TEXT_TOKENS + IMAGE_TOKENS, 3)).float()
+    image_rotary_emb = EmbedND(DIM // HEADS, 10000, [4, 6, 6])(ids)
+    return block, hidden_states, temb, image_rotary_emb
+
+
+def sparse_passes(block, hidden_states, temb, image_rotary_emb):
+    """A refresh pass then a sparse pass over the same input; returns their outputs and the computed token index"""
+    image_token_mask = torch.zeros(IMAGE_TOKENS, dtype=torch.bool)
+    image_token_mask[[1, 4, 5, 10]] = True
+    cache = FluxSparseTokenCache(image_token_mask)
+    outputs = []
+    for _ in range(2):
+        cache.begin_pass(TEXT_TOKENS)
+        tokens, rotary = cache.gather(hidden_states, image_rotary_emb)
+        outputs.append(block(tokens, temb, rotary, sparse_cache=cache, block_index=0))
+        cache.merge_output(outputs[-1][:, TEXT_TOKENS:])
+    return outputs, cache.token_index
+
+
+@pytest.mark.parametrize("processor", [None, FluxChunkedAttnProcessor(query_chunk_size=4)], ids=["default", "chunked"])
+@torch.no_grad()
+def test_sparse_pass_matches_the_full_pass(processor):
+    block, hidden_states, temb, image_rotary_emb = setup(processor)
+    dense = block(hidden_states, temb, image_rotary_emb)
+    (refresh, sparse), token_index = sparse_passes(block, hidden_states, temb, image_rotary_emb)
+
+    assert torch.allclose(refresh, dense, atol=1e-5)
+    assert sparse.shape[1] == TEXT_TOKENS + 4
+    assert torch.allclose(sparse, dense[:, token_index], atol=1e-5)
+
+
+@torch.no_grad()
+def test_chunked_processor_is_used_on_sparse_passes():
+    calls = []
+
+    class RecordingProcessor(FluxChunkedAttnProcessor):
+        def __call__(self, attn, hidden_states, image_rotary_emb=None, sparse_cache=None, block_index=None):
+            calls.append(hidden_states.shape[1])
+            return super().__call__(
+                attn,
+                hidden_states,
+                image_rotary_emb=image_rotary_emb,
+                sparse_cache=sparse_cache,
+                block_index=block_index,
+            )
+
+    sparse_passes(*setup(RecordingProcessor()))
+    assert calls == [TEXT_TOKENS + IMAGE_TOKENS, TEXT_TOKENS + 4]
+
+
+class UnawareProcessor:
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, image_rotary_emb=None):
+        return hidden_states
+
+
+@torch.no_grad()
+def test_processors_without_sparse_support_are_rejected():
+    with pytest.raises(ValueError, match="UnawareProcessor"):
+        sparse_passes(*setup(UnawareProcessor()))
@@ -1,4 +1,5 @@
-from typing import Any, Dict, List, Optional, Union
+import inspect
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -10,6 +11,7 @@ from diffusers.loaders import FromOriginalModelMixin, PeftAdapterMixin
 from diffusers.models.attention import FeedForward
 from diffusers.models.attention_processor import (
     Attention,
+    AttentionProcessor,
     FluxAttnProcessor2_0,
     FluxSingleAttnProcessor2_0,
 )
@@ -71,6 +73,338 @@ class EmbedND(nn.Module):
         return emb.unsqueeze(1)
 
 
+def apply_rope(xq: torch.Tensor, xk: torch.Tensor, freqs_cis: torch.Tensor):
+    xq_ = xq.float().reshape(*xq.shape[:-1], -1, 1, 2)
+    xk_ = xk.float().reshape(*xk.shape[:-1], -1, 1, 2)
+    xq_out = freqs_cis[..., 0] * xq_[..., 0] + freqs_cis[..., 1] * xq_[..., 1]
+    xk_out = freqs_cis[..., 0] * xk_[..., 0] + freqs_cis[..., 1] * xk_[..., 1]
+    return xq_out.reshape(*xq.shape).type_as(xq), xk_out.reshape(*xk.shape).type_as(xk)
+
+
+def apply_rope_(
+    x: torch.Tensor, freqs_cis: torch.Tensor, head_chunk_size: Optional[int] = None
+) -> torch.Tensor:
+    """In-place variant of `apply_rope` for one tensor, rotating `head_chunk_size` heads at a time."""
+    num_heads = x.shape[1]
+    head_chunk_size = head_chunk_size or num_heads
+    for start in range(0, num_heads, head_chunk_size):
+        x_chunk = x[:, start : start + head_chunk_size]
+        x_ = x_chunk.float().reshape(*x_chunk.shape[:-1], -1, 1, 2)
+        x_out = freqs_cis[..., 0] * x_[..., 0] + freqs_cis[..., 1] * x_[..., 1]
+        x_chunk.copy_(x_out.reshape(*x_chunk.shape))
+    return x
+
+
+class FluxChunkedAttnProcessor:
+    r"""
+    Memory-efficient attention processor for the joint and single attention layers of Flux.
+
+    Queries are processed in chunks and heads in groups, so that the attention scores of one chunk stay below
+    `max_memory_bytes`, and the rotary embedding is applied in place on the projected queries and keys. The same
+    instance can be installed on every attention layer of [`FluxTransformer2DModel`] and [`FluxControlNetModel`]
+    with `set_attn_processor`. It is meant for CPU inference on long sequences, where the score matrices dominate the
+    peak memory. It supports masked-token sparse denoising of the single blocks, see [`FluxSparseTokenCache`].
+
+    Args:
+        max_memory_bytes (`int`, *optional*, defaults to 256 MiB):
+            Upper bound of the float32 score matrix of one chunk, used to derive the query chunk size.
+        head_chunk_size (`int`, *optional*):
+            Number of heads processed at once. All heads when `None`.
+        query_chunk_size (`int`, *optional*):
+            Fixed number of queries per chunk, overriding `max_memory_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_memory_bytes: int = 256 * 1024 * 1024,
+        head_chunk_size: Optional[int] = None,
+        query_chunk_size: Optional[int] = None,
+    ):
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ImportError(
+                "FluxChunkedAttnProcessor requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0."
+            )
+        self.max_memory_bytes = max_memory_bytes
+        self.head_chunk_size = head_chunk_size
+        self.query_chunk_size = query_chunk_size
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: torch.FloatTensor = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+        sparse_cache: Optional["FluxSparseTokenCache"] = None,
+        block_index: Optional[int] = None,
+    ):
+        batch_size = hidden_states.shape[0]
+
+        # `sample` projections.
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        # `context` projections, only for the joint attention of the double blocks.
+        if encoder_hidden_states is not None:
+            encoder_hidden_states_query_proj = attn.add_q_proj(encoder_hidden_states)
+            encoder_hidden_states_key_proj = attn.add_k_proj(encoder_hidden_states)
+            encoder_hidden_states_value_proj = attn.add_v_proj(encoder_hidden_states)
+
+            encoder_hidden_states_query_proj = encoder_hidden_states_query_proj.view(
+                batch_size, -1, attn.heads, head_dim
+            ).transpose(1, 2)
+            encoder_hidden_states_key_proj = encoder_hidden_states_key_proj.view(
+                batch_size, -1, attn.heads, head_dim
+            ).transpose(1, 2)
+            encoder_hidden_states_value_proj = encoder_hidden_states_value_proj.view(
+                batch_size, -1, attn.heads, head_dim
+            ).transpose(1, 2)
+
+            if attn.norm_added_q is not None:
+                encoder_hidden_states_query_proj = attn.norm_added_q(encoder_hidden_states_query_proj)
+            if attn.norm_added_k is not None:
+                encoder_hidden_states_key_proj = attn.norm_added_k(encoder_hidden_states_key_proj)
+
+            query = torch.cat([encoder_hidden_states_query_proj, query], dim=2)
+            key = torch.cat([encoder_hidden_states_key_proj, key], dim=2)
+            value = torch.cat([encoder_hidden_states_value_proj, value], dim=2)
+
+        if image_rotary_emb is not None:
+            apply_rope_(query, image_rotary_emb, self.head_chunk_size)
+            apply_rope_(key, image_rotary_emb, self.head_chunk_size)
+
+        if sparse_cache is not None:
+            key, value = sparse_cache.update_key_value(block_index, key, value)
+
+        hidden_states = self._chunked_attention(query, key, value)
+        hidden_states = hidden_states.transpose(1, 2).reshape(
+            batch_size, -1, attn.heads * head_dim
+        )
+        hidden_states = hidden_states.to(query.dtype)
+
+        if encoder_hidden_states is None:
+            return hidden_states
+
+        encoder_hidden_states, hidden_states = (
+            hidden_states[:, : encoder_hidden_states.shape[1]],
+            hidden_states[:, encoder_hidden_states.shape[1] :],
+        )
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+        encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+
+        return hidden_states, encoder_hidden_states
+
+    def _chunked_attention(
+        self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor
+    ) -> torch.Tensor:
+        batch_size, num_heads, query_len, _ = query.shape
+        key_len = key.shape[2]
+
+        head_chunk_size = self.head_chunk_size or num_heads
+        if self.query_chunk_size is not None:
+            query_chunk_size = self.query_chunk_size
+        else:
+            score_bytes_per_query = batch_size * head_chunk_size * key_len * 4
+            query_chunk_size = max(1, self.max_memory_bytes // score_bytes_per_query)
+
+        output = torch.empty_like(query)
+        for head_start in range(0, num_heads, head_chunk_size):
+            heads = slice(head_start, head_start + head_chunk_size)
+            for query_start in range(0, query_len, query_chunk_size):
+                queries = slice(query_start, query_start + query_chunk_size)
+                output[:, heads, queries] = F.scaled_dot_product_attention(
+                    query[:, heads, queries],
+                    key[:, heads],
+                    value[:, heads],
+                    dropout_p=0.0,
+                    is_causal=False,
+                )
+        return output
+
+
+class FluxSparseSingleAttnProcessor:
+    r"""
+    [`FluxSingleAttnProcessor2_0`] with support for masked-token sparse denoising, see [`FluxSparseTokenCache`].
+
+    [`FluxSparseTokenCache`] runs the single blocks that use the default processor through this one on sparse passes.
+    Without a `sparse_cache` it computes the same attention as the default processor.
+    """
+
+    def __init__(self):
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ImportError(
+                "FluxSparseSingleAttnProcessor requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0."
+            )
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: torch.FloatTensor = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+        sparse_cache: Optional["FluxSparseTokenCache"] = None,
+        block_index: Optional[int] = None,
+    ):
+        batch_size = hidden_states.shape[0]
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        if image_rotary_emb is not None:
+            query, key = apply_rope(query, key, image_rotary_emb)
+
+        if sparse_cache is not None:
+            key, value = sparse_cache.update_key_value(block_index, key, value)
+
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, dropout_p=0.0, is_causal=False
+        )
+        hidden_states = hidden_states.transpose(1, 2).reshape(
+            batch_size, -1, attn.heads * head_dim
+        )
+        return hidden_states.to(query.dtype)
+
+
+class FluxSparseTokenCache:
+    r"""
+    State of masked-token sparse denoising for the single transformer blocks.
+
+    On a refresh pass every token goes through the single blocks and the keys/values of each block, as well as the
+    image tokens at the output of the single stack, are stored. On the sparse passes that follow, only the text tokens
+    and the image tokens selected by `image_token_mask` go through the single blocks: their queries, keys/values, MLP
+    and output projections are computed, they attend to the stored keys/values of the frozen tokens, and the frozen
+    tokens take their output from the last refresh pass.
+
+    The stored keys/values take `2 * num_single_layers` tensors of the size of the joint sequence.
+
+    The attention of the single blocks goes through their attention processor, which receives the cache as
+    `sparse_cache` and merges its keys/values with [`~FluxSparseTokenCache.update_key_value`]. The default processor is
+    run as [`FluxSparseSingleAttnProcessor`] and [`FluxChunkedAttnProcessor`] supports the cache as well; any other
+    processor raises a `ValueError`.
+
+    Parameters:
+        image_token_mask (`torch.BoolTensor` of shape `(image_seq_len,)`):
+            The image tokens that keep being computed on sparse passes.
+        refresh_every (`int`, *optional*, defaults to 0):
+            Run a full refresh pass every `refresh_every` transformer calls. With 0, only the first call is a refresh
+            pass.
+    """
+
+    def __init__(self, image_token_mask: torch.Tensor, refresh_every: int = 0):
+        self.image_token_index = image_token_mask.nonzero().flatten()
+        self.num_image_tokens = image_token_mask.shape[0]
+        self.refresh_every = refresh_every
+
+        self.key: Dict[int, torch.Tensor] = {}
+        self.value: Dict[int, torch.Tensor] = {}
+        self.hidden_states: Optional[torch.Tensor] = None
+        self.token_index: Optional[torch.Tensor] = None
+        self.refreshing = True
+        self._passes = 0
+
+    def begin_pass(self, num_text_tokens: int):
+        self.refreshing = self.hidden_states is None or (
+            self.refresh_every > 0 and self._passes % self.refresh_every == 0
+        )
+        self._passes += 1
+        if self.token_index is None or self.token_index.shape[0] != num_text_tokens + self.image_token_index.shape[0]:
+            text_index = torch.arange(num_text_tokens, device=self.image_token_index.device)
+            self.token_index = torch.cat([text_index, self.image_token_index + num_text_tokens])
+
+    def gather(self, hidden_states: torch.Tensor, image_rotary_emb: torch.Tensor):
+        """Select the computed tokens of the joint sequence and of its rotary embedding."""
+        if self.refreshing:
+            return hidden_states, image_rotary_emb
+        hidden_states = hidden_states.index_select(1, self.token_index)
+        if image_rotary_emb is not None:
+            image_rotary_emb = image_rotary_emb.index_select(2, self.token_index)
+        return hidden_states, image_rotary_emb
+
+    def gather_image_tokens(self, sample: torch.Tensor) -> torch.Tensor:
+        """Select the computed image tokens of an image-token tensor such as a controlnet residual."""
+        if self.refreshing:
+            return sample
+        return sample.index_select(1, self.image_token_index)
+
+    def update_key_value(
+        self, block_index: int, key: torch.Tensor, value: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Store the keys/values of a block on a refresh pass. On a sparse pass, write those of the computed tokens into
+        the stored ones and return the keys/values of the whole joint sequence.
+        """
+        if self.refreshing:
+            self.key[block_index] = key
+            self.value[block_index] = value
+            return key, value
+        # refresh the computed tokens, the frozen ones keep the keys/values of the refresh pass
+        key = self.key[block_index].index_copy_(2, self.token_index, key)
+        value = self.value[block_index].index_copy_(2, self.token_index, value)
+        return key, value
+
+    def attention(
+        self,
+        attn: Attention,
+        block_index: int,
+        hidden_states: torch.Tensor,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Run the attention of a single block through its processor, with the keys/values of this cache."""
+        processor = attn.processor
+        if isinstance(processor, FluxSingleAttnProcessor2_0):
+            processor = FluxSparseSingleAttnProcessor()
+        elif "sparse_cache" not in inspect.signature(processor.__call__).parameters:
+            raise ValueError(
+                f"{processor.__class__.__name__} does not support `sparse_mask_denoising`, use the default attention"
+                " processor or `FluxChunkedAttnProcessor`."
+            )
+        return processor(
+            attn,
+            hidden_states,
+            image_rotary_emb=image_rotary_emb,
+            sparse_cache=self,
+            block_index=block_index,
+        )
+
+    def merge_output(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Scatter the computed image tokens into the stored output of the single stack."""
+        if self.refreshing:
+            self.hidden_states = hidden_states.clone()
+            return hidden_states
+        return self.hidden_states.index_copy_(1, self.image_token_index, hidden_states)
+
+
 @maybe_allow_in_graph
 class FluxSingleTransformerBlock(nn.Module):
     r"""
@@ -114,15 +448,22 @@ class FluxSingleTransformerBlock(nn.Module):
         hidden_states: torch.FloatTensor,
         temb: torch.FloatTensor,
         image_rotary_emb=None,
+        sparse_cache: Optional[FluxSparseTokenCache] = None,
+        block_index: Optional[int] = None,
     ):
         residual = hidden_states
         norm_hidden_states, gate = self.norm(hidden_states, emb=temb)
         mlp_hidden_states = self.act_mlp(self.proj_mlp(norm_hidden_states))
 
-        attn_output = self.attn(
-            hidden_states=norm_hidden_states,
-            image_rotary_emb=image_rotary_emb,
-        )
+        if sparse_cache is not None:
+            attn_output = sparse_cache.attention(
+                self.attn, block_index, norm_hidden_states, image_rotary_emb
+            )
+        else:
+            attn_output = self.attn(
+                hidden_states=norm_hidden_states,
+                image_rotary_emb=image_rotary_emb,
+            )
 
         hidden_states = torch.cat([attn_output, mlp_hidden_states], dim=2)
         gate = gate.unsqueeze(1)
@@ -342,6 +683,66 @@ class FluxTransformer2DModel(
 
         self.gradient_checkpointing = False
 
+    @property
+    # Copied from diffusers.models.unets.unet_2d_condition.UNet2DConditionModel.attn_processors
+    def attn_processors(self) -> Dict[str, AttentionProcessor]:
+        r"""
+        Returns:
+            `dict` of attention processors: A dictionary containing all attention processors used in the model with
+            indexed by its weight name.
+        """
+        # set recursively
+        processors = {}
+
+        def fn_recursive_add_processors(name: str, module: torch.nn.Module, processors: Dict[str, AttentionProcessor]):
+            if hasattr(module, "get_processor"):
+                processors[f"{name}.processor"] = module.get_processor()
+
+            for sub_name, child in module.named_children():
+                fn_recursive_add_processors(f"{name}.{sub_name}", child, processors)
+
+            return processors
+
+        for name, module in self.named_children():
+            fn_recursive_add_processors(name, module, processors)
+
+        return processors
+
+    # Copied from diffusers.models.unets.unet_2d_condition.UNet2DConditionModel.set_attn_processor
+    def set_attn_processor(self, processor: Union[AttentionProcessor, Dict[str, AttentionProcessor]]):
+        r"""
+        Sets the attention processor to use to compute attention.
+
+        Parameters:
+            processor (`dict` of `AttentionProcessor` or only `AttentionProcessor`):
+                The instantiated processor class or a dictionary of processor classes that will be set as the processor
+                for **all** `Attention` layers.
+
+                If `processor` is a dict, the key needs to define the path to the corresponding cross attention
+                processor. This is strongly recommended when setting trainable attention processors.
+
+        """
+        count = len(self.attn_processors.keys())
+
+        if isinstance(processor, dict) and len(processor) != count:
+            raise ValueError(
+                f"A dict of processors was passed, but the number of processors {len(processor)} does not match the"
+                f" number of attention layers: {count}. Please make sure to pass {count} processor classes."
+            )
+
+        def fn_recursive_attn_processor(name: str, module: torch.nn.Module, processor):
+            if hasattr(module, "set_processor"):
+                if not isinstance(processor, dict):
+                    module.set_processor(processor)
+                else:
+                    module.set_processor(processor.pop(f"{name}.processor"))
+
+            for sub_name, child in module.named_children():
+                fn_recursive_attn_processor(f"{name}.{sub_name}", child, processor)
+
+        for name, module in self.named_children():
+            fn_recursive_attn_processor(name, module, processor)
+
     def _set_gradient_checkpointing(self, module, value=False):
         if hasattr(module, "gradient_checkpointing"):
             module.gradient_checkpointing = value
@@ -359,6 +760,7 @@ class FluxTransformer2DModel(
         controlnet_block_samples=None,
         controlnet_single_block_samples=None,
         return_dict: bool = True,
+        sparse_cache: Optional[FluxSparseTokenCache] = None,
     ) -> Union[torch.FloatTensor, Transformer2DModelOutput]:
         """
         The [`FluxTransformer2DModel`] forward method.
@@ -381,6 +783,9 @@ class FluxTransformer2DModel(
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~models.transformer_2d.Transformer2DModelOutput`] instead of a plain
                 tuple.
+            sparse_cache (`FluxSparseTokenCache`, *optional*):
+                Inference only. Enables masked-token sparse denoising of the single blocks, see
+                [`FluxSparseTokenCache`]. The same cache has to be passed to every call of a denoising run.
 
         Returns:
             If `return_dict` is True, an [`~models.transformer_2d.Transformer2DModelOutput`] is returned, otherwise a
@@ -469,6 +874,12 @@ class FluxTransformer2DModel(
 
         hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
 
+        if sparse_cache is not None:
+            if self.training and self.gradient_checkpointing:
+                raise ValueError("Sparse denoising does not support gradient checkpointing.")
+            sparse_cache.begin_pass(encoder_hidden_states.shape[1])
+            hidden_states, image_rotary_emb = sparse_cache.gather(hidden_states, image_rotary_emb)
+
         for index_block, block in enumerate(self.single_transformer_blocks):
             if self.training and self.gradient_checkpointing:
 
@@ -497,6 +908,8 @@ class FluxTransformer2DModel(
                     hidden_states=hidden_states,
                     temb=temb,
                     image_rotary_emb=image_rotary_emb,
+                    sparse_cache=sparse_cache,
+                    block_index=index_block,
                 )
 
             # controlnet residual
@@ -505,12 +918,21 @@ class FluxTransformer2DModel(
                     controlnet_single_block_samples
                 )
                 interval_control = int(np.ceil(interval_control))
+                controlnet_single_block_sample = controlnet_single_block_samples[
+                    index_block // interval_control
+                ]
+                if sparse_cache is not None:
+                    controlnet_single_block_sample = sparse_cache.gather_image_tokens(
+                        controlnet_single_block_sample
+                    )
                 hidden_states[:, encoder_hidden_states.shape[1] :, ...] = (
                     hidden_states[:, encoder_hidden_states.shape[1] :, ...]
-                    + controlnet_single_block_samples[index_block // interval_control]
+                    + controlnet_single_block_sample
                 )
 
         hidden_states = hidden_states[:, encoder_hidden_states.shape[1] :, ...]
+        if sparse_cache is not None:
+            hidden_states = sparse_cache.merge_output(hidden_states)
 
         hidden_states = self.norm_out(hidden_states, temb)
         output = self.proj_out(hidden_states)